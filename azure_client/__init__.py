@@ -1,3 +1,28 @@
 from azure_client.authentication import AzureAuth
-from azure_client.mail import create_draft, get_emails, get_all_emails_it, send_email, delete_email
-from azure_client.utils import get_or_create_credentials
+from azure_client.mail import (create_draft, get_email, get_emails, get_emails_page,
+                               get_all_emails_it, send_email, send_mail, delete_email, MessageList,
+                               RawPage)
+from azure_client.utils import (get_or_create_credentials, get_or_create_app_credentials,
+                                sync_folder, iter_sync_folder)
+from azure_client.session import HttpSession, get_default_session, set_default_session
+from azure_client.batch import (BatchResult, execute_batch, create_drafts, send_emails, send_mails,
+                                delete_emails, permanent_delete_emails, move_emails)
+from azure_client.sync import SyncResult, sync_emails, iter_sync_emails
+from azure_client.throttling import RetryPolicy, RateLimiter
+from azure_client.attachments import (add_attachment, create_draft_with_files, get_attachments,
+                                      download_attachment, download_attachments, inline_attachment)
+from azure_client.message import Message
+from azure_client.streaming import iter_emails_page, iter_all_emails
+from azure_client.fanout import FanOutResult, fan_out
+from azure_client.cache import MessageCache, CacheStats
+from azure_client.query import Query
+from azure_client.instrumentation import Event, Instrumentation, MetricsAggregator
+from azure_client.credentials import CredentialStore
+from azure_client.subscriptions import (Notification, NotificationReceiver, create_subscription,
+                                        renew_subscription, delete_subscription, get_subscriptions)
+from azure_client.export import export_folder, get_email_mime, save_email_mime
+from azure_client.merge import MailTemplate, mail_merge
+from azure_client.folders import (get_folders, get_folder, count_emails, get_mailbox_stats,
+                                  create_folder, move_folder, delete_folder, empty_folder,
+                                  move_folder_emails)
+from azure_client.codec import JsonCodec, get_codec, set_codec
@@ -0,0 +1,4 @@
+from azure_client.aio.session import AsyncHttpSession, get_default_session
+from azure_client.aio.authentication import refresh_access_token, ensure_valid_token
+from azure_client.aio.mail import (create_draft, get_emails, get_emails_page, get_all_emails_it,
+                                   send_email, send_mail, delete_email)
@@ -0,0 +1,129 @@
+"""
+Module which refreshes the azure tokens with coroutines
+"""
+
+import asyncio
+import logging
+import time
+import urllib.parse
+import weakref
+from azure_client import codec
+from azure_client import authentication
+from azure_client.instrumentation import emit, TOKEN_REFRESH
+from azure_client.aio.session import get_session
+
+
+_REFRESH_LOCKS = weakref.WeakKeyDictionary()
+
+
+async def get_access_token_from_refresh_token(client_id, client_secret, refresh_token, tenant,  # pylint: disable=too-many-arguments
+                                              redirect_uri, session=None):
+    """
+    coroutine which refreshes an access token using a refresh token,
+    returns the access token, the refresh token and the lifetime of the access token
+    """
+    token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=authentication.LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
+    data = {
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "refresh_token": refresh_token,
+        "redirect_uri": redirect_uri,
+        "grant_type": "refresh_token"
+        }
+    params = urllib.parse.urlencode(data).encode("utf8")
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    resp = await get_session(session).request("POST", token_url, params, headers)
+    resp_data = codec.loads(resp.read())
+    access_token = resp_data['access_token']
+    refresh_token = resp_data.get('refresh_token', refresh_token)
+    expires_in = resp_data.get('expires_in')
+
+    return access_token, refresh_token, expires_in
+
+async def get_client_credentials_token(data, tenant, session=None):
+    """
+    coroutine which gets an application access token with the client credentials
+    built by azure_client.authentication.client_credentials_data,
+    returns the access token and its lifetime
+    """
+    token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=authentication.LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
+    params = urllib.parse.urlencode(data).encode("utf8")
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    resp = await get_session(session).request("POST", token_url, params, headers)
+    resp_data = codec.loads(resp.read())
+
+    return resp_data['access_token'], resp_data.get('expires_in')
+
+async def refresh_access_token(auth, session=None):
+    """
+    coroutine version of AzureAuth.refresh_access_token,
+    updates the tokens of the azure_client.authentication.AzureAuth given
+    """
+    if auth.store is not None:
+        # the lock of the store is held by a thread so that the event loop is not blocked,
+        # the token is then refreshed with the synchronous session of auth
+        await asyncio.get_running_loop().run_in_executor(None, auth.refresh_access_token)
+        return
+    start = time.perf_counter()
+    try:
+        await _refresh_access_token(auth, session)
+    except Exception as err:
+        emit(get_session(session), TOKEN_REFRESH, grant_type=auth.grant_type,
+             duration=time.perf_counter() - start, source='server', error=err)
+        raise
+    emit(get_session(session), TOKEN_REFRESH, grant_type=auth.grant_type,
+         duration=time.perf_counter() - start, source='server', error=None)
+
+async def _refresh_access_token(auth, session):
+    if auth.grant_type == authentication.CLIENT_CREDENTIALS:
+        logging.getLogger(__name__).info('Requesting an application token')
+        auth.access_token, expires_in = await get_client_credentials_token(
+            authentication.client_credentials_data(auth),
+            auth.tenant,
+            session=session)
+        auth._set_expiry(expires_in)  # pylint: disable=protected-access
+        return
+    logging.getLogger(__name__).info('Refreshing the token')
+    auth.access_token, auth.refresh_token, expires_in = await get_access_token_from_refresh_token(
+        auth.client_id,
+        auth.client_secret,
+        auth.refresh_token,
+        auth.tenant,
+        auth.redirect_uri,
+        session=session)
+    auth._set_expiry(expires_in)  # pylint: disable=protected-access
+
+def _refresh_lock(auth):
+    """
+    returns the lock of the refreshes of auth in the running event loop
+    """
+    locks = _REFRESH_LOCKS.setdefault(asyncio.get_running_loop(), weakref.WeakKeyDictionary())
+    lock = locks.get(auth)
+    if lock is None:
+        lock = locks[auth] = asyncio.Lock()
+    return lock
+
+async def ensure_valid_token(auth, margin=authentication.REFRESH_MARGIN, session=None):
+    """
+    coroutine version of AzureAuth.ensure_valid_token,
+    the concurrent coroutines wait for one single refresh
+    """
+    if not auth.token_expires_soon(margin):
+        return False
+    async with _refresh_lock(auth):
+        if not auth.token_expires_soon(margin):
+            return False
+        await refresh_access_token(auth, session)
+        return True
+
+async def refresh_rejected_token(auth, rejected_token, session=None):
+    """
+    coroutine version of AzureAuth.refresh_rejected_token
+    """
+    async with _refresh_lock(auth):
+        if auth.access_token == rejected_token:
+            if auth.store is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, auth.refresh_rejected_token, rejected_token)
+            else:
+                await refresh_access_token(auth, session)
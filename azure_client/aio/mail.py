@@ -0,0 +1,187 @@
+"""
+Module which handles the outlook email REST API with coroutines,
+see azure_client.mail for the documentation of the endpoints
+"""
+
+import logging
+import time
+from azure_client import codec, mail
+from azure_client.mail import (MAX_PAGE_SIZE, DEFAULT_SELECT, _messages_url, _messages_headers,
+                               _draft_data, _send_mail_data, _messages_value)
+from azure_client.exceptions import AzureError
+from azure_client.instrumentation import emit, PARSE
+from azure_client.aio.authentication import ensure_valid_token, refresh_rejected_token
+from azure_client.aio.session import get_session
+
+
+async def _request(auth, method, url, data=None, headers=None, session=None):  # pylint: disable=too-many-arguments
+    """
+    sends one request to the graph API with the credentials of auth,
+    raises an AzureError if the request fails, the access token is
+    refreshed before it expires and the request is retried once if
+    the server rejects the token
+    """
+    await ensure_valid_token(auth, session=session)
+    headers = dict(headers or {})
+    access_token = auth.access_token
+    headers['Authorization'] = 'Bearer {}'.format(access_token)
+    try:
+        return await get_session(session).request(method, url, data, headers)
+    except AzureError as err:
+        if err.code != 401 or not auth.can_refresh():
+            raise
+    logging.getLogger(__name__).info("Access token rejected, refreshing it")
+    await refresh_rejected_token(auth, access_token, session)
+    headers['Authorization'] = 'Bearer {}'.format(auth.access_token)
+    return await get_session(session).request(method, url, data, headers)
+
+async def _get_messages_data(auth, url, session, headers=None):
+    """
+    gets one page of messages and returns the decoded response
+    """
+    headers = headers or {'Content-Type': 'application/json'}
+    resp = await _request(auth, "GET", url, headers=headers, session=session)
+    start = time.perf_counter()
+    resp_data = codec.loads(resp.read())
+    emit(get_session(session), PARSE, kind='messages', duration=time.perf_counter() - start,
+         size=len(resp.read()))
+
+    logging.getLogger(__name__).info("Messages recieved")
+
+    return resp_data
+
+async def create_draft(auth, subject, body, addresses, user_id, cc_addresses=(),  # pylint: disable=too-many-arguments
+                       attachments_list=None, session=None):
+    """
+    coroutine version of azure_client.mail.create_draft,
+    returns the id of the draft created
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    data = _draft_data(subject, body, addresses, cc_addresses, attachments_list)
+
+    params = codec.dumps(data)
+
+    url = "{api_url}/{user_id}/messages".format(api_url=mail.API_URL, user_id=user_id)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = await _request(auth, "POST", url, params, headers, session)
+    resp_data = codec.loads(resp.read())
+
+    logging.getLogger(__name__).info("Draft created")
+
+    return resp_data['id']
+
+async def get_emails(auth, user_id, folder_id='AllItems', session=None, **kwargs):
+    """
+    coroutine version of azure_client.mail.get_emails
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    url = _messages_url(user_id, folder_id, kwargs)
+    resp_data = await _get_messages_data(auth, url, session, _messages_headers(kwargs))
+
+    return _messages_value(resp_data)
+
+async def get_emails_page(auth, user_id, folder_id='AllItems', next_link=None, session=None,  # pylint: disable=too-many-arguments
+                          **kwargs):
+    """
+    coroutine version of azure_client.mail.get_emails_page
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    url = next_link if next_link is not None else _messages_url(user_id, folder_id, kwargs)
+    resp_data = await _get_messages_data(auth, url, session, _messages_headers(kwargs))
+
+    return _messages_value(resp_data), resp_data.get('@odata.nextLink')
+
+async def send_email(auth, user_id, message_id, session=None):
+    """
+    coroutine version of azure_client.mail.send_email
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    url = "{api_url}/{user_id}/messages/{message_id}/send".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id
+        )
+
+    await _request(auth, "POST", url, session=session)
+    logging.getLogger(__name__).info("Message sent")
+
+async def send_mail(auth, subject, body, addresses, user_id, cc_addresses=(), attachments_list=None,  # pylint: disable=too-many-arguments
+                    save_to_sent_items=True, session=None):
+    """
+    coroutine version of azure_client.mail.send_mail
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    data = _send_mail_data(_draft_data(subject, body, addresses, cc_addresses, attachments_list),
+                           save_to_sent_items)
+
+    params = codec.dumps(data)
+
+    url = "{api_url}/{user_id}/sendMail".format(api_url=mail.API_URL, user_id=user_id)
+
+    headers = {'Content-Type': 'application/json'}
+    await _request(auth, "POST", url, params, headers, session)
+    logging.getLogger(__name__).info("Message sent")
+
+async def delete_email(auth, user_id, message_id, session=None):
+    """
+    coroutine version of azure_client.mail.delete_email
+
+    Args:
+        session (azure_client.aio.session.AsyncHttpSession): the session to use,
+            the default one if None
+    """
+    url = "{api_url}/{user_id}/messages/{message_id}".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id
+        )
+
+    await _request(auth, "DELETE", url, session=session)
+    logging.getLogger(__name__).info("Message deleted")
+
+async def get_all_emails_it(auth, user_id, folder_id='AllItems', pages_limit=None, pages_size=50,  # pylint: disable=too-many-arguments
+                            pagination='next_link', session=None, **kwargs):
+    """
+    asynchronous generator version of azure_client.mail.get_all_emails_it
+    """
+    kwargs.setdefault('select', DEFAULT_SELECT)
+    if pages_size > MAX_PAGE_SIZE:
+        raise ValueError('The pages size should be at most {}'.format(MAX_PAGE_SIZE))
+    if pagination not in ('next_link', 'skip'):
+        raise ValueError('Unexpected pagination {}'.format(pagination))
+
+    i = 0
+    args_dict = dict(kwargs, top=pages_size)
+    if pagination == 'skip':
+        args_dict['skip'] = 0
+    curr_emails, next_link = await get_emails_page(auth, user_id, folder_id, session=session,
+                                                   **args_dict)
+    while len(curr_emails) != 0:
+        yield curr_emails
+        if pages_limit is not None and i >= pages_limit:
+            break
+        i += 1
+        if pagination == 'next_link':
+            if next_link is None:
+                break
+            curr_emails, next_link = await get_emails_page(
+                auth, user_id, folder_id, next_link, session, body_type=kwargs.get('body_type'))
+        else:
+            args_dict['skip'] = pages_size * i
+            curr_emails = await get_emails(auth, user_id, folder_id, session, **args_dict)
@@ -0,0 +1,307 @@
+"""
+Module which handles the non blocking http connections to the azure
+REST APIs, the connections are asyncio streams kept alive and pooled by
+host, and a semaphore limits the number of requests in flight
+"""
+
+import asyncio
+import http.client
+import logging
+import ssl
+import time
+import urllib.parse
+import weakref
+from collections import deque
+from azure_client.exceptions import AzureError
+from azure_client.instrumentation import Instrumentation, REQUEST, RETRY, THROTTLED
+from azure_client.session import HttpResponse, DEFAULT_IDLE_TIMEOUT, DEFAULT_TIMEOUT
+from azure_client.throttling import (RetryPolicy, RateLimiter, IDEMPOTENT_METHODS,
+                                     RETRY_AFTER_STATUSES, parse_retry_after)
+
+
+DEFAULT_MAX_CONCURRENCY = 100
+DEFAULT_POOL_SIZE = 100
+
+_DEFAULT_SESSIONS = weakref.WeakKeyDictionary()
+
+
+class _Connection:  # pylint: disable=too-few-public-methods
+
+    """
+    one keep-alive connection to a host
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """
+        closes the underlying transport
+        """
+        self.writer.close()
+
+
+class AsyncHttpSession:
+
+    """
+    Class which keeps a pool of keep-alive asyncio connections per host,
+    at most max_concurrency requests are in flight at the same time
+
+    Args:
+        max_concurrency (int): the maximum number of concurrent requests
+        pool_size (int): the maximum number of idle connections kept per host
+        idle_timeout (float): the number of seconds after which an idle connection is closed
+        timeout (float): the timeout of one request in seconds
+        ssl_context (ssl.SSLContext): the context of the https connections, the default one if None
+        retry_policy (azure_client.throttling.RetryPolicy): how the failed requests are retried,
+            a default RetryPolicy if None
+        rate_limiter (azure_client.throttling.RateLimiter): the limiter of the requests per mailbox,
+            a default RateLimiter if None
+        instrumentation (azure_client.instrumentation.Instrumentation): receives the events
+            of the requests, a new Instrumentation without listeners if None, the connections
+            being opened by asyncio the dns, connect and tls phases are reported together as connect
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, pool_size=DEFAULT_POOL_SIZE,  # pylint: disable=too-many-arguments
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT, ssl_context=None,
+                 retry_policy=None, rate_limiter=None, instrumentation=None):
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pools = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def request(self, method, url, data=None, headers=None):
+        """
+        sends one request and returns an azure_client.session.HttpResponse,
+        the request is retried according to the retry policy and delayed
+        by the rate limiter, raises an AzureError if the server answers
+        with an error status
+
+        Args:
+            method (str): the http method, 'GET', 'POST', 'DELETE'...
+            url (str): the full url of the resource
+            data (bytes): the body of the request
+            headers (dict): the headers of the request
+        """
+        key = self.rate_limiter.key(url, data)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            wait = self.rate_limiter.reserve(key)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            phases = {}
+            try:
+                async with self._semaphore:
+                    phases['queue'] = time.perf_counter() - start
+                    response = await asyncio.wait_for(
+                        self._request(method, url, data, headers, phases), self.timeout)
+            except Exception as err:
+                self.instrumentation.emit(
+                    REQUEST, method=method, url=url, status=None, attempt=attempt,
+                    duration=time.perf_counter() - start, phases=phases,
+                    request_size=len(data) if data else 0, response_size=None, reused=None,
+                    error=err)
+                if not self.retry_policy.should_retry_error(method, err, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logging.getLogger(__name__).warning(
+                    'Request %s %s failed with %r, retrying in %.1fs', method, url, err, delay)
+                self.instrumentation.emit(
+                    RETRY, method=method, url=url, status=None, attempt=attempt, delay=delay,
+                    retry_after=None)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.instrumentation.emit(
+                REQUEST, method=method, url=url, status=response.status, attempt=attempt,
+                duration=time.perf_counter() - start, phases=response.phases,
+                request_size=len(data) if data else 0, response_size=len(response.body),
+                reused=response.reused, error=None)
+            if response.status < 400:
+                self.rate_limiter.succeeded(key)
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status in RETRY_AFTER_STATUSES:
+                self.rate_limiter.throttled(key, retry_after)
+                self.instrumentation.emit(
+                    THROTTLED, url=url, status=response.status, retry_after=retry_after, count=1)
+            if not self.retry_policy.should_retry(method, response.status, attempt):
+                raise AzureError(response)
+            delay = self.retry_policy.delay(attempt, retry_after)
+            logging.getLogger(__name__).warning(
+                'Request %s %s failed with status %d, retrying in %.1fs',
+                method, url, response.status, delay)
+            self.instrumentation.emit(
+                RETRY, method=method, url=url, status=response.status, attempt=attempt, delay=delay,
+                retry_after=retry_after)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def close(self):
+        """
+        closes all the idle connections of the pool
+        """
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    async def _request(self, method, url, data, headers, phases):  # pylint: disable=too-many-arguments
+        parsed_url = urllib.parse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        request = self._serialize(method, path, parsed_url.netloc, data, headers or {})
+
+        start = time.perf_counter()
+        conn, reused = await self._acquire(key)
+        if not reused:
+            phases['connect'] = time.perf_counter() - start
+        try:
+            status, reason, resp_headers, body, keep_alive = await self._send(
+                conn, request, method, phases)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            conn.close()
+            if not reused or method not in IDEMPOTENT_METHODS:
+                # a request which is not idempotent may have been processed, it is not sent twice
+                raise
+            # the server closed the idle connection in the meantime
+            logging.getLogger(__name__).debug(
+                'Stale connection to %s, reconnecting', parsed_url.netloc)
+            start = time.perf_counter()
+            conn, reused = await self._new_connection(key), False
+            phases['connect'] = time.perf_counter() - start
+            status, reason, resp_headers, body, keep_alive = await self._send(
+                conn, request, method, phases)
+        except BaseException:
+            conn.close()
+            raise
+
+        if keep_alive:
+            self._release(key, conn)
+        else:
+            conn.close()
+        response = HttpResponse(status, reason, resp_headers, body)
+        response.phases = phases
+        response.reused = reused
+        return response
+
+    @staticmethod
+    def _serialize(method, path, netloc, data, headers):  # pylint: disable=too-many-arguments
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(netloc)]
+        lowered = {key.lower() for key in headers}
+        has_body = data is not None or method in ('POST', 'PUT', 'PATCH')
+        if 'content-length' not in lowered and has_body:
+            lines.append('Content-Length: {}'.format(len(data or b'')))
+        lines.extend('{}: {}'.format(key, value) for (key, value) in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b'')
+
+    @staticmethod
+    async def _send(conn, request, method, phases):
+        start = time.perf_counter()
+        conn.writer.write(request)
+        await conn.writer.drain()
+        sent = time.perf_counter()
+
+        status_line = await conn.reader.readuntil(b'\r\n')
+        received = time.perf_counter()
+        phases['send'] = sent - start
+        phases['server'] = received - sent
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+        headers = http.client.HTTPMessage()
+        while True:
+            line = await conn.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await conn.reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+                if size == 0:
+                    while await conn.reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await conn.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await conn.reader.read()
+            keep_alive = False
+        phases['read'] = time.perf_counter() - received
+        return status, reason, headers, body, keep_alive
+
+    async def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            ssl_context = self.ssl_context or ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(host, port or 443, ssl=ssl_context)
+        elif scheme == 'http':
+            reader, writer = await asyncio.open_connection(host, port or 80)
+        else:
+            raise ValueError('Unsupported url scheme {}'.format(scheme))
+        return _Connection(reader, writer)
+
+    async def _acquire(self, key):
+        now = time.monotonic()
+        pool = self._pools.get(key)
+        while pool:
+            conn = pool.pop()
+            if now - conn.last_used < self.idle_timeout and not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        return await self._new_connection(key), False
+
+    def _release(self, key, conn):
+        pool = self._pools.setdefault(key, deque())
+        if len(pool) < self.pool_size:
+            conn.last_used = time.monotonic()
+            pool.append(conn)
+        else:
+            conn.close()
+
+
+def get_default_session():
+    """
+    returns the session shared by the coroutines running
+    in the current event loop
+    """
+    loop = asyncio.get_running_loop()
+    session = _DEFAULT_SESSIONS.get(loop)
+    if session is None:
+        session = _DEFAULT_SESSIONS[loop] = AsyncHttpSession()
+    return session
+
+
+def get_session(session=None):
+    """
+    returns the session given or the default one if it is None
+    """
+    if session is None:
+        return get_default_session()
+    return session
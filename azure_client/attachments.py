@@ -0,0 +1,369 @@
+"""
+Module which handles the attachments of the messages, the small files
+are sent inline and the large ones through an upload session in chunks
+read from the disk into one reused buffer
+see https://docs.microsoft.com/en-us/graph/outlook-large-attachments
+the attachments are downloaded as raw bytes from /$value, the large ones
+in byte ranges fetched concurrently and read straight into a memory
+mapped file
+"""
+
+import os
+import logging
+import base64
+import mimetypes
+import mmap
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from azure_client import codec, mail
+from azure_client.exceptions import AzureError
+from azure_client.mail import _request, create_draft
+from azure_client.session import get_session
+
+
+# above that size the attachments are sent through an upload session
+INLINE_LIMIT = 3 * 1024 * 1024
+# the chunks of an upload session should be multiples of 320 KiB
+CHUNK_UNIT = 320 * 1024
+DEFAULT_CHUNK_SIZE = 10 * CHUNK_UNIT
+# the attachments larger than that are downloaded in concurrent ranges of that size
+DEFAULT_RANGE_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_WORKERS = 4
+# the fields listed by get_attachments, contentBytes would inline the files in base64
+ATTACHMENT_SELECT = 'id,name,contentType,size,isInline,lastModifiedDateTime'
+FILE_ATTACHMENT = '#microsoft.graph.fileAttachment'
+
+
+@contextmanager
+def _open_file(file):
+    """
+    opens the file if it is a path, uses the file object as is else
+    """
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, 'rb') as file_object:
+            yield file_object
+    else:
+        yield file
+
+
+def _file_size(file_object):
+    position = file_object.tell()
+    size = file_object.seek(0, os.SEEK_END)
+    file_object.seek(position)
+    return size - position
+
+
+def add_attachment(auth, user_id, message_id, file, name=None, content_type=None,  # pylint: disable=too-many-arguments
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    adds a file as attachment to a draft, the file is sent inline if it is
+    smaller than INLINE_LIMIT, in chunks through an upload session else,
+    so that the memory used does not depend on the size of the file
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the draft
+        file (str or file object): the path of the file or a seekable binary file object,
+            read from its current position
+        name (str): the name of the attachment, by default the name of the file
+        content_type (str): the mime type of the attachment, guessed from the name if None
+        chunk_size (int): the size of the chunks of the upload session, a multiple of CHUNK_UNIT
+    """
+    if chunk_size % CHUNK_UNIT != 0:
+        raise ValueError('The chunk size should be a multiple of {}'.format(CHUNK_UNIT))
+    with _open_file(file) as file_object:
+        if name is None:
+            name = os.path.basename(getattr(file_object, 'name', 'attachment'))
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        size = _file_size(file_object)
+        if size < INLINE_LIMIT:
+            _add_inline_attachment(auth, user_id, message_id, file_object, name, content_type)
+        else:
+            _upload_attachment(auth, user_id, message_id, file_object, name, content_type, size,
+                               chunk_size)
+
+    logging.getLogger(__name__).info("Attachment %s added", name)
+
+
+def inline_attachment(file, name=None, content_type=None):
+    """
+    returns the attachment resource of a file with its content in base64,
+    as expected in the attachments_list of create_draft
+
+    Args:
+        file (str or file object): the path of the file or a binary file object,
+            read from its current position
+        name (str): the name of the attachment, by default the name of the file
+        content_type (str): the mime type of the attachment, guessed from the name if None
+    """
+    with _open_file(file) as file_object:
+        if name is None:
+            name = os.path.basename(getattr(file_object, 'name', 'attachment'))
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        return {
+            '@odata.type': FILE_ATTACHMENT,
+            'name': name,
+            'contentType': content_type,
+            'contentBytes': base64.b64encode(file_object.read()).decode('ascii')
+            }
+
+
+def _add_inline_attachment(auth, user_id, message_id, file_object, name, content_type):  # pylint: disable=too-many-arguments
+    data = inline_attachment(file_object, name, content_type)
+    params = codec.dumps(data)
+
+    url = "{api_url}/{user_id}/messages/{message_id}/attachments".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id)
+
+    headers = {'Content-Type': 'application/json'}
+    _request(auth, "POST", url, params, headers)
+
+
+def _upload_attachment(auth, user_id, message_id, file_object, name, content_type, size,  # pylint: disable=too-many-arguments
+                       chunk_size):
+    data = {
+        'AttachmentItem': {
+            'attachmentType': 'file',
+            'name': name,
+            'contentType': content_type,
+            'size': size
+            }
+        }
+    params = codec.dumps(data)
+
+    url = "{api_url}/{user_id}/messages/{message_id}/attachments/createUploadSession".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "POST", url, params, headers)
+    upload_url = codec.loads(resp.read())['uploadUrl']
+
+    # the upload url is pre-authenticated, the chunks are sent without the access token
+    session = get_session(auth.session)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < size:
+        length = file_object.readinto(view[:min(chunk_size, size - offset)])
+        if not length:
+            raise ValueError('The file {} ended before the expected size'.format(name))
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Range': 'bytes {}-{}/{}'.format(offset, offset + length - 1, size)
+            }
+        session.request("PUT", upload_url, view[:length], headers)
+        offset += length
+        logging.getLogger(__name__).debug("Uploaded %d/%d bytes of %s", offset, size, name)
+
+
+def create_draft_with_files(auth, subject, body, addresses, user_id, files, cc_addresses=()):  # pylint: disable=too-many-arguments
+    """
+    creates a draft as create_draft and attaches the files to it with add_attachment,
+    returns the id of the draft
+
+    Args:
+        files (list): the paths or the binary file objects to attach
+    """
+    message_id = create_draft(auth, subject, body, addresses, user_id, cc_addresses)
+    for file in files:
+        add_attachment(auth, user_id, message_id, file)
+    return message_id
+
+
+def _attachments_url(user_id, message_id):
+    return "{api_url}/{user_id}/messages/{message_id}/attachments".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id)
+
+
+def get_attachments(auth, user_id, message_id, select=ATTACHMENT_SELECT):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/message-list-attachments
+    returns the attachments of a message without their content,
+    which is downloaded with download_attachment
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+        select (str): the fields returned separated by a comma, all of them if None
+    """
+    url = _attachments_url(user_id, message_id)
+    if select is not None:
+        url += '?$select={}'.format(select)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "GET", url, headers=headers)
+    return codec.loads(resp.read())['value']
+
+
+def _read_exactly(resp, view):
+    """
+    reads the body of resp into the whole view
+    """
+    offset = 0
+    while offset < len(view):
+        with view[offset:] as part:
+            read = resp.readinto(part)
+        if not read:
+            raise ValueError('The attachment ended {} bytes before the expected size'.format(
+                len(view) - offset))
+        offset += read
+
+
+def _download_range(auth, url, view, start):
+    """
+    downloads the bytes of the attachment from start into view
+    """
+    headers = {'Range': 'bytes={}-{}'.format(start, start + len(view) - 1)}
+    with _request(auth, "GET", url, headers=headers, stream=True) as resp:
+        if resp.status != 206:
+            raise ValueError('The server ignored the range starting at {}'.format(start))
+        _read_exactly(resp, view)
+
+
+def download_attachment(auth, user_id, message_id, attachment_id, path,  # pylint: disable=too-many-arguments
+                        range_size=DEFAULT_RANGE_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    downloads the raw content of a file attachment into the file at path,
+    the first range of range_size bytes gives the size of the content, the
+    file is then preallocated and memory mapped and the other ranges are
+    fetched by max_workers threads, each range being read from its
+    connection straight into its place in the file, the file only
+    appears once complete, returns its size
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+        attachment_id (str): the id of the attachment, as returned by get_attachments
+        path (str): the path of the file written
+        range_size (int): the size of the ranges downloaded concurrently
+        max_workers (int): the maximum number of ranges downloaded at the same time
+    """
+    url = "{}/{}/$value".format(_attachments_url(user_id, message_id), attachment_id)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=directory)
+    try:
+        with os.fdopen(fd, 'r+b') as out_file:
+            headers = {'Range': 'bytes=0-{}'.format(range_size - 1)}
+            try:
+                resp = _request(auth, "GET", url, headers=headers, stream=True)
+            except AzureError as err:
+                if err.code != 416:
+                    raise
+                # an empty content has no satisfiable range, it is downloaded without one
+                resp = _request(auth, "GET", url, stream=True)
+            with resp:
+                size = _content_size(resp)
+                if size is None:
+                    # no size announced, the content is copied as it comes
+                    size = _copy(resp, out_file)
+                elif size > 0:
+                    out_file.truncate(size)
+                    with mmap.mmap(out_file.fileno(), size) as mapped, memoryview(mapped) as view:
+                        with view[:size if resp.status != 206 else min(range_size, size)] as part:
+                            _read_exactly(resp, part)
+                        if resp.status == 206 and size > range_size:
+                            resp.close()
+                            _download_ranges(auth, url, view, range_size, max_workers)
+                        mapped.flush()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    logging.getLogger(__name__).info("Attachment %s downloaded, %d bytes", attachment_id, size)
+    return size
+
+
+def _content_size(resp):
+    """
+    returns the full size of the content from the headers of a response
+    to a range request, None if the server did not give it
+    """
+    if resp.status == 206:
+        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
+def _copy(resp, out_file):
+    buffer = bytearray(DEFAULT_CHUNK_SIZE)
+    view = memoryview(buffer)
+    size = 0
+    while True:
+        read = resp.readinto(buffer)
+        if not read:
+            return size
+        out_file.write(view[:read])
+        size += read
+
+
+def _download_ranges(auth, url, view, range_size, max_workers):
+    """
+    downloads the content of the attachment at url after its first range into view
+    """
+    def download(start):
+        with view[start:start + range_size] as part:
+            _download_range(auth, url, part, start)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(download, range(range_size, len(view), range_size)):
+            pass
+
+
+def _unique_name(name, names):
+    """
+    returns name, or name with a number before its extension if it is
+    already in names, the names being compared regardless of the case
+    """
+    root, extension = os.path.splitext(name)
+    unique_name = name
+    number = 1
+    while unique_name.lower() in names:
+        unique_name = '{} ({}){}'.format(root, number, extension)
+        number += 1
+    names.add(unique_name.lower())
+    return unique_name
+
+
+def download_attachments(auth, user_id, message_id, directory, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    downloads all the file attachments of a message into directory, named
+    after the attachments, a number being added to the names used by several
+    of them, returns the paths of the files written
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+        directory (str): the directory where the files are written, created if needed
+        max_workers (int): the maximum number of ranges downloaded at the same time
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    names = set()
+    for attachment in get_attachments(auth, user_id, message_id):
+        if attachment.get('@odata.type', FILE_ATTACHMENT) != FILE_ATTACHMENT:
+            # the attached messages and references have no file content
+            continue
+        name = _unique_name(os.path.basename(attachment['name']) or attachment['id'], names)
+        path = os.path.join(directory, name)
+        download_attachment(auth, user_id, message_id, attachment['id'], path,
+                            max_workers=max_workers)
+        paths.append(path)
+    return paths
@@ -4,17 +4,25 @@ In that file we have the code which retrieves the data from detrack
 website by doing some scraping
 """
 
+import base64
 import logging
+import threading
+import time
+import uuid
 from contextlib import contextmanager
-import urllib.request
 import urllib.parse
-import urllib.error
 import json
-from selenium.webdriver.support.ui import WebDriverWait
-from azure_client.exceptions import AzureError
+from azure_client import codec
+from azure_client.credentials import write_json_atomic
+from azure_client.instrumentation import emit, TOKEN_REFRESH
+from azure_client.session import get_session
 
 
 LOGIN_URL = "https://login.microsoftonline.com"
+REFRESH_MARGIN = 300
+AUTHORIZATION_CODE = 'authorization_code'
+CLIENT_CREDENTIALS = 'client_credentials'
+APP_SCOPE = 'https://graph.microsoft.com/.default'
 
 @contextmanager
 def web_driver(driver_generator):
@@ -47,10 +55,18 @@ class PageRedirected:  # pylint: disable=too-few-public-methods
 
 class AzureAuth:
     """
-    Class which allows us to retrieve an access token
+    Class which allows us to retrieve an access token,
+    the session is the azure_client.session.HttpSession used by the
+    token calls and the mail functions, the default shared one if None,
+    the store is an azure_client.credentials.CredentialStore through which
+    the tokens are refreshed when several processes share the credentials,
+    expires_at is the timestamp at which the access token expires,
+    None if it is unknown, grant_type is AUTHORIZATION_CODE for the users
+    authenticated with a browser and CLIENT_CREDENTIALS for the applications
+    authenticated with a secret or a certificate
     """
 
-    def __init__(self):
+    def __init__(self, session=None, store=None):
         self.scope = ''
         self.client_id = ''
         self.client_secret = ''
@@ -58,36 +74,61 @@ class AzureAuth:
         self.refresh_token = ''
         self.redirect_uri = ''
         self.tenant = ''
+        self.certificate = ''
+        self.thumbprint = ''
+        self.grant_type = AUTHORIZATION_CODE
+        self.expires_at = None
+        self.session = session
+        self.store = store
+        self._refresh_lock = threading.Lock()
+
+    def dump_data(self):
+        """
+        returns the authentification data as a dict which can be serialized in json
+        """
+        return {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'scope': self.scope,
+            'tenant': self.tenant,
+            'redirect_uri': self.redirect_uri,
+            'certificate': self.certificate,
+            'thumbprint': self.thumbprint,
+            'grant_type': self.grant_type,
+            'expires_at': self.expires_at
+            }
+
+    def load_data(self, data):
+        """
+        sets the authentification data from a dict returned by dump_data
+        """
+        self.access_token = data.get('access_token', '')
+        self.refresh_token = data.get('refresh_token', '')
+        self.client_id = data.get('client_id', '')
+        self.client_secret = data.get('client_secret', '')
+        self.scope = data.get('scope', '')
+        self.tenant = data.get('tenant', '')
+        self.redirect_uri = data.get('redirect_uri', '')
+        self.certificate = data.get('certificate', '')
+        self.thumbprint = data.get('thumbprint', '')
+        self.grant_type = data.get('grant_type', AUTHORIZATION_CODE)
+        self.expires_at = data.get('expires_at')
 
     def save_auth(self, filename):
         """
-        save the authentification data in one json file
+        save the authentification data in one json file,
+        the file is replaced atomically so that it is never left half written
         """
-        with open(filename, 'w') as data_file:
-            data = {
-                'access_token': self.access_token,
-                'refresh_token': self.refresh_token,
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'scope': self.scope,
-                'tenant': self.tenant,
-                'redirect_uri': self.redirect_uri
-                }
-            json.dump(data, data_file)
+        write_json_atomic(filename, self.dump_data())
 
     def get_auth_from_file(self, filename):
         """
         get the authentification from a json file
         """
         with open(filename, 'r') as data_file:
-            data = json.load(data_file)
-            self.access_token = data.get('access_token', '')
-            self.refresh_token = data.get('refresh_token', '')
-            self.client_id = data.get('client_id', '')
-            self.client_secret = data.get('client_secret', '')
-            self.scope = data.get('scope', '')
-            self.tenant = data.get('tenant', '')
-            self.redirect_uri = data.get('redirect_uri', '')
+            self.load_data(json.load(data_file))
 
     def authenticate(self, driver_generator, client_id, client_secret, scope, tenant, redirect_uri):  # pylint: disable=too-many-arguments
         """
@@ -110,6 +151,7 @@ class AzureAuth:
         self.tenant = tenant
         self.redirect_uri = redirect_uri
         self.client_secret = client_secret
+        self.grant_type = AUTHORIZATION_CODE
 
         code = AzureAuth._get_authorization_code(
             driver_generator,
@@ -117,30 +159,142 @@ class AzureAuth:
             self.scope,
             self.tenant,
             self.redirect_uri)
-        self.access_token, self.refresh_token = AzureAuth._get_token(
+        self.access_token, self.refresh_token, expires_in = AzureAuth._get_token(
             self.client_id,
             self.client_secret,
             code, self.tenant,
-            self.redirect_uri)
+            self.redirect_uri,
+            session=self.session)
+        self._set_expiry(expires_in)
+
+    def authenticate_application(self, client_id, tenant, client_secret='', certificate='',  # pylint: disable=too-many-arguments
+                                 thumbprint='', scope=APP_SCOPE):
+        """
+        goes through the oauth client credentials flow, without any browser,
+        the application authenticates itself with its client secret or with
+        a certificate, the tokens are the application ones so the user ids
+        given to the mail functions should be 'users/email@domain.com'
+
+        Args:
+            client_id (str): the id of the application
+            tenant (str): the identifier of the tenant
+            client_secret (str): the secret of the application, if no certificate is given
+            certificate (str): the path of the PEM private key of the certificate registered
+                for the application, it needs the cryptography package
+            thumbprint (str): the SHA-1 thumbprint of the certificate in hexadecimal
+            scope (str): the scope of the token, the default graph permissions of the application
+        """
+        logging.getLogger(__name__).info('Authenticating the application')
+        if not client_secret and not certificate:
+            raise ValueError('A client secret or a certificate is needed')
+        if certificate and not thumbprint:
+            raise ValueError('The thumbprint of the certificate is needed')
+        self.client_id = client_id
+        self.tenant = tenant
+        self.client_secret = client_secret
+        self.certificate = certificate
+        self.thumbprint = thumbprint
+        self.scope = scope
+        self.grant_type = CLIENT_CREDENTIALS
+        self.refresh_token = ''
+        self.refresh_access_token()
+
+    def can_refresh(self):
+        """
+        returns True if a new access token can be retrieved without the user
+        """
+        return self.grant_type == CLIENT_CREDENTIALS or bool(self.refresh_token)
 
     def refresh_access_token(self):
         """
         that function allows to retrieve a new access token using a
-        refresh token
+        refresh token, or the client credentials for an application,
+        if there is a store the token saved there by another process
+        is reused when it is newer and still valid
+        """
+        self._refresh_through_store()
+
+    def _refresh_through_store(self, rejected_token=None):
         """
+        refreshes the token, through the store if there is one so that
+        the token refreshed by another process is reused
+        """
+        start = time.perf_counter()
+        refreshed = True
+        try:
+            if self.store is not None:
+                refreshed = self.store.refresh(self, rejected_token, REFRESH_MARGIN)
+            else:
+                self._refresh_access_token()
+        except Exception as err:
+            emit(get_session(self.session), TOKEN_REFRESH, grant_type=self.grant_type,
+                 duration=time.perf_counter() - start, source='server', error=err)
+            raise
+        emit(get_session(self.session), TOKEN_REFRESH, grant_type=self.grant_type,
+             duration=time.perf_counter() - start, source='server' if refreshed else 'store',
+             error=None)
+
+    def _refresh_access_token(self):
+        if self.grant_type == CLIENT_CREDENTIALS:
+            logging.getLogger(__name__).info('Requesting an application token')
+            self.access_token, expires_in = AzureAuth._get_client_credentials_token(
+                client_credentials_data(self),
+                self.tenant,
+                session=self.session)
+            self._set_expiry(expires_in)
+            return
         logging.getLogger(__name__).info('Refreshing the token')
-        self.access_token, self.refresh_token = AzureAuth._get_access_token_from_refresh_token(
+        tokens = AzureAuth._get_access_token_from_refresh_token(
             self.client_id,
             self.client_secret,
             self.refresh_token,
             self.tenant,
-            self.redirect_uri)
+            self.redirect_uri,
+            session=self.session)
+        self.access_token, self.refresh_token, expires_in = tokens
+        self._set_expiry(expires_in)
+
+    def token_expires_soon(self, margin=REFRESH_MARGIN):
+        """
+        returns True if the access token expires in less than margin seconds,
+        False if it does not or if its expiry is unknown
+        """
+        return self.expires_at is not None and time.time() >= self.expires_at - margin
+
+    def ensure_valid_token(self, margin=REFRESH_MARGIN):
+        """
+        refreshes the access token if it expires in less than margin seconds,
+        the concurrent callers wait for one single refresh,
+        returns True if the token has been refreshed
+        """
+        if not self.token_expires_soon(margin):
+            return False
+        with self._refresh_lock:
+            if not self.token_expires_soon(margin):
+                return False
+            self.refresh_access_token()
+            return True
+
+    def refresh_rejected_token(self, rejected_token):
+        """
+        refreshes the access token after the server rejected rejected_token,
+        nothing is done if another caller already replaced it meanwhile
+        """
+        with self._refresh_lock:
+            if self.access_token == rejected_token:
+                self._refresh_through_store(rejected_token)
+
+    def _set_expiry(self, expires_in):
+        self.expires_at = time.time() + int(expires_in) if expires_in else None
 
     @staticmethod
     def _get_authorization_code(driver_generator, client_id, scope, tenant, redirect_uri):
         """
         gets the authorization code to start the oauth process
         """
+        # selenium is only needed by that flow, it is slow and heavy to import
+        from selenium.webdriver.support.ui import WebDriverWait  # pylint: disable=import-outside-toplevel
+
         authorize_url = "{login_url}/{tenant}/oauth2/v2.0/authorize".format(login_url=LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
 
         code = None
@@ -159,9 +313,10 @@ class AzureAuth:
         return code
 
     @staticmethod
-    def _get_token(client_id, client_secret, code, tenant, redirect_uri):
+    def _get_token(client_id, client_secret, code, tenant, redirect_uri, session=None):  # pylint: disable=too-many-arguments
         """
-        gets access token from authentification code
+        gets access token from authentification code,
+        returns the access token, the refresh token and the lifetime of the access token
         """
         token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
         data = {
@@ -172,13 +327,14 @@ class AzureAuth:
             "grant_type": "authorization_code"
             }
         params = urllib.parse.urlencode(data).encode("utf8")
-        req = urllib.request.Request(token_url, data=params)
-        resp = urllib.request.urlopen(req)
-        resp_data = json.load(resp)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        resp = get_session(session).request("POST", token_url, params, headers)
+        resp_data = codec.loads(resp.read())
         access_token = resp_data['access_token']
         refresh_token = resp_data.get('refresh_token', '')
+        expires_in = resp_data.get('expires_in')
 
-        return access_token, refresh_token
+        return access_token, refresh_token, expires_in
 
     @staticmethod
     def _get_access_token_from_refresh_token(\
@@ -186,9 +342,11 @@ class AzureAuth:
             client_secret,
             refresh_token,
             tenant,
-            redirect_uri):
+            redirect_uri,
+            session=None):
         """
-        refresh an access token using a refresh token
+        refresh an access token using a refresh token,
+        returns the access token, the refresh token and the lifetime of the access token
         """
         token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
         data = {
@@ -199,13 +357,84 @@ class AzureAuth:
             "grant_type": "refresh_token"
             }
         params = urllib.parse.urlencode(data).encode("utf8")
-        req = urllib.request.Request(token_url, data=params)
-        try:
-            resp = urllib.request.urlopen(req)
-        except urllib.error.HTTPError as err:
-            raise AzureError(err)
-        resp_data = json.load(resp)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        resp = get_session(session).request("POST", token_url, params, headers)
+        resp_data = codec.loads(resp.read())
         access_token = resp_data['access_token']
-        refresh_token = resp_data['refresh_token']
+        refresh_token = resp_data.get('refresh_token', refresh_token)
+        expires_in = resp_data.get('expires_in')
+
+        return access_token, refresh_token, expires_in
+
+    @staticmethod
+    def _get_client_credentials_token(data, tenant, session=None):
+        """
+        gets an application access token with the client credentials,
+        returns the access token and its lifetime
+        """
+        token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=LOGIN_URL, tenant=tenant)  # pylint: disable=line-too-long
+        params = urllib.parse.urlencode(data).encode("utf8")
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        resp = get_session(session).request("POST", token_url, params, headers)
+        resp_data = codec.loads(resp.read())
+
+        return resp_data['access_token'], resp_data.get('expires_in')
+
+
+def client_credentials_data(auth):
+    """
+    builds the body of the client credentials token request of auth,
+    with a signed assertion if it authenticates with a certificate
+    """
+    data = {
+        "client_id": auth.client_id,
+        "scope": auth.scope,
+        "grant_type": CLIENT_CREDENTIALS
+        }
+    if auth.certificate:
+        data["client_assertion_type"] = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer"
+        data["client_assertion"] = _client_assertion(
+            auth.client_id, auth.tenant, auth.certificate, auth.thumbprint)
+    else:
+        data["client_secret"] = auth.client_secret
+    return data
+
+
+def _base64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _client_assertion(client_id, tenant, certificate, thumbprint, lifetime=600):  # pylint: disable=too-many-arguments
+    """
+    builds the JWT signed with the private key of the certificate which
+    authenticates the application, see
+    https://docs.microsoft.com/en-us/azure/active-directory/develop/active-directory-certificate-credentials
+    """
+    try:
+        from cryptography.hazmat.primitives import hashes, serialization  # pylint: disable=import-outside-toplevel
+        from cryptography.hazmat.primitives.asymmetric import padding  # pylint: disable=import-outside-toplevel
+    except ImportError as err:
+        raise ImportError(
+            'The cryptography package is needed to authenticate with a certificate') from err
+
+    token_url = "{login_url}/{tenant}/oauth2/v2.0/token".format(login_url=LOGIN_URL, tenant=tenant)
+    now = int(time.time())
+    x5t = _base64url(bytes.fromhex(thumbprint.replace(':', '')))
+    header = {'alg': 'RS256', 'typ': 'JWT', 'x5t': x5t}
+    payload = {
+        'aud': token_url,
+        'iss': client_id,
+        'sub': client_id,
+        'jti': str(uuid.uuid4()),
+        'nbf': now,
+        'exp': now + lifetime
+        }
+    signing_input = '{}.{}'.format(
+        _base64url(json.dumps(header).encode('utf8')),
+        _base64url(json.dumps(payload).encode('utf8')))
+
+    with open(certificate, 'rb') as key_file:
+        private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+    signature = private_key.sign(signing_input.encode('ascii'), padding.PKCS1v15(), hashes.SHA256())
 
-        return access_token, refresh_token
+    return '{}.{}'.format(signing_input, _base64url(signature))
@@ -0,0 +1,344 @@
+"""
+Module which handles the graph JSON batching, the operations are packed
+by groups of 20 in $batch requests which are sent concurrently
+see https://docs.microsoft.com/en-us/graph/json-batching
+"""
+
+import http.client
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from azure_client import codec, mail
+from azure_client.exceptions import AzureError
+from azure_client.instrumentation import emit, PARSE, THROTTLED
+from azure_client.mail import _request, _draft_data, _send_mail_data
+from azure_client.session import HttpResponse, get_session
+from azure_client.throttling import RETRY_AFTER_STATUSES, parse_retry_after
+
+
+BATCH_SIZE = 20
+DEFAULT_MAX_WORKERS = 4
+# the graph API rejects the $batch requests larger than 4 MiB
+MAX_BATCH_BYTES = 4 * 1024 * 1024 - 64 * 1024
+
+
+class BatchResult:  # pylint: disable=too-few-public-methods
+
+    """
+    the result of one operation of a batch, error is the exception of
+    the operation if it failed, an AzureError or the transport error
+    of its $batch request whose status is then None, None else, and
+    value is what the equivalent single call would have returned
+    """
+
+    def __init__(self, status, body=None, value=None, error=None, headers=None):  # pylint: disable=too-many-arguments
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        """
+        True if the operation succeeded
+        """
+        return self.error is None
+
+    def __repr__(self):
+        return 'BatchResult(status={}, value={!r}, error={!r})'.format(
+            self.status, self.value, self.error)
+
+
+def _sub_request(method, url, body=None):
+    """
+    builds one request of a batch, the url is relative to the api url,
+    body is a dict or bytes of json already serialized, the dicts are
+    serialized here so that their size counts in the size of the batch
+    """
+    request = {'method': method, 'url': url}
+    if body is not None:
+        request['body'] = body if isinstance(body, (bytes, bytearray)) else codec.dumps(body)
+        request['headers'] = {'Content-Type': 'application/json'}
+    return request
+
+
+def _sub_result(response):
+    """
+    converts one response of a batch to a BatchResult
+    """
+    status = response['status']
+    body = response.get('body')
+    headers = response.get('headers', {})
+    if status >= 400:
+        raw_body = codec.dumps(body) if body is not None else b''
+        error = AzureError(HttpResponse(status, '', headers, raw_body))
+        return BatchResult(status, body, error=error, headers=headers)
+    return BatchResult(status, body, headers=headers)
+
+
+def _post_batch(auth, requests):
+    """
+    sends at most BATCH_SIZE requests in one $batch request, returns
+    their results in the same order and the number of times the session
+    retried the $batch request, None if it failed as a whole, the error
+    of the $batch request being then the error of all its results
+    """
+    params = _encode_batch(requests)
+    url = "{api_url}/$batch".format(api_url=mail.API_URL)
+    headers = {'Content-Type': 'application/json'}
+    try:
+        resp = _request(auth, "POST", url, params, headers)
+        start = time.perf_counter()
+        raw_data = resp.read()
+        resp_data = codec.loads(raw_data)
+    except AzureError as err:
+        return [BatchResult(err.code, error=err) for _ in requests], None
+    except (OSError, http.client.HTTPException, ValueError) as err:
+        logging.getLogger(__name__).warning("Batch of %d requests failed: %r", len(requests), err)
+        return [BatchResult(None, error=err) for _ in requests], None
+    emit(get_session(auth.session), PARSE, kind='batch', duration=time.perf_counter() - start,
+         size=len(raw_data))
+
+    results = [None] * len(requests)
+    for response in resp_data['responses']:
+        results[int(response['id'])] = _sub_result(response)
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = BatchResult(
+                None, error=ValueError('No response to the request {} of the batch'.format(i)))
+    logging.getLogger(__name__).info("Batch of %d requests sent", len(requests))
+    return results, resp.retries
+
+
+def _encode_member(key, value):
+    """
+    serializes one member of a request of a batch, a body already
+    serialized as bytes is copied as it is
+    """
+    if key == 'body' and isinstance(value, (bytes, bytearray)):
+        return codec.dumps(key) + b':' + value
+    return codec.dumps(key) + b':' + codec.dumps(value)
+
+
+def _encode_batch(requests):
+    """
+    serializes the requests of a batch, the objects of the requests are
+    built member by member so that the bodies already serialized can be
+    spliced in whatever the output of the codec
+    """
+    parts = []
+    for i, request in enumerate(requests):
+        members = [_encode_member(key, value) for (key, value) in dict(request, id=str(i)).items()]
+        parts.append(b'{' + b','.join(members) + b'}')
+    return b''.join((b'{"requests":[', b','.join(parts), b']}'))
+
+
+def _chunks(requests, max_bytes):
+    """
+    splits the requests in batches of at most BATCH_SIZE requests and of
+    about max_bytes of bodies at most, the bodies given as dicts are
+    serialized to be counted and sent as they are
+    """
+    chunk = []
+    size = 0
+    for request in requests:
+        body = request.get('body')
+        if body is not None and not isinstance(body, (bytes, bytearray)):
+            body = codec.dumps(body)
+            request = dict(request, body=body)
+        request_size = len(body) if body is not None else 0
+        if chunk and (len(chunk) == BATCH_SIZE or size + request_size > max_bytes):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(request)
+        size += request_size
+    if chunk:
+        yield chunk
+
+
+def _send_batch(auth, requests):
+    """
+    sends the requests in one $batch request, the requests throttled
+    individually are sent again according to the retry policy of the
+    session, the retries of the $batch requests by the session counting
+    in the retries of their requests so that they share one budget
+    """
+    results, retries = _post_batch(auth, requests)
+    retry_policy = get_session(auth.session).retry_policy
+    # the retries spent on each request, None once its batch failed as a whole
+    attempts = [retries] * len(requests)
+    while True:
+        throttled = [
+            i for (i, result) in enumerate(results)
+            if attempts[i] is not None and result.status in RETRY_AFTER_STATUSES
+            and retry_policy.should_retry(requests[i]['method'], result.status, attempts[i])]
+        if not throttled:
+            return results
+        attempt = max(attempts[i] for i in throttled)
+        retry_after = max(
+            (parse_retry_after(_header(results[i].headers, 'Retry-After')) or 0 for i in throttled),
+            default=0)
+        delay = retry_policy.delay(attempt, retry_after or None)
+        logging.getLogger(__name__).warning(
+            '%d requests of the batch throttled, retrying in %.1fs', len(throttled), delay)
+        emit(get_session(auth.session), THROTTLED, url=requests[throttled[0]]['url'],
+             status=results[throttled[0]].status, retry_after=retry_after or None,
+             count=len(throttled))
+        time.sleep(delay)
+        retried_results, retries = _post_batch(auth, [requests[i] for i in throttled])
+        for i, result in zip(throttled, retried_results):
+            results[i] = result
+            attempts[i] = attempts[i] + 1 + retries if retries is not None else None
+
+
+def _header(headers, name):
+    """
+    returns the value of a header of a batch response, the names are case insensitive
+    """
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def execute_batch(auth, requests, max_workers=DEFAULT_MAX_WORKERS, max_batch_bytes=MAX_BATCH_BYTES):
+    """
+    sends the requests in $batch requests of BATCH_SIZE operations,
+    max_workers batches being in flight at the same time,
+    returns one BatchResult per request in the same order
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        requests (list): dicts with the keys 'method', 'url' relative to the api url
+            ex: '/me/messages/{id}', and optionally 'body', a dict or bytes of json, and 'headers'
+        max_workers (int): the maximum number of batches sent concurrently
+        max_batch_bytes (int): the batches are split so that their bodies do not
+            exceed that size
+    """
+    chunks = list(_chunks(requests, max_batch_bytes))
+    if len(chunks) <= 1 or max_workers <= 1:
+        chunks_results = [_send_batch(auth, chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            chunks_results = list(executor.map(lambda chunk: _send_batch(auth, chunk), chunks))
+    return [result for chunk_results in chunks_results for result in chunk_results]
+
+
+def delete_emails(auth, user_id, message_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    deletes several messages with batch requests, see delete_email
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_ids (iterable): the ids of the messages to delete
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    requests = [
+        _sub_request("DELETE", "/{user_id}/messages/{message_id}".format(
+            user_id=user_id, message_id=message_id))
+        for message_id in message_ids]
+    return execute_batch(auth, requests, max_workers)
+
+
+def permanent_delete_emails(auth, user_id, message_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    deletes several messages permanently with batch requests, instead
+    of moving them to the DeletedItems folder as delete_emails does
+    see https://docs.microsoft.com/en-us/graph/api/message-permanentdelete
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_ids (iterable): the ids of the messages to delete
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    requests = [
+        _sub_request("POST", "/{user_id}/messages/{message_id}/permanentDelete".format(
+            user_id=user_id, message_id=message_id))
+        for message_id in message_ids]
+    return execute_batch(auth, requests, max_workers)
+
+
+def move_emails(auth, user_id, message_ids, destination_id, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    moves several messages to another folder with batch requests,
+    the value of each result is the new id of the message moved
+    see https://docs.microsoft.com/en-us/graph/api/message-move
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_ids (iterable): the ids of the messages to move
+        destination_id (str): the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    body = codec.dumps({'destinationId': destination_id})
+    requests = [
+        _sub_request("POST", "/{user_id}/messages/{message_id}/move".format(
+            user_id=user_id, message_id=message_id), body)
+        for message_id in message_ids]
+    results = execute_batch(auth, requests, max_workers)
+    for result in results:
+        if result.ok:
+            result.value = result.body['id']
+    return results
+
+
+def send_emails(auth, user_id, message_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    sends several drafts with batch requests, see send_email
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_ids (iterable): the ids of the drafts to send
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    requests = [
+        _sub_request("POST", "/{user_id}/messages/{message_id}/send".format(
+            user_id=user_id, message_id=message_id))
+        for message_id in message_ids]
+    return execute_batch(auth, requests, max_workers)
+
+
+def send_mails(auth, user_id, messages, save_to_sent_items=True, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    sends several new messages with batch requests, see send_mail,
+    one request per message instead of creating drafts and sending them
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        messages (iterable): dicts with the keys 'subject', 'body', 'addresses' and
+            optionally 'cc_addresses' and 'attachments_list' as in create_draft
+        save_to_sent_items (bool): keeps a copy of the messages in the SentItems folder
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    url = "/{user_id}/sendMail".format(user_id=user_id)
+    requests = [
+        _sub_request("POST", url, _send_mail_data(_draft_data(**message), save_to_sent_items))
+        for message in messages]
+    return execute_batch(auth, requests, max_workers)
+
+
+def create_drafts(auth, user_id, drafts, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    creates several drafts with batch requests, see create_draft,
+    the value of each result is the id of the draft created
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        drafts (iterable): dicts with the keys 'subject', 'body', 'addresses' and
+            optionally 'cc_addresses' and 'attachments_list' as in create_draft
+        max_workers (int): the maximum number of batches sent concurrently
+    """
+    url = "/{user_id}/messages".format(user_id=user_id)
+    requests = [_sub_request("POST", url, _draft_data(**draft)) for draft in drafts]
+    results = execute_batch(auth, requests, max_workers)
+    for result in results:
+        if result.ok:
+            result.value = result.body['id']
+    return results
@@ -0,0 +1,236 @@
+"""
+Module which caches the pages of messages returned by get_emails, in a
+bounded in-memory LRU and optionally in a sqlite database, the expired
+entries are revalidated by comparing the changeKey of the messages
+which is much cheaper than downloading them again
+
+the entries are kept serialized with the codec of the package, so that
+each call returns its own copy of the messages which the caller can
+modify without changing the cache
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from azure_client import codec
+from azure_client.mail import MessageList, get_emails, _query_string, _messages_value
+
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_TTL = 60
+
+
+class CacheStats:  # pylint: disable=too-few-public-methods
+
+    """
+    the counters of a MessageCache, hits are the calls answered without
+    any request, revalidations the expired entries confirmed unchanged by
+    one small request, misses the calls which downloaded the messages
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_ratio(self):
+        """
+        the part of the calls which did not download the messages
+        """
+        total = self.hits + self.revalidations + self.misses
+        return (self.hits + self.revalidations) / total if total else 0.0
+
+    def as_dict(self):
+        """
+        returns the counters as a dict
+        """
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hit_ratio
+            }
+
+    def __repr__(self):
+        return 'CacheStats({})'.format(self.as_dict())
+
+
+class _Entry:  # pylint: disable=too-few-public-methods
+
+    """
+    a cached page, data is the page serialized as a response of the
+    graph API so that its @odata.count is kept with the messages
+    """
+
+    __slots__ = ('data', 'validator', 'expires_at')
+
+    def __init__(self, data, validator, expires_at):
+        self.data = data
+        self.validator = validator
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_messages(cls, messages, validator, expires_at):
+        """
+        builds the entry of the messages returned by get_emails
+        """
+        page = {'value': messages}
+        if isinstance(messages, MessageList):
+            page['@odata.count'] = messages.total_count
+        return cls(codec.dumps(page), validator, expires_at)
+
+    def messages(self):
+        """
+        returns a new copy of the messages, a MessageList if the count was asked
+        """
+        page = codec.loads(self.data)
+        # the databases written before the counts were kept hold the bare lists
+        return page if isinstance(page, list) else _messages_value(page)
+
+
+class MessageCache:
+
+    """
+    Class which caches the results of get_emails by user, folder and query,
+    it can be shared between threads
+
+    Args:
+        max_entries (int): the maximum number of entries kept in memory
+        ttl (float): the number of seconds during which an entry is used without
+            any request, it is revalidated after that
+        path (str): the path of a sqlite database where the entries are also
+            stored, so that they survive the process, None to keep them in memory only
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, messages TEXT, validator TEXT, expires_at REAL)')
+            self._db.commit()
+
+    def get_emails(self, auth, user_id, folder_id='AllItems', ttl=None, **kwargs):
+        """
+        cached version of azure_client.mail.get_emails, see it for the arguments
+
+        Args:
+            ttl (float): the lifetime of the entry if it is created or revalidated,
+                the ttl of the cache if None
+        """
+        # the keys are built with json so that they do not depend on the codec
+        key = json.dumps([user_id, folder_id, _query_string(kwargs), kwargs.get('body_type')])
+        ttl = self.ttl if ttl is None else ttl
+        entry = self._get(key)
+
+        if entry is not None and entry.expires_at > time.time():
+            with self._lock:
+                self.stats.hits += 1
+            return entry.messages()
+
+        if entry is not None and entry.validator == self._validator(
+                auth, user_id, folder_id, kwargs):
+            with self._lock:
+                entry.expires_at = time.time() + ttl
+                if self._db is not None:
+                    self._db.execute(
+                        'UPDATE entries SET expires_at = ? WHERE key = ?', (entry.expires_at, key))
+                    self._db.commit()
+                self.stats.revalidations += 1
+            logging.getLogger(__name__).debug("Cache entry revalidated")
+            return entry.messages()
+
+        with self._lock:
+            self.stats.misses += 1
+        select = kwargs.get('select')
+        args_dict = dict(kwargs)
+        if select and 'changekey' not in select.lower():
+            args_dict['select'] = select + ',changeKey'
+        messages = get_emails(auth, user_id, folder_id, **args_dict)
+        validator = [[message['id'], message.get('changeKey')] for message in messages]
+        if select and 'changekey' not in select.lower():
+            for message in messages:
+                message.pop('changeKey', None)
+        self._put(key, _Entry.from_messages(messages, validator, time.time() + ttl))
+        return messages
+
+    def invalidate(self, user_id=None, folder_id=None):
+        """
+        removes the entries of the user and folder, all of them if both are None
+        """
+        def matches(key):
+            entry_user_id, entry_folder_id = json.loads(key)[:2]
+            return ((user_id is None or entry_user_id == user_id)
+                    and (folder_id is None or entry_folder_id == folder_id))
+
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                del self._entries[key]
+            if self._db is not None:
+                keys = [row[0] for row in self._db.execute('SELECT key FROM entries')]
+                self._db.executemany(
+                    'DELETE FROM entries WHERE key = ?', [(key,) for key in keys if matches(key)])
+                self._db.commit()
+
+    def close(self):
+        """
+        closes the sqlite database if there is one
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def _validator(auth, user_id, folder_id, kwargs):
+        """
+        gets the ids and change keys of the messages matching the query,
+        they change as soon as a message is added, removed or modified
+        """
+        args_dict = {key: item for (key, item) in kwargs.items()
+                     if key not in ('expand', 'count', 'body_type')}
+        args_dict['select'] = 'id,changeKey'
+        messages = get_emails(auth, user_id, folder_id, **args_dict)
+        return [[message['id'], message.get('changeKey')] for message in messages]
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                'SELECT messages, validator, expires_at FROM entries WHERE key = ?',
+                (key,)).fetchone()
+        if row is None:
+            return None
+        entry = _Entry(row[0], codec.loads(row[1]), row[2])
+        self._put(key, entry, persist=False)
+        return entry
+
+    def _put(self, key, entry, persist=True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+            if persist and self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                    (key, entry.data, codec.dumps(entry.validator), entry.expires_at))
+                self._db.commit()
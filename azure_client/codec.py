@@ -0,0 +1,97 @@
+"""
+Module which holds the json codec of the request and response bodies,
+orjson is used when it is installed, the json module of the standard
+library else, another codec can be set with set_codec, ex:
+    set_codec('json')
+    set_codec(JsonCodec('ujson', ujson.loads, lambda obj: ujson.dumps(obj).encode('utf8')))
+"""
+
+import json
+import logging
+
+
+class JsonCodec:  # pylint: disable=too-few-public-methods
+
+    """
+    a pair of functions serializing the bodies
+
+    Args:
+        name (str): the name of the codec
+        decode (callable): decodes bytes of json to python objects, kept as loads
+        encode (callable): encodes python objects to bytes of compact json in utf8,
+            kept as dumps
+    """
+
+    def __init__(self, name, decode, encode):
+        self.name = name
+        self.loads = decode
+        self.dumps = encode
+
+    def __repr__(self):
+        return 'JsonCodec({!r})'.format(self.name)
+
+
+def _json_codec():
+    return JsonCodec(
+        'json', json.loads, lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf8'))
+
+
+def _orjson_codec():
+    import orjson  # pylint: disable=import-outside-toplevel,import-error
+    return JsonCodec('orjson', orjson.loads, orjson.dumps)
+
+
+_CODECS = {
+    'json': _json_codec,
+    'orjson': _orjson_codec,
+    }
+
+
+def _default_codec():
+    try:
+        return _orjson_codec()
+    except ImportError:
+        return _json_codec()
+
+
+_CODEC = _default_codec()
+
+
+def get_codec():
+    """
+    returns the JsonCodec used
+    """
+    return _CODEC
+
+
+def set_codec(codec):
+    """
+    changes the codec used by all the requests, codec is a JsonCodec or the name
+    of a known one, 'json' or 'orjson', or 'auto' for orjson if it is installed
+    """
+    global _CODEC  # pylint: disable=global-statement
+    if codec == 'auto':
+        codec = _default_codec()
+    elif isinstance(codec, str):
+        if codec not in _CODECS:
+            raise ValueError('Unexpected codec {}'.format(codec))
+        try:
+            codec = _CODECS[codec]()
+        except ImportError as err:
+            raise ImportError('The {} package is needed by that codec'.format(codec)) from err
+    _CODEC = codec
+    logging.getLogger(__name__).debug('Json codec %s', codec.name)
+
+
+def loads(data):
+    """
+    decodes bytes of json with the current codec
+    """
+    return _CODEC.loads(data)
+
+
+def dumps(obj):
+    """
+    encodes obj as bytes of json with the current codec
+    """
+    return _CODEC.dumps(obj)
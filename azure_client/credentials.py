@@ -0,0 +1,169 @@
+"""
+Module which stores the credentials in a json file shared by several
+processes, the file is replaced atomically and a lock file serializes
+the refreshes so that only one process refreshes an expiring token
+while the other ones reuse the token it saved
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+DEFAULT_LOCK_TIMEOUT = 60
+# the delay between two attempts to take a lock held by another process
+_LOCK_POLL_INTERVAL = 0.05
+
+
+def write_json_atomic(path, data):
+    """
+    writes data as json in path through a temporary file renamed over it,
+    so that the readers see either the previous content or the new one,
+    the file is only readable by its owner
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as data_file:
+            json.dump(data, data_file)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+if fcntl is not None:
+    def _try_lock(lock_file):
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(lock_file):
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+else:
+    import msvcrt  # pylint: disable=import-error
+
+    # msvcrt locks a byte range, the first byte of the lock file
+    def _try_lock(lock_file):
+        lock_file.seek(0)
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(lock_file):
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path, timeout=DEFAULT_LOCK_TIMEOUT):
+    """
+    context manager which holds an exclusive lock on the file at path,
+    created if needed, raises a TimeoutError if another process holds it
+    for more than timeout seconds, None to wait forever
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with open(path, 'a+b') as lock_file:
+        while not _try_lock(lock_file):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError('Could not lock {} within {}s'.format(path, timeout))
+            time.sleep(_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
+
+
+class CredentialStore:
+
+    """
+    Class which keeps the credentials of an AzureAuth in a json file, it
+    can be shared by the threads and the processes using the same file,
+    given to AzureAuth(store=...) the refreshes of the token go through
+    it: the first process finding the token expired refreshes it and
+    saves it, the other ones wait for it and reuse the token saved
+    instead of refreshing it again, so that a rotated refresh token is
+    never overwritten by an older one
+
+    Args:
+        path (str): the path of the json file, the lock file is path + '.lock'
+        lock_timeout (float): the maximum number of seconds waited for the lock,
+            None to wait forever
+    """
+
+    def __init__(self, path, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self):
+        """
+        context manager which holds the lock of the store for the threads
+        and the processes, it is not reentrant
+        """
+        with self._lock:
+            with file_lock(self.lock_path, self.lock_timeout):
+                yield
+
+    def read(self):
+        """
+        returns the data of the file, None if it does not exist
+        """
+        try:
+            with open(self.path, 'r', encoding='utf8') as data_file:
+                return json.load(data_file)
+        except FileNotFoundError:
+            return None
+
+    def load(self, auth):
+        """
+        loads the credentials of the file in auth, returns False if there are none
+        """
+        data = self.read()
+        if data is None:
+            return False
+        auth.load_data(data)
+        return True
+
+    def save(self, auth):
+        """
+        replaces the credentials of the file by the ones of auth
+        """
+        write_json_atomic(self.path, auth.dump_data())
+
+    def refresh(self, auth, rejected_token=None, margin=0):
+        """
+        gives auth a valid access token, the one saved by another process
+        if it differs from the token of auth, or rejected_token if it is
+        given, and does not expire in less than margin seconds, a new one
+        refreshed and saved else, returns True if the token was refreshed
+        """
+        with self.lock():
+            data = self.read()
+            current_token = rejected_token if rejected_token is not None else auth.access_token
+            token = data.get('access_token') if data is not None else None
+            if token and token != current_token:
+                expires_at = data.get('expires_at')
+                if expires_at is None or time.time() < expires_at - margin:
+                    auth.load_data(data)
+                    return False
+            auth._refresh_access_token()  # pylint: disable=protected-access
+            self.save(auth)
+            return True
@@ -0,0 +1,403 @@
+"""
+Module which exports whole folders to files, the messages are written
+as compressed json lines, or their raw MIME content fetched from /$value
+is written in a mbox file or in one eml file per message, the MIME
+contents of a page being downloaded concurrently
+
+the messages are streamed, the json lines are written one at a time and
+the MIME contents are escaped and written chunk by chunk as they are
+read from their connections, the next MIME contents being requested
+while the current one is written
+
+the export writes one page at a time and records in a checkpoint file
+the cursor of the next page with the size of the output, so that an
+interrupted export started again with the same checkpoint resumes after
+the last page written instead of starting over
+"""
+
+import bz2
+import datetime
+import functools
+import gzip
+import json
+import logging
+import lzma
+import os
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import islice
+from urllib.parse import urlencode
+from azure_client import codec, mail
+from azure_client.credentials import write_json_atomic
+from azure_client.mail import MAX_PAGE_SIZE, _request
+from azure_client.streaming import iter_emails_page
+
+
+FORMATS = ('jsonl', 'mbox', 'eml')
+COMPRESSIONS = {
+    'gzip': lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6),
+    'bz2': lambda fileobj: bz2.BZ2File(fileobj, mode='wb'),
+    'xz': lambda fileobj: lzma.LZMAFile(fileobj, mode='wb'),
+    }
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_PAGES_SIZE = 100
+# the fields listed when only the MIME contents are exported
+MIME_SELECT = 'id,receivedDateTime'
+
+_CHUNK_SIZE = 256 * 1024
+# the lines of a mbox message starting with 'From ', quoted or not, are quoted once more (mboxrd)
+_FROM_RE = re.compile(br'^(>*From )', re.MULTILINE)
+
+
+def _mime_url(user_id, message_id):
+    return "{api_url}/{user_id}/messages/{message_id}/$value".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        message_id=message_id
+        )
+
+
+def get_email_mime(auth, user_id, message_id):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/message-get#example-4-get-mime-content
+    returns the raw MIME content of a message as bytes
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+    """
+    with _request(auth, "GET", _mime_url(user_id, message_id), stream=True) as resp:
+        return resp.read()
+
+
+def save_email_mime(auth, user_id, message_id, path):
+    """
+    writes the raw MIME content of a message in the file at path, the
+    content is copied from the response to the file chunk by chunk and
+    the file only appears once complete, returns its size
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+        path (str): the path of the eml file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=directory)
+    size = 0
+    try:
+        buffer = bytearray(_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with os.fdopen(fd, 'wb') as eml_file:
+            with _request(auth, "GET", _mime_url(user_id, message_id), stream=True) as resp:
+                while True:
+                    read = resp.readinto(buffer)
+                    if not read:
+                        break
+                    eml_file.write(view[:read])
+                    size += read
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return size
+
+
+def _mbox_header(message):
+    """
+    returns the 'From ' line starting the entry of one message in a mbox file
+    """
+    try:
+        received = datetime.datetime.strptime(message['receivedDateTime'][:19], '%Y-%m-%dT%H:%M:%S')
+    except (KeyError, TypeError, ValueError):
+        received = datetime.datetime(1970, 1, 1)
+    return b'From MAILER-DAEMON ' + received.strftime('%a %b %d %H:%M:%S %Y\n').encode('ascii')
+
+
+class _MboxEscaper:
+
+    """
+    escapes the MIME content of one message for a mbox file chunk by chunk,
+    the line endings are converted to '\n' and the lines starting with
+    'From ', quoted or not, are quoted once more, only the end of a chunk
+    which could be the start of such a line is held until the next one
+    """
+
+    def __init__(self):
+        self._held = b''
+        self._line_start = True
+        self._last = b''
+
+    def feed(self, chunk):
+        """
+        returns the escaped bytes of chunk which can already be written
+        """
+        data = self._held + chunk if self._held else chunk
+        carriage_return = data.endswith(b'\r')
+        if carriage_return:
+            # it may be the start of a '\r\n' split between two chunks
+            data = data[:-1]
+        if b'\r\n' in data:
+            data = data.replace(b'\r\n', b'\n')
+        head = b''
+        if not self._line_start:
+            newline = data.find(b'\n') + 1
+            if not newline:
+                self._held = b'\r' if carriage_return else b''
+                return self._emit(data)
+            head, data = data[:newline], data[newline:]
+        last_line = data[data.rfind(b'\n') + 1:]
+        if b'From '.startswith(last_line.lstrip(b'>')):
+            data = data[:len(data) - len(last_line)]
+        else:
+            last_line = b''
+        self._held = last_line + (b'\r' if carriage_return else b'')
+        if b'From ' in data:
+            data = _FROM_RE.sub(br'>\1', data)
+        escaped = self._emit(head + data if head else data)
+        self._line_start = bool(last_line) or not escaped or escaped.endswith(b'\n')
+        return escaped
+
+    def _emit(self, data):
+        if data:
+            self._last = data[-1:]
+        return data
+
+    def close(self):
+        """
+        returns the end of the entry, the bytes held with the line ending
+        the content if it is missing and the blank line closing the entry
+        """
+        held, self._held = self._held, b''
+        if self._line_start and held.lstrip(b'>').startswith(b'From '):
+            held = b'>' + held
+        end = self._emit(held)
+        if self._last != b'\n':
+            end += b'\n'
+        return end + b'\n'
+
+
+def _eml_name(message_id):
+    # the ids of the graph API are base64 which can contain '/'
+    return message_id.replace('/', '_').replace('+', '-') + '.eml'
+
+
+def _save_eml(auth, user_id, directory, message):
+    save_email_mime(auth, user_id, message['id'], os.path.join(directory, _eml_name(message['id'])))
+
+
+class _Checkpoint:
+
+    """
+    the progress of an export saved in a json file
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.reset()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as checkpoint_file:
+                data = json.load(checkpoint_file)
+            if data.get('key') != key:
+                raise ValueError('The checkpoint {} belongs to another export'.format(path))
+            self.next_link = data['next_link']
+            self.offset = data['offset']
+            self.exported = data['exported']
+            self.complete = data['complete']
+            self.started = True
+
+    def reset(self):
+        """
+        starts the export over from the first page
+        """
+        self.next_link = None
+        self.offset = 0
+        self.exported = 0
+        self.complete = False
+        self.started = False
+
+    def save(self):
+        """
+        writes the progress in the checkpoint file, if there is one
+        """
+        if self.path is not None:
+            write_json_atomic(self.path, {
+                'key': self.key,
+                'next_link': self.next_link,
+                'offset': self.offset,
+                'exported': self.exported,
+                'complete': self.complete,
+                })
+
+
+def export_folder(auth, user_id, path, folder_id='AllItems', export_format='jsonl',  # pylint: disable=too-many-arguments,too-many-locals
+                  compression='gzip', checkpoint=None, pages_size=DEFAULT_PAGES_SIZE,
+                  max_workers=DEFAULT_MAX_WORKERS, **kwargs):
+    """
+    exports all the messages of a folder and returns the number of messages
+    exported, those of the previous runs included when resuming from a checkpoint
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        path (str): the output file, a directory for the 'eml' format
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+            by default 'AllItems'
+        export_format (str): 'jsonl' for one message dict per line, 'mbox' for the MIME
+            contents in a mboxrd file, 'eml' for one MIME file per message in the directory path
+        compression (str): 'gzip', 'bz2', 'xz' or None, the compression of the jsonl and mbox
+            files, each page is compressed in its own stream, which the decompressors read
+            as one file, so that the output can be truncated to the last page checkpointed
+        checkpoint (str): the path of the json file where the progress is saved, the export
+            resumes from it if it exists, it cannot be resumed if None
+        pages_size (int): the number of messages per page, at most MAX_PAGE_SIZE
+        max_workers (int): the number of MIME contents downloaded concurrently
+        kwargs: the query arguments of get_emails, all the fields are exported in jsonl if
+            select is not given, only MIME_SELECT is listed for the other formats
+    """
+    if export_format not in FORMATS:
+        raise ValueError('Unexpected format {}'.format(export_format))
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError('Unexpected compression {}'.format(compression))
+    if pages_size > MAX_PAGE_SIZE:
+        raise ValueError('The pages size should be at most {}'.format(MAX_PAGE_SIZE))
+    if export_format != 'jsonl':
+        kwargs['select'] = MIME_SELECT
+    kwargs['top'] = pages_size
+
+    query = urlencode(sorted((name, str(value)) for name, value in kwargs.items()))
+    key = '{}/{}/{}/{}?{}'.format(user_id, folder_id, export_format, compression, query)
+    progress = _Checkpoint(checkpoint, key)
+    if progress.complete:
+        logging.getLogger(__name__).info("Export of %s already complete", path)
+        return progress.exported
+    if progress.started and export_format != 'eml' and (
+            not os.path.exists(path) or os.path.getsize(path) < progress.offset):
+        logging.getLogger(__name__).warning(
+            "The output %s is missing or truncated, the export starts over", path)
+        progress.reset()
+    if export_format == 'eml':
+        os.makedirs(path, exist_ok=True)
+        out_file = None
+    else:
+        out_file = open(path, 'r+b' if progress.started and os.path.exists(path) else 'wb')
+        # the data written after the last checkpoint is dropped and written again
+        out_file.truncate(progress.offset)
+        out_file.seek(progress.offset)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            others = {}
+            page = iter_emails_page(auth, user_id, folder_id, progress.next_link, others=others,
+                                    **kwargs)
+            if export_format == 'jsonl':
+                with _page_output(out_file, compression) as output:
+                    exported = _write_jsonl(output, page)
+            elif export_format == 'mbox':
+                page = list(page)
+                opened = _opened_mimes(executor, auth, user_id, page, max_workers)
+                with _page_output(out_file, compression) as output, closing(opened):
+                    for message, resp in opened:
+                        _write_mbox_entry(output, message, resp)
+                exported = len(page)
+            else:
+                page = list(page)
+                list(executor.map(functools.partial(_save_eml, auth, user_id, path), page))
+                exported = len(page)
+
+            progress.exported += exported
+            progress.next_link = others.get('@odata.nextLink')
+            progress.complete = progress.next_link is None
+            if out_file is not None:
+                out_file.flush()
+                os.fsync(out_file.fileno())
+                progress.offset = out_file.tell()
+            progress.save()
+            logging.getLogger(__name__).info("%d messages exported to %s", progress.exported, path)
+            if progress.complete:
+                return progress.exported
+    finally:
+        executor.shutdown(wait=False)
+        if out_file is not None:
+            out_file.close()
+
+
+@contextmanager
+def _page_output(out_file, compression):
+    """
+    yields the file where one page is written, a new compressed stream
+    appended to out_file if compression is not None
+    """
+    if compression is None:
+        yield out_file
+    else:
+        with COMPRESSIONS[compression](out_file) as compressed_file:
+            yield compressed_file
+
+
+def _write_jsonl(output, messages):
+    """
+    writes the messages as json lines one at a time, returns their number
+    """
+    count = 0
+    for message in messages:
+        output.write(codec.dumps(message))
+        output.write(b'\n')
+        count += 1
+    return count
+
+
+def _open_mime(auth, user_id, message_id):
+    return _request(auth, "GET", _mime_url(user_id, message_id), stream=True)
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _opened_mimes(executor, auth, user_id, messages, window):
+    """
+    generator which yields the messages with the streamed responses of
+    their MIME contents in order, the requests of the next window messages
+    are sent ahead so that their contents are on their way while the
+    current one is read
+    """
+    messages = iter(messages)
+    pending = deque()
+    try:
+        while True:
+            for message in islice(messages, window - len(pending)):
+                pending.append((message, executor.submit(_open_mime, auth, user_id, message['id'])))
+            if not pending:
+                return
+            message, future = pending.popleft()
+            with future.result() as resp:
+                yield message, resp
+    finally:
+        for _, future in pending:
+            if not future.cancel():
+                future.add_done_callback(_close_response)
+
+
+def _write_mbox_entry(output, message, resp):
+    """
+    writes the entry of one message in a mbox file, its MIME content being
+    escaped and written chunk by chunk as it is read from resp
+    """
+    output.write(_mbox_header(message))
+    escaper = _MboxEscaper()
+    while True:
+        chunk = resp.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        output.write(escaper.feed(chunk))
+    output.write(escaper.close())
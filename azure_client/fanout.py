@@ -0,0 +1,143 @@
+"""
+Module which runs one operation on many mailboxes concurrently, sharing
+one AzureAuth and its session, and yields the results of the mailboxes
+as they finish
+"""
+
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from azure_client.batch import send_emails, delete_emails
+from azure_client.mail import get_all_emails_it
+from azure_client.session import get_session, DEFAULT_POOL_SIZE
+from azure_client.sync import sync_emails
+from azure_client.throttling import RateLimiter
+
+
+# one connection of the default pool per worker
+DEFAULT_MAX_WORKERS = DEFAULT_POOL_SIZE
+# the graph API accepts 4 concurrent requests per mailbox
+DEFAULT_PER_MAILBOX = 4
+
+
+class FanOutResult:  # pylint: disable=too-few-public-methods
+
+    """
+    the result of the operation on one mailbox, error is the exception
+    raised if it failed, None else, and value is what the operation returned
+    """
+
+    def __init__(self, user_id, value=None, error=None):
+        self.user_id = user_id
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        """
+        True if the operation succeeded
+        """
+        return self.error is None
+
+    def __repr__(self):
+        return 'FanOutResult(user_id={!r}, error={!r})'.format(self.user_id, self.error)
+
+
+def _list_emails(auth, user_id, folder_id='AllItems', per_mailbox=None, **kwargs):  # pylint: disable=unused-argument
+    pages = get_all_emails_it(auth, user_id, folder_id, **kwargs)
+    return [email for page in pages for email in page]
+
+
+def _sync_emails(auth, user_id, per_mailbox=None, **kwargs):  # pylint: disable=unused-argument
+    return sync_emails(auth, user_id, **kwargs)
+
+
+def _send_emails(auth, user_id, message_ids, per_mailbox=DEFAULT_PER_MAILBOX):
+    return send_emails(auth, user_id, message_ids, max_workers=per_mailbox)
+
+
+def _delete_emails(auth, user_id, message_ids, per_mailbox=DEFAULT_PER_MAILBOX):
+    return delete_emails(auth, user_id, message_ids, max_workers=per_mailbox)
+
+
+OPERATIONS = {
+    'list': _list_emails,
+    'sync': _sync_emails,
+    'send': _send_emails,
+    'delete': _delete_emails,
+    }
+
+
+def fan_out(auth, targets, operation, max_workers=DEFAULT_MAX_WORKERS,
+            per_mailbox=DEFAULT_PER_MAILBOX):
+    """
+    generator which runs the operation on every mailbox of targets,
+    at most max_workers at the same time and at most per_mailbox at the same
+    time on one mailbox, and yields one FanOutResult per target as they finish
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials,
+            shared by all the operations, as its session
+        targets (iterable): the user ids, ex: 'users/email@domain.com', or pairs of one
+            user id and a dict of keyword arguments of the operation for that mailbox
+        operation (str or callable): 'list' (get_all_emails_it), 'sync' (sync_emails),
+            'send' (send_emails) or 'delete' (delete_emails) which take message_ids,
+            or a function called as operation(auth, user_id, **kwargs)
+        max_workers (int): the maximum number of operations running at the same time
+        per_mailbox (int): the maximum number of operations running at the same time
+            on one mailbox, also the number of concurrent batches of 'send' and 'delete'
+    """
+    if isinstance(operation, str):
+        if operation not in OPERATIONS:
+            raise ValueError('Unexpected operation {}'.format(operation))
+        operation = functools.partial(OPERATIONS[operation], per_mailbox=per_mailbox)
+
+    session = get_session(auth.session)
+    if getattr(session, 'pool_size', max_workers) < max_workers:
+        logging.getLogger(__name__).warning(
+            'The pool size %d is smaller than the %d workers, connections will be reopened',
+            session.pool_size, max_workers)
+
+    mailbox_semaphores = {}
+    lock = threading.Lock()
+
+    def run(user_id, kwargs):
+        # the targets are grouped by mailbox as the rate limiter does,
+        # ex: 'users/Email@domain.com' and '/users/email%40domain.com'
+        mailbox = RateLimiter.key('/' + user_id.strip('/')) or user_id.lower()
+        with lock:
+            semaphore = mailbox_semaphores.setdefault(mailbox, threading.Semaphore(per_mailbox))
+        with semaphore:
+            try:
+                return FanOutResult(user_id, operation(auth, user_id, **kwargs))
+            except Exception as err:  # pylint: disable=broad-except
+                logging.getLogger(__name__).info("Operation failed on %s: %s", user_id, err)
+                return FanOutResult(user_id, error=err)
+
+    targets = iter(targets)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = set()
+    exhausted = False
+    try:
+        while True:
+            # only a window of the targets is submitted so that huge
+            # lists of mailboxes are consumed lazily
+            while not exhausted and len(pending) < 2 * max_workers:
+                target = next(targets, None)
+                if target is None:
+                    exhausted = True
+                    break
+                user_id, kwargs = (target, {}) if isinstance(target, str) else target
+                pending.add(executor.submit(run, user_id, kwargs))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # when the generator is closed early the operations not started are
+        # cancelled and the running ones finish in the background
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
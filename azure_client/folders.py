@@ -0,0 +1,351 @@
+"""
+Module which handles the mail folders, the folders carry the number of
+their messages and of the unread ones, so that the size of a folder is
+known with one small request instead of listing its messages
+see https://docs.microsoft.com/en-us/graph/api/resources/mailfolder
+
+the folders are created, moved and deleted with one request whatever
+their size, the graph API has no operation emptying a folder so its
+messages are deleted or moved with batch requests, the first page of the
+folder being listed again after each round so that the removals do not
+shift the pages as a $skip cursor would
+"""
+
+import logging
+from urllib.parse import urlencode
+from azure_client import codec, mail
+from azure_client.batch import (DEFAULT_MAX_WORKERS, delete_emails, permanent_delete_emails,
+                                move_emails)
+from azure_client.mail import (MAX_PAGE_SIZE, _request, _messages_headers, _get_messages_data,
+                               _messages_url, get_emails_page)
+
+
+# the fields of the folders listed by default
+FOLDER_SELECT = 'id,displayName,parentFolderId,childFolderCount,totalItemCount,unreadItemCount'
+# the graph API returns at most that many folders per page
+MAX_FOLDERS_PAGE_SIZE = 999
+
+
+def _folders_url(user_id, parent_folder_id, select, include_hidden):
+    if parent_folder_id is None:
+        path = "{api_url}/{user_id}/mailFolders".format(api_url=mail.API_URL, user_id=user_id)
+    else:
+        path = "{api_url}/{user_id}/mailFolders/{folder_id}/childFolders".format(
+            api_url=mail.API_URL,
+            user_id=user_id,
+            folder_id=parent_folder_id)
+    params = {'$top': MAX_FOLDERS_PAGE_SIZE}
+    if select is not None:
+        params['$select'] = select
+    if include_hidden:
+        params['includeHiddenFolders'] = 'true'
+    return '{}?{}'.format(path, urlencode(params))
+
+
+def get_folders(auth, user_id, parent_folder_id=None, recursive=False, include_hidden=False,  # pylint: disable=too-many-arguments
+                select=FOLDER_SELECT):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/user-list-mailfolders
+    returns the folders with their 'totalItemCount' and 'unreadItemCount'
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        parent_folder_id (str): lists the child folders of that folder, the top level ones if None
+        recursive (bool): also lists the child folders of the folders, after them
+        include_hidden (bool): also lists the hidden folders
+        select (str): the fields returned separated by a comma, all of them if None,
+            childFolderCount is needed by recursive
+    """
+    folders = []
+    url = _folders_url(user_id, parent_folder_id, select, include_hidden)
+    while url is not None:
+        resp = _request(auth, "GET", url, headers={'Content-Type': 'application/json'})
+        resp_data = codec.loads(resp.read())
+        folders.extend(resp_data['value'])
+        url = resp_data.get('@odata.nextLink')
+
+    if recursive:
+        for folder in list(folders):
+            if folder.get('childFolderCount', 1):
+                folders.extend(
+                    get_folders(auth, user_id, folder['id'], True, include_hidden, select))
+
+    logging.getLogger(__name__).info("%d folders recieved", len(folders))
+    return folders
+
+
+def get_folder(auth, user_id, folder_id, select=FOLDER_SELECT):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/mailfolder-get
+    returns one folder with its 'totalItemCount' and 'unreadItemCount'
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+        select (str): the fields returned separated by a comma, all of them if None
+    """
+    url = _folder_url(user_id, folder_id)
+    if select is not None:
+        url += '?' + urlencode({'$select': select})
+
+    resp = _request(auth, "GET", url, headers={'Content-Type': 'application/json'})
+    return codec.loads(resp.read())
+
+
+def count_emails(auth, user_id, folder_id='AllItems', **kwargs):
+    """
+    returns the number of messages of a folder matching the query, the
+    totalItemCount of the folder if there is no filter nor search, else
+    the @odata.count of a listing of one message
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+            by default 'AllItems'
+        filter (str): only counts the messages matching the filter, see get_emails
+        search (str): only counts the messages matching the search, see get_emails
+    """
+    unexpected = set(kwargs) - {'filter', 'search'}
+    if unexpected:
+        raise TypeError('Unexpected arguments {}'.format(', '.join(sorted(unexpected))))
+    if not kwargs and folder_id != 'AllItems':
+        return get_folder(auth, user_id, folder_id, select='totalItemCount')['totalItemCount']
+
+    kwargs = dict(kwargs, count=True, top=1, select='id')
+    resp_data = _get_messages_data(
+        auth, _messages_url(user_id, folder_id, kwargs), _messages_headers(kwargs))
+    return resp_data['@odata.count']
+
+
+def get_mailbox_stats(auth, user_id, include_hidden=False):
+    """
+    returns the numbers of messages and unread messages of all the folders
+    of the mailbox as a dict with the keys 'folders', 'totalItemCount' and
+    'unreadItemCount', the folders being listed recursively
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        include_hidden (bool): also counts the hidden folders
+    """
+    folders = get_folders(auth, user_id, recursive=True, include_hidden=include_hidden)
+    return {
+        'folders': len(folders),
+        'totalItemCount': sum(folder.get('totalItemCount', 0) for folder in folders),
+        'unreadItemCount': sum(folder.get('unreadItemCount', 0) for folder in folders),
+        }
+
+
+def _folder_url(user_id, folder_id):
+    return "{api_url}/{user_id}/mailFolders/{folder_id}".format(
+        api_url=mail.API_URL, user_id=user_id, folder_id=folder_id)
+
+
+def create_folder(auth, user_id, display_name, parent_folder_id=None, hidden=False):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/user-post-mailfolders
+    creates a folder and returns it
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        display_name (str): the name of the folder
+        parent_folder_id (str): creates the folder in that one, at the top level if None
+        hidden (bool): hides the folder
+    """
+    if parent_folder_id is None:
+        url = "{api_url}/{user_id}/mailFolders".format(api_url=mail.API_URL, user_id=user_id)
+    else:
+        url = _folder_url(user_id, parent_folder_id) + '/childFolders'
+    data = {'displayName': display_name}
+    if hidden:
+        data['isHidden'] = True
+    params = codec.dumps(data)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "POST", url, params, headers)
+    resp_data = codec.loads(resp.read())
+
+    logging.getLogger(__name__).info("Folder %s created", display_name)
+    return resp_data
+
+
+def move_folder(auth, user_id, folder_id, destination_id):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/mailfolder-move
+    moves a folder with all its messages and child folders in one request,
+    returns the folder moved
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): the id of the folder moved
+        destination_id (str): the id of the new parent folder
+            or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+    """
+    params = codec.dumps({'destinationId': destination_id})
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "POST", _folder_url(user_id, folder_id) + '/move', params, headers)
+    resp_data = codec.loads(resp.read())
+
+    logging.getLogger(__name__).info("Folder %s moved", folder_id)
+    return resp_data
+
+
+def delete_folder(auth, user_id, folder_id, permanent=False):
+    """
+    implementation of those endpoints:
+    https://docs.microsoft.com/en-us/graph/api/mailfolder-delete
+    https://docs.microsoft.com/en-us/graph/api/mailfolder-permanentdelete
+    deletes a folder with all its messages and child folders in one request,
+    the well-known folders such as 'Inbox' cannot be deleted, see empty_folder
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): the id of the folder
+        permanent (bool): deletes it permanently instead of moving it to the DeletedItems folder
+    """
+    if permanent:
+        _request(auth, "POST", _folder_url(user_id, folder_id) + '/permanentDelete')
+    else:
+        _request(auth, "DELETE", _folder_url(user_id, folder_id))
+
+    logging.getLogger(__name__).info("Folder %s deleted", folder_id)
+
+
+def _round_limit(auth, user_id, folder_id, pages_size, filter_):
+    """
+    returns the number of rounds needed to go once through the messages
+    of the folder, with one more round for the messages arriving meanwhile
+    """
+    total = count_emails(auth, user_id, folder_id, **({'filter': filter_} if filter_ else {}))
+    return -(-total // pages_size) + 1
+
+
+def _next_ids(auth, user_id, folder_id, pages_size, filter_, skipped):
+    """
+    returns the ids of the first messages of the folder which are not in
+    skipped, the pages holding only skipped ids are passed with their
+    @odata.nextLink so that the messages which cannot be removed do not
+    hide the other ones
+    """
+    page, next_link = get_emails_page(
+        auth, user_id, folder_id, top=pages_size, select='id', filter=filter_)
+    while True:
+        message_ids = [message['id'] for message in page if message['id'] not in skipped]
+        if message_ids or next_link is None:
+            return message_ids
+        page, next_link = get_emails_page(auth, user_id, folder_id, next_link)
+
+
+def _drain(auth, user_id, folder_id, operation, pages_size, filter_):  # pylint: disable=too-many-arguments
+    """
+    applies operation to the ids of the first page of the folder until
+    the folder is empty, operation removing the messages from the folder,
+    returns the number of messages removed, the messages which could not
+    be removed are skipped and logged, the rounds are capped by the number
+    of messages in the folder at the start
+    """
+    if pages_size > MAX_PAGE_SIZE:
+        raise ValueError('The pages size should be at most {}'.format(MAX_PAGE_SIZE))
+    max_rounds = _round_limit(auth, user_id, folder_id, pages_size, filter_)
+    removed = 0
+    failed = 0
+    # the ids already handled, removed or not, each id is sent once
+    skipped = set()
+    for _ in range(max_rounds):
+        message_ids = _next_ids(auth, user_id, folder_id, pages_size, filter_, skipped)
+        if not message_ids:
+            break
+        skipped.update(message_ids)
+        for message_id, result in zip(message_ids, operation(message_ids)):
+            if result.ok:
+                removed += 1
+            elif result.status != 404:
+                # a 404 is a message already removed in the meantime
+                failed += 1
+                logging.getLogger(__name__).warning(
+                    "Message %s not removed: %s", message_id, result.error)
+        logging.getLogger(__name__).info("%d messages removed from %s", removed, folder_id)
+    else:
+        logging.getLogger(__name__).warning("%s not emptied after %d rounds", folder_id, max_rounds)
+    if failed:
+        logging.getLogger(__name__).warning(
+            "%d messages could not be removed from %s", failed, folder_id)
+    return removed
+
+
+def _same_folder(auth, user_id, folder_id, other_id):
+    """
+    returns whether the two ids or well-known names are the same folder
+    """
+    if folder_id.lower() == other_id.lower():
+        return True
+    ids = [get_folder(auth, user_id, folder, select='id')['id'] for folder in (folder_id, other_id)]
+    return ids[0] == ids[1]
+
+
+def empty_folder(auth, user_id, folder_id, permanent=False, include_subfolders=False,  # pylint: disable=too-many-arguments
+                 filter=None, max_workers=DEFAULT_MAX_WORKERS, pages_size=MAX_PAGE_SIZE):  # pylint: disable=redefined-builtin
+    """
+    deletes all the messages of a folder, pages_size messages at a time
+    with max_workers concurrent batch requests, returns the number of
+    messages deleted, 'AllItems' can only be emptied permanently since
+    the messages deleted are moved to DeletedItems
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+        permanent (bool): deletes them permanently instead of moving them to the DeletedItems folder
+        include_subfolders (bool): also deletes the child folders, with one request per folder
+        filter (str): only deletes the messages matching the filter, see get_emails
+        max_workers (int): the maximum number of batches sent concurrently
+        pages_size (int): the number of messages listed at once, at most MAX_PAGE_SIZE
+    """
+    if folder_id.lower() == 'allitems' and not permanent:
+        # the messages deleted would come back in DeletedItems with new ids
+        raise ValueError('AllItems can only be emptied with permanent=True')
+    delete = permanent_delete_emails if permanent else delete_emails
+    removed = _drain(auth, user_id, folder_id,
+                     lambda message_ids: delete(auth, user_id, message_ids, max_workers),
+                     pages_size, filter)
+    if include_subfolders:
+        for folder in get_folders(auth, user_id, folder_id, select='id'):
+            delete_folder(auth, user_id, folder['id'], permanent)
+    return removed
+
+
+def move_folder_emails(auth, user_id, folder_id, destination_id, filter=None,  # pylint: disable=too-many-arguments,redefined-builtin
+                       max_workers=DEFAULT_MAX_WORKERS, pages_size=MAX_PAGE_SIZE):
+    """
+    moves all the messages of a folder to another one, pages_size messages
+    at a time with max_workers concurrent batch requests, returns the
+    number of messages moved, raises a ValueError if the destination is
+    the folder itself or if the folder is 'AllItems'
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+        destination_id (str): the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+        filter (str): only moves the messages matching the filter, see get_emails
+        max_workers (int): the maximum number of batches sent concurrently
+        pages_size (int): the number of messages listed at once, at most MAX_PAGE_SIZE
+    """
+    if folder_id.lower() == 'allitems' or _same_folder(auth, user_id, folder_id, destination_id):
+        # the messages moved would be listed again with new ids
+        raise ValueError('The destination {} is in the folder {}'.format(destination_id, folder_id))
+    return _drain(auth, user_id, folder_id,
+                  lambda message_ids: move_emails(
+                      auth, user_id, message_ids, destination_id, max_workers),
+                  pages_size, filter)
@@ -0,0 +1,324 @@
+"""
+Module which reports what happens on the http sessions, the listeners
+added to the instrumentation of a session receive one Event per request,
+retry, throttling, token refresh and parsing of a response, and
+MetricsAggregator turns them into counters and histograms which can be
+exported in the Prometheus text format
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+
+REQUEST = 'request'
+RETRY = 'retry'
+THROTTLED = 'throttled'
+TOKEN_REFRESH = 'token_refresh'
+PARSE = 'parse'
+
+# the phases of a request, queue is the time waited for the rate limiter,
+# dns, connect and tls are only there when a new connection was opened,
+# server is the time from the end of the request to the response headers
+# and read the time spent reading the body
+PHASES = ('queue', 'dns', 'connect', 'tls', 'send', 'server', 'read')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Event:  # pylint: disable=too-few-public-methods
+
+    """
+    one thing which happened on a session, name is one of REQUEST, RETRY,
+    THROTTLED, TOKEN_REFRESH or PARSE and the other attributes depend on it:
+        REQUEST: method, url, status (None if no response was received), attempt,
+            duration, phases (a dict of PHASES in seconds), request_size,
+            response_size (None for streamed responses), reused, error
+        RETRY: method, url, status (None after a network error), attempt, delay, retry_after
+        THROTTLED: url, status, retry_after, count (the number of requests throttled,
+            more than 1 for the requests of a batch)
+        TOKEN_REFRESH: grant_type, duration, error, source ('server' if a new token was
+            requested, 'store' if the token refreshed by another process was reused)
+        PARSE: kind, duration, size
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.time = time.time()
+        self.__dict__.update(fields)
+
+    def as_dict(self):
+        """
+        returns the attributes of the event as a dict
+        """
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return 'Event({})'.format(', '.join(
+            '{}={!r}'.format(key, value) for (key, value) in self.__dict__.items()))
+
+
+class Instrumentation:
+
+    """
+    Class which dispatches the events of a session to its listeners,
+    the listeners are callables taking one Event, they are called in the
+    thread of the request so they should be quick, their exceptions are
+    logged and ignored
+
+    Args:
+        listeners (iterable): the initial listeners
+    """
+
+    def __init__(self, listeners=()):
+        self._listeners = tuple(listeners)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        True if there is at least one listener
+        """
+        return bool(self._listeners)
+
+    def add_listener(self, listener):
+        """
+        adds a callable which receives all the events
+        """
+        with self._lock:
+            self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """
+        removes a listener added before
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+            listeners.remove(listener)
+            self._listeners = tuple(listeners)
+
+    def emit(self, name, **fields):
+        """
+        sends an event to the listeners, nothing is built if there is none
+        """
+        listeners = self._listeners
+        if not listeners:
+            return
+        event = Event(name, **fields)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception(
+                    'The instrumentation listener %r failed', listener)
+
+
+def emit(session, name, **fields):
+    """
+    sends an event to the instrumentation of the session if it has one
+    """
+    instrumentation = getattr(session, 'instrumentation', None)
+    if instrumentation is not None:
+        instrumentation.emit(name, **fields)
+
+
+class Histogram:
+
+    """
+    Class which counts the values observed in cumulative buckets as Prometheus does
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        adds one value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        returns the pairs of the upper bound of each bucket, the last one being
+        infinite, and the number of values lower or equal to it
+        """
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, quantile):
+        """
+        estimates a quantile, ex: 0.99, by interpolating in its bucket,
+        None if no value was observed
+        """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        lower = 0.0
+        previous = 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == float('inf'):
+                    return lower
+                count = total - previous
+                return lower + (bound - lower) * ((rank - previous) / count if count else 0)
+            lower, previous = bound, total
+        return lower
+
+
+class MetricsAggregator:
+
+    """
+    Class which aggregates the events of one or several sessions into
+    counters and histograms, it is a listener, ex:
+        metrics = MetricsAggregator()
+        get_default_session().instrumentation.add_listener(metrics)
+        ...
+        print(metrics.prometheus_text())
+
+    Args:
+        prefix (str): the prefix of the names of the metrics
+        duration_buckets (tuple): the buckets of the durations in seconds
+        size_buckets (tuple): the buckets of the sizes in bytes
+    """
+
+    def __init__(self, prefix='azure_client', duration_buckets=DURATION_BUCKETS,
+                 size_buckets=SIZE_BUCKETS):
+        self.prefix = prefix
+        self.duration_buckets = duration_buckets
+        self.size_buckets = size_buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            if event.name == REQUEST:
+                self._request(event)
+            elif event.name == RETRY:
+                self._increment('retries_total', status=event.status)
+            elif event.name == THROTTLED:
+                self._increment('throttled_total', event.count, status=event.status)
+            elif event.name == TOKEN_REFRESH:
+                outcome = 'error' if event.error is not None else 'ok'
+                self._increment('token_refreshes_total', grant_type=event.grant_type,
+                                source=event.source, outcome=outcome)
+                self._observe('token_refresh_duration_seconds', event.duration,
+                              self.duration_buckets)
+            elif event.name == PARSE:
+                self._observe('parse_duration_seconds', event.duration, self.duration_buckets,
+                              kind=event.kind)
+                self._observe('parse_size_bytes', event.size, self.size_buckets, kind=event.kind)
+
+    def _request(self, event):
+        status = event.status if event.status is not None else type(event.error).__name__
+        self._increment('requests_total', method=event.method, status=status)
+        self._observe('request_duration_seconds', event.duration, self.duration_buckets,
+                      method=event.method)
+        for phase, duration in event.phases.items():
+            self._observe('request_phase_duration_seconds', duration, self.duration_buckets,
+                          phase=phase)
+        if event.request_size:
+            self._increment('request_bytes_total', event.request_size)
+        if event.response_size is not None:
+            self._increment('response_bytes_total', event.response_size)
+            self._observe('response_size_bytes', event.response_size, self.size_buckets)
+
+    def _increment(self, name, value=1, **labels):
+        key = tuple(sorted((label, str(item)) for (label, item) in labels.items()))
+        series = self._counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    def _observe(self, name, value, buckets, **labels):
+        key = tuple(sorted((label, str(item)) for (label, item) in labels.items()))
+        series = self._histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """
+        returns the value of a counter, ex: counter('requests_total', method='GET', status=200)
+        """
+        key = tuple(sorted((label, str(item)) for (label, item) in labels.items()))
+        with self._lock:
+            return self._counters.get(name, {}).get(key, 0)
+
+    def histogram(self, name, **labels):
+        """
+        returns a Histogram, ex: histogram('request_phase_duration_seconds', phase='server'),
+        None if nothing was observed
+        """
+        key = tuple(sorted((label, str(item)) for (label, item) in labels.items()))
+        with self._lock:
+            return self._histograms.get(name, {}).get(key)
+
+    def snapshot(self):
+        """
+        returns all the metrics as a dict which can be serialized in json
+        or converted to another format such as OpenTelemetry
+        """
+        with self._lock:
+            counters = {
+                name: [{'labels': dict(key), 'value': value} for (key, value) in series.items()]
+                for (name, series) in self._counters.items()}
+            histograms = {
+                name: [{
+                    'labels': dict(key),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': [['+Inf' if bound == float('inf') else bound, total]
+                                for (bound, total) in histogram.cumulative()]
+                    } for (key, histogram) in series.items()]
+                for (name, series) in self._histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus_text(self):
+        """
+        returns all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for name, series in sorted(snapshot['counters'].items()):
+            full_name = '{}_{}'.format(self.prefix, name)
+            lines.append('# TYPE {} counter'.format(full_name))
+            for item in series:
+                lines.append('{}{} {}'.format(full_name, _labels(item['labels']), item['value']))
+        for name, series in sorted(snapshot['histograms'].items()):
+            full_name = '{}_{}'.format(self.prefix, name)
+            lines.append('# TYPE {} histogram'.format(full_name))
+            for item in series:
+                for bound, total in item['buckets']:
+                    labels = dict(item['labels'], le=str(bound))
+                    lines.append('{}_bucket{} {}'.format(full_name, _labels(labels), total))
+                lines.append('{}_sum{} {}'.format(full_name, _labels(item['labels']), item['sum']))
+                lines.append('{}_count{} {}'.format(
+                    full_name, _labels(item['labels']), item['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """
+        removes all the metrics
+        """
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in sorted(labels.items())))
@@ -3,22 +3,201 @@ Module which handles the outlook email REST API
 """
 
 import logging
-import json
-import urllib.request
-import urllib.error
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
+from azure_client import codec
 from azure_client.exceptions import AzureError
+from azure_client.instrumentation import emit, PARSE
+from azure_client.session import get_session
 
 
 API_URL = "https://graph.microsoft.com/beta"
+MAX_PAGE_SIZE = 1000
+# the fields selected by default by the helpers going through whole folders
+DEFAULT_SELECT = 'id,subject,sender,receivedDateTime,changeKey'
+# the values given to the boolean query arguments set to True
+_TRUE_VALUES = {'expand': 'attachments'}
+# the keyword arguments sent as Prefer headers rather than in the query string
+_PREFER_ARGS = ('body_type',)
 
 
+def _request(auth, method, url, data=None, headers=None, stream=False):  # pylint: disable=too-many-arguments
+    """
+    sends one request to the graph API with the credentials of auth
+    through its session, raises an AzureError if the request fails,
+    the access token is refreshed before it expires and the request
+    is retried once if the server rejects the token, if stream is True
+    an azure_client.session.StreamedResponse is returned
+    """
+    auth.ensure_valid_token()
+    headers = dict(headers or {})
+    access_token = auth.access_token
+    headers['Authorization'] = 'Bearer {}'.format(access_token)
+    try:
+        return get_session(auth.session).request(method, url, data, headers, stream)
+    except AzureError as err:
+        if err.code != 401 or not auth.can_refresh():
+            raise
+    logging.getLogger(__name__).info("Access token rejected, refreshing it")
+    auth.refresh_rejected_token(access_token)
+    headers['Authorization'] = 'Bearer {}'.format(auth.access_token)
+    return get_session(auth.session).request(method, url, data, headers, stream)
+
+def _query_string(kwargs):
+    """
+    builds the odata query string from the keyword arguments of get_emails,
+    the arguments which are None or False are left out
+    """
+    params = {}
+    for key, item in kwargs.items():
+        if key in _PREFER_ARGS or item is None or item is False:
+            continue
+        if item is True:
+            item = _TRUE_VALUES.get(key, 'true')
+        params["$" + key] = item
+    return urlencode(params)
+
+def _messages_headers(kwargs):
+    """
+    builds the headers of the requests listing messages, body_type
+    asks the server for the bodies in 'text' or 'html'
+    """
+    headers = {'Content-Type': 'application/json'}
+    if kwargs.get('body_type'):
+        headers['Prefer'] = 'outlook.body-content-type="{}"'.format(kwargs['body_type'])
+    return headers
+
+def _messages_url(user_id, folder_id, kwargs):
+    """
+    builds the url listing the messages of a folder
+    """
+    return "{api_url}/{user_id}/MailFolders/{folder_id}/messages?{params}".format(
+        api_url=API_URL,
+        user_id=user_id,
+        folder_id=folder_id,
+        params=_query_string(kwargs))
+
+def _get_messages_raw(auth, url, headers=None):
+    """
+    gets one page of messages and returns the body of the response as it is
+    """
+    headers = headers or {'Content-Type': 'application/json'}
+    resp = _request(auth, "GET", url, headers=headers)
+    raw_data = resp.read()
+
+    logging.getLogger(__name__).info("Messages recieved")
+
+    return raw_data
+
+def _decode_messages(session, raw_data):
+    """
+    decodes a page of messages and reports the parse time to the instrumentation
+    """
+    start = time.perf_counter()
+    resp_data = codec.loads(raw_data)
+    emit(session, PARSE, kind='messages', duration=time.perf_counter() - start, size=len(raw_data))
+    return resp_data
+
+def _get_messages_data(auth, url, headers=None):
+    """
+    gets one page of messages and returns the decoded response
+    """
+    return _decode_messages(get_session(auth.session), _get_messages_raw(auth, url, headers))
+
+class RawPage:
+
+    """
+    a page of messages returned by get_emails(lazy=True), raw is the body
+    of the response as received, to forward or store it without decoding
+    it, the messages are only decoded the first time they are accessed,
+    the page can then be used as the list of messages
+    """
+
+    def __init__(self, raw, session=None):
+        self.raw = raw
+        self._session = session
+        self._data = None
+
+    def decode(self):
+        """
+        returns the decoded response, decoding it on the first call
+        """
+        if self._data is None:
+            self._data = _decode_messages(self._session, self.raw)
+        return self._data
+
+    @property
+    def messages(self):
+        """
+        the list of the messages, a MessageList if the count was asked
+        """
+        return _messages_value(self.decode())
+
+    @property
+    def next_link(self):
+        """
+        the url of the next page, None if it is the last one
+        """
+        return self.decode().get('@odata.nextLink')
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __repr__(self):
+        return 'RawPage({} bytes, decoded={})'.format(len(self.raw), self._data is not None)
+
+class MessageList(list):
+
+    """
+    the messages of a listing made with count=True, total_count is the
+    number of messages matching the query given by @odata.count, all the
+    pages included
+    """
+
+    def __init__(self, messages, total_count):
+        super().__init__(messages)
+        self.total_count = total_count
+
+def _messages_value(resp_data):
+    """
+    returns the messages of a decoded page, with their total count if it was asked
+    """
+    if '@odata.count' in resp_data:
+        return MessageList(resp_data['value'], resp_data['@odata.count'])
+    return resp_data['value']
+
+def _draft_data(subject, body, addresses, cc_addresses=(), attachments_list=None):
+    """
+    builds the message resource sent to create a draft
+    """
+    data = {}
+    data['Subject'] = subject
+    data['Body'] = {}
+    data['Body']['ContentType'] = 'HTML'
+    data['Body']['Content'] = body
+    data['ToRecipients'] = [{'EmailAddress': {'Address': addr}} for addr in addresses]
+    data['ccRecipients'] = [{'EmailAddress': {'Address': addr}} for addr in cc_addresses]
+    if attachments_list is not None:
+        data['Attachments'] = attachments_list
+    return data
+
 def create_draft(auth, subject, body, addresses, user_id, cc_addresses=[], attachments_list=None):
     """
     this functions creates a draft with the email data given
     the user id should be either 'me', either 'users/email@domain.com'
-    either 'users/{AAD_userId@AAD_tenandId}',
-    see https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/use-outlook-rest-api#target-user
+    either 'users/{AAD_userId@AAD_tenandId}', see
+    https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/use-outlook-rest-api#target-user
     for more
 
     Args:
@@ -31,36 +210,21 @@ def create_draft(auth, subject, body, addresses, user_id, cc_addresses=[], attac
         attachments_list (list): a list formatted as described here
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/mail-rest-operations#create-attachments
     """
-    data = {}
-    data['Subject'] = subject
-    data['Body'] = {}
-    data['Body']['ContentType'] = 'HTML'
-    data['Body']['Content'] = body
-    data['ToRecipients'] = [{'EmailAddress': {'Address': addr}} for addr in addresses]
-    data['ccRecipients'] = [{'EmailAddress': {'Address': addr}} for addr in cc_addresses]
-    if attachments_list is not None:
-        data['Attachments'] = attachments_list
+    data = _draft_data(subject, body, addresses, cc_addresses, attachments_list)
 
-    params = json.dumps(data).encode('utf8')
+    params = codec.dumps(data)
 
     url = "{api_url}/{user_id}/messages".format(api_url=API_URL, user_id=user_id)
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer {}'.format(auth.access_token)
-        }
-    req = urllib.request.Request(url, params, headers)
-    try:
-        resp = urllib.request.urlopen(req)
-        resp_data = json.load(resp)
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "POST", url, params, headers)
+    resp_data = codec.loads(resp.read())
 
-        logging.getLogger(__name__).info("Draft created")
+    logging.getLogger(__name__).info("Draft created")
 
-        return resp_data['id']
-    except urllib.error.HTTPError as err:
-        raise AzureError(err)
+    return resp_data['id']
 
-def get_emails(auth, user_id, folder_id='AllItems', **kwargs):
+def get_emails(auth, user_id, folder_id='AllItems', lazy=False, **kwargs):
     """
     implementation of that endpoint:
     https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/mail-rest-operations#get-messages
@@ -70,46 +234,56 @@ def get_emails(auth, user_id, folder_id='AllItems', **kwargs):
         user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
         folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
             by default 'AllItems'
-        search (str): to search for specific messages, please see the documentation for syntax ex: "subject:pizza"
+        search (str): to search for specific messages, please see the documentation
+            for syntax ex: "subject:pizza"
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#Search
-        filter (str): to filter with some conditions, see in the documentation for syntax ex: "Start/DateTime ge '2016-04-01T08:00'"
+        filter (str): to filter with some conditions, see in the documentation
+            for syntax ex: "Start/DateTime ge '2016-04-01T08:00'"
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#Filter
         select (str): the elements you want to select separated by a comma ex: 'Sender,Subject,id'
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#Select
         orderby (str): to sort results
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#OrderBy
-        top (int): for pagination, the number of entries displayed maximum, 50
+        top (int): for pagination, the number of entries displayed maximum, at most MAX_PAGE_SIZE
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#TopSkip
         skip (int): for pagination, the number of entries to skip
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#TopSkip
         expand (bool): to expand messages and attachments
-        count (bool): if true it will return a count of the messages
+        count (bool): if true a MessageList is returned whose total_count is the number of messages
+            matching the query, see also azure_client.folders.count_emails
             https://docs.microsoft.com/en-us/previous-versions/office/office-365-api/api/version-2.0/complex-types-for-mail-contacts-calendar#Count
+        body_type (str): 'text' or 'html', the format of the bodies returned
+        lazy (bool): returns a RawPage holding the bytes received, decoded only when it is used
+        the arguments can also be built with azure_client.query.Query
     """
 
-    kwargs = {"$" + key: item for (key, item) in kwargs.items() if item != False}
+    url = _messages_url(user_id, folder_id, kwargs)
+    if lazy:
+        return RawPage(_get_messages_raw(auth, url, _messages_headers(kwargs)),
+                       get_session(auth.session))
+    resp_data = _get_messages_data(auth, url, _messages_headers(kwargs))
 
-    url = "{api_url}/{user_id}/MailFolders/{folder_id}/messages?{params}".format(
-        api_url=API_URL,
-        user_id=user_id,
-        folder_id=folder_id,
-        params=urlencode(kwargs).replace("=True", ""))
+    return _messages_value(resp_data)
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer {}'.format(auth.access_token)
-        }
-
-    req = urllib.request.Request(url, headers=headers)
-    try:
-        resp = urllib.request.urlopen(req)
-        resp_data = json.load(resp)
+def get_emails_page(auth, user_id, folder_id='AllItems', next_link=None, **kwargs):
+    """
+    same as get_emails but also returns the url of the next page given
+    by the server in @odata.nextLink, None if it is the last page,
+    if next_link is given that page is fetched and kwargs are ignored
 
-        logging.getLogger(__name__).info("Messages recieved")
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems'
+            by default 'AllItems'
+        next_link (str): the url of the page returned by the previous call
+        kwargs: the query arguments of get_emails, only body_type is used with next_link
+            since the other ones are already in it
+    """
+    url = next_link if next_link is not None else _messages_url(user_id, folder_id, kwargs)
+    resp_data = _get_messages_data(auth, url, _messages_headers(kwargs))
 
-        return resp_data['value']
-    except urllib.error.HTTPError as err:
-        raise AzureError(err)
+    return _messages_value(resp_data), resp_data.get('@odata.nextLink')
 
 def send_email(auth, user_id, message_id):
     """
@@ -127,14 +301,43 @@ def send_email(auth, user_id, message_id):
         message_id=message_id
         )
 
-    headers = {'Authorization': 'Bearer {}'.format(auth.access_token)}
+    _request(auth, "POST", url)
+    logging.getLogger(__name__).info("Message sent")
 
-    req = urllib.request.Request(url, headers=headers, method="POST")
-    try:
-        urllib.request.urlopen(req)
-        logging.getLogger(__name__).info("Message sent")
-    except urllib.error.HTTPError as err:
-        raise AzureError(err)
+def _send_mail_data(message, save_to_sent_items=True):
+    """
+    builds the body of sendMail around the message resource of _draft_data
+    """
+    return {'Message': message, 'SaveToSentItems': save_to_sent_items}
+
+def send_mail(auth, subject, body, addresses, user_id, cc_addresses=(), attachments_list=None,  # pylint: disable=too-many-arguments
+              save_to_sent_items=True):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/user-sendmail
+    sends a new message in one request, without creating a draft first,
+    the server does not return the id of the message sent
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        subject (str): the subject of the message
+        body (str): the body of the message in html
+        addresses (list): the list of the addresses of the recipients
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        cc_addresses (list): a list of the addresses to cc
+        attachments_list (list): a list formatted as in create_draft
+        save_to_sent_items (bool): keeps a copy of the message in the SentItems folder
+    """
+    data = _send_mail_data(_draft_data(subject, body, addresses, cc_addresses, attachments_list),
+                           save_to_sent_items)
+
+    params = codec.dumps(data)
+
+    url = "{api_url}/{user_id}/sendMail".format(api_url=API_URL, user_id=user_id)
+
+    headers = {'Content-Type': 'application/json'}
+    _request(auth, "POST", url, params, headers)
+    logging.getLogger(__name__).info("Message sent")
 
 def delete_email(auth, user_id, message_id):
     """
@@ -152,26 +355,161 @@ def delete_email(auth, user_id, message_id):
         message_id=message_id
         )
 
-    headers = {'Authorization': 'Bearer {}'.format(auth.access_token)}
+    _request(auth, "DELETE", url)
+    logging.getLogger(__name__).info("Message deleted")
 
-    req = urllib.request.Request(url, headers=headers, method="DELETE")
-    try:
-        urllib.request.urlopen(req)
-        logging.getLogger(__name__).info("Message deleted")
-    except urllib.error.HTTPError as err:
-        raise AzureError(err)
+def get_email(auth, user_id, message_id, **kwargs):
+    """
+    implementation of that endpoint:
+    https://docs.microsoft.com/en-us/graph/api/message-get
+    returns one message, ex: the one of an azure_client.subscriptions.Notification
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        message_id (str): the id of the message
+        select (str): the elements you want to select separated by a comma, all of them if None
+        expand (bool): to expand the attachments
+        body_type (str): 'text' or 'html', the format of the body returned
+    """
+    url = "{api_url}/{user_id}/messages/{message_id}".format(
+        api_url=API_URL,
+        user_id=user_id,
+        message_id=message_id
+        )
+    query_string = _query_string(kwargs)
+    if query_string:
+        url += '?' + query_string
 
-def get_all_emails_it(auth, user_id, folder_id='AllItems', pages_limit=None, pages_size=50, **kwargs):
+    return _get_messages_data(auth, url, _messages_headers(kwargs))
+
+def get_all_emails_it(auth, user_id, folder_id='AllItems', pages_limit=None, pages_size=50,  # pylint: disable=too-many-arguments
+                      pagination='next_link', prefetch=0, **kwargs):
     """
     iterator which goes through all the pages to find all the emails
+
+    Args:
+        pages_limit (int): stops after that page if not None
+        pages_size (int): the number of emails per page, at most MAX_PAGE_SIZE
+        pagination (str): 'next_link' to follow the @odata.nextLink cursors given by the server,
+            which stays fast on deep pages and consistent if the folder changes,
+            or 'skip' to compute the pages with $top and $skip
+        prefetch (int): the number of pages fetched in the background while the current
+            one is processed, 0 to fetch them only when they are needed,
+            the 'skip' pagination fetches them concurrently on a pool of prefetch threads
+        kwargs: the query arguments of get_emails, only the fields of DEFAULT_SELECT
+            are selected if select is not given, select=None selects all of them
     """
-    i = 0
-    args_dict = dict(kwargs, top=pages_size, skip=pages_size * i)
-    curr_emails = get_emails(auth, user_id, folder_id, **args_dict)
-    while len(curr_emails) != 0:
+    kwargs.setdefault('select', DEFAULT_SELECT)
+    if pages_size > MAX_PAGE_SIZE:
+        raise ValueError('The pages size should be at most {}'.format(MAX_PAGE_SIZE))
+    if pagination == 'next_link':
+        pages = _next_link_pages(auth, user_id, folder_id, pages_size, kwargs)
+        if prefetch > 0:
+            pages = _prefetched(pages, prefetch, pages_limit)
+    elif pagination == 'skip':
+        if prefetch > 0:
+            pages = _skip_pages_prefetched(auth, user_id, folder_id, pages_size, kwargs, prefetch,
+                                           pages_limit)
+        else:
+            pages = _skip_pages(auth, user_id, folder_id, pages_size, kwargs)
+    else:
+        raise ValueError('Unexpected pagination {}'.format(pagination))
+
+    try:
+        for i, curr_emails in enumerate(pages):
+            if len(curr_emails) == 0:
+                break
+            yield curr_emails
+            if pages_limit is not None and i >= pages_limit:
+                break
+    finally:
+        pages.close()
+
+def _next_link_pages(auth, user_id, folder_id, pages_size, kwargs):
+    curr_emails, next_link = get_emails_page(auth, user_id, folder_id,
+                                             **dict(kwargs, top=pages_size))
+    yield curr_emails
+    while next_link is not None:
+        curr_emails, next_link = get_emails_page(auth, user_id, folder_id, next_link=next_link,
+                                                 body_type=kwargs.get('body_type'))
         yield curr_emails
-        if pages_limit is not None and i >= pages_limit:
-            break
-        i += 1
+
+def _skip_pages(auth, user_id, folder_id, pages_size, kwargs):
+    i = 0
+    while True:
         args_dict = dict(kwargs, top=pages_size, skip=pages_size * i)
         curr_emails = get_emails(auth, user_id, folder_id, **args_dict)
+        yield curr_emails
+        if len(curr_emails) == 0:
+            return
+        i += 1
+
+def _skip_pages_prefetched(auth, user_id, folder_id, pages_size, kwargs, prefetch, pages_limit):  # pylint: disable=too-many-arguments
+    """
+    fetches the pages with $skip, the prefetch next pages being fetched
+    concurrently while the current one is processed
+    """
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    futures = deque()
+    i = 0
+    try:
+        while True:
+            while len(futures) <= prefetch and (pages_limit is None or i <= pages_limit):
+                args_dict = dict(kwargs, top=pages_size, skip=pages_size * i)
+                futures.append(executor.submit(get_emails, auth, user_id, folder_id, **args_dict))
+                i += 1
+            if not futures:
+                return
+            curr_emails = futures.popleft().result()
+            yield curr_emails
+            if len(curr_emails) == 0:
+                return
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+_END_OF_PAGES = object()
+
+def _prefetched(pages, prefetch, pages_limit=None):
+    """
+    iterates over pages while one background thread fetches up to prefetch
+    pages ahead, the errors of the fetching are raised to the consumer
+    and closing the iterator stops the background thread
+    """
+    if pages_limit is not None:
+        pages = itertools.islice(pages, pages_limit + 1)
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((_END_OF_PAGES, None))
+        except Exception as err:  # pylint: disable=broad-except
+            put((None, err))
+
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, err = buffer.get()
+            if err is not None:
+                raise err
+            if page is _END_OF_PAGES:
+                return
+            yield page
+    finally:
+        stop.set()
@@ -0,0 +1,194 @@
+"""
+Module which sends one message template to many recipients, the template
+is parsed and serialized in json once, only the placeholders and the
+recipients are serialized for each message and spliced between the
+invariant parts, the messages are then created and sent with batch
+requests, or sent directly with sendMail
+"""
+
+import html
+import json
+import logging
+import string
+from itertools import islice
+from azure_client.attachments import inline_attachment
+from azure_client.batch import (BatchResult, DEFAULT_MAX_WORKERS, BATCH_SIZE, execute_batch,
+                                send_emails, _sub_request)
+
+
+def _json_string(text):
+    """
+    returns text serialized as the content of a json string, without the quotes
+    """
+    return json.dumps(text, ensure_ascii=False)[1:-1].encode('utf8')
+
+
+class _TemplateField:
+
+    """
+    a string with $placeholders, split once into its literal parts already
+    serialized in json and the names of the placeholders between them
+    """
+
+    def __init__(self, text, escape=None):
+        self.literals = []
+        self.names = []
+        self.escape = escape
+        literal = []
+        position = 0
+        for match in string.Template.pattern.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                literal.append('$')
+            elif match.group('named') is not None or match.group('braced') is not None:
+                self.literals.append(_json_string(''.join(literal)))
+                self.names.append(match.group('named') or match.group('braced'))
+                literal = []
+            else:
+                raise ValueError('Invalid placeholder at position {} of {!r}'.format(
+                    match.start(), text[:40]))
+        literal.append(text[position:])
+        self.literals.append(_json_string(''.join(literal)))
+
+    def render(self, variables, parts):
+        """
+        appends the json serialized string with the variables to parts,
+        raises a KeyError if a placeholder has no variable
+        """
+        parts.append(b'"')
+        parts.append(self.literals[0])
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = str(variables[name])
+            parts.append(_json_string(self.escape(value) if self.escape is not None else value))
+            parts.append(literal)
+        parts.append(b'"')
+
+
+def _recipients(addresses):
+    return json.dumps([{'EmailAddress': {'Address': addr}} for addr in addresses]).encode('utf8')
+
+
+class MailTemplate:  # pylint: disable=too-few-public-methods
+
+    """
+    Class which holds a message sent to many recipients, the subject and
+    the body can contain placeholders such as $first_name or ${first_name},
+    '$$' being a literal '$', replaced by the variables of each recipient,
+    the attachments and the cc recipients are the same for all the messages,
+    the files are read and encoded in base64 once
+
+    Args:
+        subject (str): the subject of the message with placeholders
+        body (str): the body of the message in html with placeholders
+        cc_addresses (list): the addresses to cc in all the messages
+        files (list): the paths or the binary file objects to attach
+        attachments_list (list): attachments formatted as in create_draft
+        escape_html (bool): escapes the variables inserted in the body
+    """
+
+    def __init__(self, subject, body, cc_addresses=(), files=(), attachments_list=None,  # pylint: disable=too-many-arguments
+                 escape_html=True):
+        attachments = list(attachments_list or []) + [inline_attachment(file) for file in files]
+        self._subject = _TemplateField(subject)
+        self._body = _TemplateField(body, html.escape if escape_html else None)
+        self._prefix = b'{"Subject":'
+        self._before_body = b',"Body":{"ContentType":"HTML","Content":'
+        self._before_recipients = b'},"ToRecipients":'
+        tail = {'ccRecipients': [{'EmailAddress': {'Address': addr}} for addr in cc_addresses]}
+        if attachments:
+            tail['Attachments'] = attachments
+        self._suffix = b',' + json.dumps(tail, separators=(',', ':')).encode('utf8')[1:]
+
+    def render(self, addresses, variables):
+        """
+        returns the message resource of create_draft for one recipient serialized in json
+
+        Args:
+            addresses (list): the addresses of the recipients of that message
+            variables (dict): the values of the placeholders
+        """
+        parts = [self._prefix]
+        self._subject.render(variables, parts)
+        parts.append(self._before_body)
+        self._body.render(variables, parts)
+        parts.append(self._before_recipients)
+        parts.append(_recipients(addresses))
+        parts.append(self._suffix)
+        return b''.join(parts)
+
+    def render_send_mail(self, addresses, variables, save_to_sent_items=True):
+        """
+        returns the body of sendMail for one recipient serialized in json, see render
+        """
+        return b''.join((b'{"Message":', self.render(addresses, variables),
+                         b',"SaveToSentItems":', b'true' if save_to_sent_items else b'false', b'}'))
+
+
+def mail_merge(auth, user_id, template, recipients, send=True, max_workers=DEFAULT_MAX_WORKERS,  # pylint: disable=too-many-arguments,too-many-locals
+               direct=False, save_to_sent_items=True):
+    """
+    creates one message of the template per recipient with batch requests
+    and sends them if send is True, the recipients are consumed by windows
+    of max_workers batches so that a long iterable is not held in memory,
+    returns one BatchResult per recipient in the same order whose value is
+    the id of the message, its error is the one of the creation, of the
+    sending or a KeyError if a variable is missing
+    if direct is True each message is sent with one sendMail request
+    instead, which halves the requests but gives no id to the results
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        template (MailTemplate): the message sent
+        recipients (iterable): pairs of one address or a list of addresses and
+            a dict of the variables of the template for that message
+        send (bool): sends the messages created, they are left in the drafts else
+        max_workers (int): the maximum number of batches sent concurrently
+        direct (bool): sends the messages with sendMail without creating drafts
+        save_to_sent_items (bool): keeps a copy of the messages sent directly in SentItems
+    """
+    if direct:
+        url = "/{user_id}/sendMail".format(user_id=user_id)
+    else:
+        url = "/{user_id}/messages".format(user_id=user_id)
+    recipients = iter(recipients)
+    results = []
+    while True:
+        window = list(islice(recipients, BATCH_SIZE * max_workers))
+        if not window:
+            break
+        window_results = [None] * len(window)
+        requests = []
+        indexes = []
+        for i, (addresses, variables) in enumerate(window):
+            if isinstance(addresses, str):
+                addresses = [addresses]
+            try:
+                if direct:
+                    body = template.render_send_mail(addresses, variables, save_to_sent_items)
+                else:
+                    body = template.render(addresses, variables)
+                requests.append(_sub_request("POST", url, body))
+                indexes.append(i)
+            except KeyError as err:
+                window_results[i] = BatchResult(None, error=err)
+
+        created = []
+        for i, result in zip(indexes, execute_batch(auth, requests, max_workers)):
+            window_results[i] = result
+            if result.ok and not direct:
+                result.value = result.body['id']
+                created.append(i)
+
+        if send and created:
+            message_ids = [window_results[i].value for i in created]
+            sent = send_emails(auth, user_id, message_ids, max_workers)
+            for i, message_id, result in zip(created, message_ids, sent):
+                result.value = message_id
+                window_results[i] = result
+        results.extend(window_results)
+
+    logging.getLogger(__name__).info("Mail merge of %d messages, %d failed",
+                                     len(results), sum(not result.ok for result in results))
+    return results
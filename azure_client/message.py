@@ -0,0 +1,49 @@
+"""
+Module which defines a compact representation of the messages
+"""
+
+
+class Message:
+
+    """
+    the common fields of one message, without the memory overhead of a dict,
+    sender is the email address of the sender and received_date_time the
+    ISO 8601 date given by the server, the fields which were not selected are None
+    """
+
+    __slots__ = ('id', 'subject', 'sender', 'received_date_time', 'change_key')
+
+    SELECT = 'id,subject,sender,receivedDateTime,changeKey'
+
+    def __init__(self, id, subject=None, sender=None, received_date_time=None, change_key=None):  # pylint: disable=redefined-builtin,too-many-arguments
+        self.id = id  # pylint: disable=invalid-name
+        self.subject = subject
+        self.sender = sender
+        self.received_date_time = received_date_time
+        self.change_key = change_key
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        builds a Message from one message returned by the graph API
+        """
+        sender = data.get('sender')
+        if sender is not None:
+            sender = sender.get('emailAddress', {}).get('address')
+        return cls(
+            data['id'],
+            data.get('subject'),
+            sender,
+            data.get('receivedDateTime'),
+            data.get('changeKey'))
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return 'Message(id={!r}, subject={!r})'.format(self.id, self.subject)
@@ -0,0 +1,188 @@
+"""
+Module which builds the odata query arguments of the messages listings,
+so that only the fields needed are requested and the filters are
+formatted without mistakes
+see https://docs.microsoft.com/en-us/graph/query-parameters
+"""
+
+import datetime
+
+
+COMPARISON_OPERATORS = ('eq', 'ne', 'gt', 'ge', 'lt', 'le')
+FUNCTION_OPERATORS = ('contains', 'startswith', 'endswith')
+BODY_TYPES = ('text', 'html')
+# the fields holding the whole body of the messages
+BODY_FIELDS = ('body', 'uniqueBody')
+
+
+def format_value(value):
+    """
+    formats a python value as an odata literal, the strings are quoted,
+    the dates and datetimes written in ISO 8601, the naive datetimes
+    being considered as UTC
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.isoformat() + 'Z'
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    raise TypeError('Unexpected value {!r}'.format(value))
+
+
+class Query:
+
+    """
+    Class which builds the keyword arguments of azure_client.mail.get_emails
+    and of the other messages listings, the methods return the query so that
+    they can be chained, ex:
+        query = Query().select('id', 'subject').where('isRead', 'eq', False).order_by(
+            'receivedDateTime', True)
+        emails = get_emails(auth, 'me', 'Inbox', **query.params())
+    """
+
+    def __init__(self):
+        self._select = []
+        self._filters = []
+        self._orderby = []
+        self._search = None
+        self._top = None
+        self._skip = None
+        self._count = False
+        self._expand = None
+        self._body_type = None
+
+    def select(self, *fields):
+        """
+        adds fields to the projection, all the fields are returned if none is selected
+        """
+        for field in fields:
+            if field not in self._select:
+                self._select.append(field)
+        return self
+
+    def preview_only(self):
+        """
+        replaces the bodies of the messages by their first 255 characters in bodyPreview
+        """
+        self._select = [field for field in self._select if field not in BODY_FIELDS]
+        return self.select('bodyPreview')
+
+    def where(self, field, operator, value):
+        """
+        adds a condition, all of them should be met, ex: where('isRead', 'eq', False)
+
+        Args:
+            field (str): the field compared, ex: 'receivedDateTime' or 'from/emailAddress/address'
+            operator (str): one of COMPARISON_OPERATORS or FUNCTION_OPERATORS
+            value: the value compared, formatted with format_value
+        """
+        if operator in COMPARISON_OPERATORS:
+            condition = '{} {} {}'.format(field, operator, format_value(value))
+        elif operator in FUNCTION_OPERATORS:
+            condition = '{}({},{})'.format(operator, field, format_value(value))
+        else:
+            raise ValueError('Unexpected operator {}'.format(operator))
+        return self.filter(condition)
+
+    def filter(self, expression):
+        """
+        adds a condition written in the odata syntax, ex: "importance eq 'high'"
+        """
+        self._filters.append(expression)
+        return self
+
+    def search(self, text):
+        """
+        searches the messages, ex: 'subject:pizza', it can not be combined with order_by
+        """
+        self._search = '"{}"'.format(text.replace('"', '\\"'))
+        return self
+
+    def order_by(self, field, descending=False):
+        """
+        sorts the messages by the field, the first call being the main order
+        """
+        self._orderby.append('{} desc'.format(field) if descending else field)
+        return self
+
+    def top(self, count):
+        """
+        sets the number of messages per page, at most azure_client.mail.MAX_PAGE_SIZE
+        """
+        self._top = count
+        return self
+
+    def skip(self, count):
+        """
+        sets the number of messages skipped
+        """
+        self._skip = count
+        return self
+
+    def count(self):
+        """
+        asks the server for the total number of messages matching the query
+        """
+        self._count = True
+        return self
+
+    def expand(self, relation='attachments'):
+        """
+        returns the related resources with the messages
+        """
+        self._expand = relation
+        return self
+
+    def body_type(self, body_type):
+        """
+        asks the server for the bodies in 'text' or 'html'
+        """
+        if body_type not in BODY_TYPES:
+            raise ValueError('Unexpected body type {}'.format(body_type))
+        self._body_type = body_type
+        return self
+
+    def text_body(self):
+        """
+        asks the server for the bodies in text, which are smaller than in html
+        """
+        return self.body_type('text')
+
+    def params(self):
+        """
+        returns the keyword arguments of get_emails for that query, select
+        is None if no field was selected so that the helpers going through
+        whole folders do not replace it with their default projection
+        """
+        params = {'select': ','.join(self._select) or None}
+        if self._filters:
+            params['filter'] = ' and '.join(
+                '({})'.format(condition) if len(self._filters) > 1 else condition
+                for condition in self._filters)
+        if self._orderby:
+            params['orderby'] = ','.join(self._orderby)
+        if self._search is not None:
+            params['search'] = self._search
+        if self._top is not None:
+            params['top'] = self._top
+        if self._skip is not None:
+            params['skip'] = self._skip
+        if self._count:
+            params['count'] = True
+        if self._expand is not None:
+            params['expand'] = self._expand
+        if self._body_type is not None:
+            params['body_type'] = self._body_type
+        return params
+
+    def __repr__(self):
+        return 'Query({})'.format(self.params())
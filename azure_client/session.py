@@ -0,0 +1,430 @@
+"""
+Module which handles the http connections to the azure REST APIs,
+the connections are kept alive and pooled by host so that consecutive
+calls do not pay a new TCP and TLS handshake
+"""
+
+import logging
+import select
+import socket
+import threading
+import time
+import http.client
+import urllib.parse
+from collections import deque
+from azure_client.exceptions import AzureError
+from azure_client.instrumentation import Instrumentation, REQUEST, RETRY, THROTTLED
+from azure_client.throttling import (RetryPolicy, RateLimiter, IDEMPOTENT_METHODS,
+                                     RETRY_AFTER_STATUSES, parse_retry_after)
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_TIMEOUT = 120
+
+_DEFAULT_SESSION = None
+_DEFAULT_SESSION_LOCK = threading.Lock()
+
+
+class HttpResponse:  # pylint: disable=too-few-public-methods
+
+    """
+    the response of one http request, the body is fully read so that
+    the connection can go back to the pool right away
+    it exposes the same attributes as urllib.error.HTTPError so that
+    it can be given to AzureError, phases holds the durations of the
+    phases of the request, see azure_client.instrumentation.PHASES,
+    retries is the number of times the request was retried
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.code = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.phases = {}
+        self.reused = None
+        self.retries = 0
+
+    def read(self):
+        """
+        returns the body of the response as bytes
+        """
+        return self.body
+
+
+class StreamedResponse:
+
+    """
+    the response of one http request whose body is read on demand,
+    the connection goes back to the pool once the body has been fully
+    read and the response closed, it can be used as a context manager
+    """
+
+    def __init__(self, response, release):
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.phases = {}
+        self.reused = None
+        self.retries = 0
+        self._response = response
+        self._release = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, amt=None):
+        """
+        returns at most amt bytes of the body, all the rest if amt is None,
+        an empty bytes object once the body has been read
+        """
+        return self._response.read(amt)
+
+    def readinto(self, buffer):
+        """
+        reads the body into the buffer and returns the number of bytes read
+        """
+        return self._response.readinto(buffer)
+
+    def close(self):
+        """
+        gives the connection back to the pool if the body has been read,
+        closes it else
+        """
+        if self._release is not None:
+            release, self._release = self._release, None
+            if self._response.length == 0:
+                # an empty body is only marked as read once read
+                self._response.read()
+            release(self._response.isclosed())
+
+
+class _TimedConnectionMixin:
+
+    """
+    measures the name resolution, the TCP connection and the TLS handshake
+    of an http.client connection in phases
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.phases = {}
+        self._create_connection = self._timed_create_connection
+
+    def connect(self):
+        """
+        opens the connection, measuring its phases
+        """
+        self.phases = {}
+        start = time.perf_counter()
+        super().connect()
+        if isinstance(self, http.client.HTTPSConnection):
+            elapsed = time.perf_counter() - start
+            opened = self.phases.get('dns', 0.0) + self.phases.get('connect', 0.0)
+            self.phases['tls'] = max(0.0, elapsed - opened)
+
+    def _timed_create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,  # pylint: disable=protected-access
+                                 source_address=None):
+        start = time.perf_counter()
+        addresses = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        self.phases['dns'] = resolved - start
+        error = None
+        for *_, sockaddr in addresses:
+            try:
+                sock = socket.create_connection(sockaddr[:2], timeout, source_address)
+            except OSError as err:
+                error = err
+                continue
+            self.phases['connect'] = time.perf_counter() - resolved
+            return sock
+        raise error or OSError('No address found for {}'.format(address[0]))
+
+
+class _HTTPConnection(_TimedConnectionMixin, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TimedConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+
+class HttpSession:
+
+    """
+    Class which keeps a pool of keep-alive connections per host,
+    it can be shared between threads, each request takes one idle
+    connection from the pool (or opens a new one) and gives it back
+    once the response has been read
+
+    Args:
+        pool_size (int): the maximum number of idle connections kept per host
+        idle_timeout (float): the number of seconds after which an idle connection is closed
+        timeout (float): the socket timeout of the connections
+        retry_policy (azure_client.throttling.RetryPolicy): how the failed requests are retried,
+            a default RetryPolicy if None
+        rate_limiter (azure_client.throttling.RateLimiter): the limiter of the requests per mailbox,
+            a default RateLimiter if None
+        instrumentation (azure_client.instrumentation.Instrumentation): receives the events
+            of the requests, a new Instrumentation without listeners if None
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,  # pylint: disable=too-many-arguments
+                 timeout=DEFAULT_TIMEOUT, retry_policy=None, rate_limiter=None,
+                 instrumentation=None):
+        if pool_size < 1:
+            raise ValueError('The pool size should be at least 1')
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, method, url, data=None, headers=None, stream=False):  # pylint: disable=too-many-arguments
+        """
+        sends one request and returns an HttpResponse, the request is retried
+        according to the retry policy and delayed by the rate limiter,
+        raises an AzureError if the server answers with an error status
+
+        Args:
+            method (str): the http method, 'GET', 'POST', 'DELETE'...
+            url (str): the full url of the resource
+            data (bytes): the body of the request
+            headers (dict): the headers of the request
+            stream (bool): if True the body is not read and a StreamedResponse
+                is returned, it should be closed once used
+        """
+        key = self.rate_limiter.key(url, data)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            self.rate_limiter.acquire(key)
+            queued = time.perf_counter() - start
+            try:
+                response = self._request(method, url, data, headers or {}, stream)
+            except Exception as err:
+                self.instrumentation.emit(
+                    REQUEST, method=method, url=url, status=None, attempt=attempt,
+                    duration=time.perf_counter() - start, phases={'queue': queued},
+                    request_size=len(data) if data else 0, response_size=None, reused=None,
+                    error=err)
+                if not self.retry_policy.should_retry_error(method, err, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logging.getLogger(__name__).warning(
+                    'Request %s %s failed with %r, retrying in %.1fs', method, url, err, delay)
+                self.instrumentation.emit(
+                    RETRY, method=method, url=url, status=None, attempt=attempt, delay=delay,
+                    retry_after=None)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            response.phases['queue'] = queued
+            self.instrumentation.emit(
+                REQUEST, method=method, url=url, status=response.status, attempt=attempt,
+                duration=time.perf_counter() - start, phases=response.phases,
+                request_size=len(data) if data else 0,
+                response_size=len(response.body) if isinstance(response, HttpResponse) else None,
+                reused=response.reused, error=None)
+            if response.status < 400:
+                self.rate_limiter.succeeded(key)
+                response.retries = attempt
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status in RETRY_AFTER_STATUSES:
+                self.rate_limiter.throttled(key, retry_after)
+                self.instrumentation.emit(
+                    THROTTLED, url=url, status=response.status, retry_after=retry_after, count=1)
+            if not self.retry_policy.should_retry(method, response.status, attempt):
+                raise AzureError(response)
+            delay = self.retry_policy.delay(attempt, retry_after)
+            logging.getLogger(__name__).warning(
+                'Request %s %s failed with status %d, retrying in %.1fs',
+                method, url, response.status, delay)
+            self.instrumentation.emit(
+                RETRY, method=method, url=url, status=response.status, attempt=attempt, delay=delay,
+                retry_after=retry_after)
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, method, url, data, headers, stream):  # pylint: disable=too-many-arguments
+        """
+        sends one request and returns the HttpResponse whatever its status,
+        a StreamedResponse if stream is True and the request succeeded
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+
+        phases = {}
+        conn, reused = self._acquire(key)
+        try:
+            resp = self._send(conn, method, path, data, headers, phases)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused or method not in IDEMPOTENT_METHODS:
+                # a request which is not idempotent may have been processed, it is not sent twice
+                raise
+            # the server closed the idle connection in the meantime
+            logging.getLogger(__name__).debug(
+                'Stale connection to %s, reconnecting', parsed_url.netloc)
+            conn, reused = self._new_connection(key), False
+            resp = self._send(conn, method, path, data, headers, phases)
+        except BaseException:
+            conn.close()
+            raise
+
+        def release(fully_read):
+            if fully_read and not resp.will_close:
+                self._release(key, conn)
+            else:
+                conn.close()
+
+        if stream and resp.status < 400:
+            response = StreamedResponse(resp, release)
+        else:
+            start = time.perf_counter()
+            try:
+                body = resp.read()
+            except BaseException:
+                conn.close()
+                raise
+            phases['read'] = time.perf_counter() - start
+            release(True)
+            response = HttpResponse(resp.status, resp.reason, resp.headers, body)
+        response.phases = phases
+        response.reused = reused
+        return response
+
+    def close(self):
+        """
+        closes all the idle connections of the pool
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+        for pool in pools:
+            for conn, _ in pool:
+                conn.close()
+
+    @staticmethod
+    def _send(conn, method, path, data, headers, phases):  # pylint: disable=too-many-arguments
+        """
+        sends the request and reads the response headers, the durations
+        of the connection, of the sending and of the wait for the server
+        are stored in phases
+        """
+        if conn.sock is None:
+            conn.connect()
+            phases.update(conn.phases)
+        start = time.perf_counter()
+        conn.request(method, path, body=data, headers=headers)
+        sent = time.perf_counter()
+        resp = conn.getresponse()
+        phases['send'] = sent - start
+        phases['server'] = time.perf_counter() - sent
+        return resp
+
+    def _new_connection(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return _HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == 'http':
+            return _HTTPConnection(netloc, timeout=self.timeout)
+        raise ValueError('Unsupported url scheme {}'.format(scheme))
+
+    def _acquire(self, key):
+        """
+        returns an idle connection to the host if there is one
+        which did not time out, a new connection else
+        """
+        expired = []
+        conn = None
+        now = time.monotonic()
+        with self._lock:
+            pool = self._pools.get(key)
+            while pool:
+                candidate, last_used = pool.pop()
+                if now - last_used < self.idle_timeout and not _dropped(candidate):
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._new_connection(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+
+def _dropped(conn):
+    """
+    returns True if the server closed an idle connection, its socket being
+    readable while no response is expected, so that it is not used to
+    send a request which could not be replayed
+    """
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def get_default_session():
+    """
+    returns the session shared by all the calls which are not
+    given an explicit session
+    """
+    global _DEFAULT_SESSION  # pylint: disable=global-statement
+    with _DEFAULT_SESSION_LOCK:
+        if _DEFAULT_SESSION is None:
+            _DEFAULT_SESSION = HttpSession()
+        return _DEFAULT_SESSION
+
+
+def set_default_session(session):
+    """
+    replaces the session shared by all the calls, for instance to
+    change the pool size or the idle timeout
+    """
+    global _DEFAULT_SESSION  # pylint: disable=global-statement
+    with _DEFAULT_SESSION_LOCK:
+        previous, _DEFAULT_SESSION = _DEFAULT_SESSION, session
+    if previous is not None and previous is not session:
+        previous.close()
+
+
+def get_session(session=None):
+    """
+    returns the session given or the default one if it is None
+    """
+    if session is None:
+        return get_default_session()
+    return session
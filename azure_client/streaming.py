@@ -0,0 +1,175 @@
+"""
+Module which parses the pages of messages incrementally, the messages
+of the 'value' array are decoded and yielded one at a time while the
+response is read, so that a whole page is never held in memory
+"""
+
+import codecs
+import json
+import logging
+from azure_client.mail import (MAX_PAGE_SIZE, DEFAULT_SELECT, _request, _messages_url,
+                               _messages_headers)
+from azure_client.message import Message
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _IncrementalReader:
+
+    """
+    a text buffer filled on demand from a binary stream
+    """
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def fill(self, size=None):
+        """
+        reads at least size more bytes if possible, returns False at the end of the stream
+        """
+        if self.eof:
+            return False
+        data = self.stream.read(max(size or 0, self.chunk_size))
+        if not data:
+            self.eof = True
+            self.text = self.text[self.pos:] + self._decoder.decode(b'', final=True)
+        else:
+            self.text = self.text[self.pos:] + self._decoder.decode(data)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        skips the whitespaces and returns the next character, '' at the end
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """
+        consumes the next character which should be one of chars
+        """
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise json.JSONDecodeError('Expecting one of {!r}'.format(chars), self.text, self.pos)
+        self.pos += 1
+        return char
+
+    def decode(self, decoder):
+        """
+        decodes the next json value, reading more data until it is complete
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                # the value is incomplete, reading as much again as what is
+                # buffered keeps the parsing of large values linear
+                if not self.fill(len(self.text) - self.pos):
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.text) and not self.eof:
+                self.fill(len(self.text) - self.pos)
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(stream, key='value', others=None, chunk_size=DEFAULT_CHUNK_SIZE, decoder=None):
+    """
+    generator which yields one by one the items of the array under key
+    in the json object read from the binary stream, the other members
+    of the object are stored in the dict others if it is given
+
+    Args:
+        stream: a binary file object or response with a read method
+        key (str): the name of the member holding the array
+        others (dict): filled with the other members of the object
+        chunk_size (int): the number of bytes read at once
+        decoder (json.JSONDecoder): the decoder of the items
+    """
+    decoder = decoder or json.JSONDecoder()
+    reader = _IncrementalReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.decode(decoder)
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.decode(decoder)
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            value = reader.decode(decoder)
+            if others is not None:
+                others[name] = value
+        if reader.expect(',}') == '}':
+            return
+
+
+def iter_emails_page(auth, user_id, folder_id='AllItems', next_link=None, compact=False,  # pylint: disable=too-many-arguments
+                     others=None, **kwargs):
+    """
+    streaming version of azure_client.mail.get_emails_page, generator
+    which yields the messages of one page one by one while they are read,
+    the other members of the response such as '@odata.nextLink' are
+    stored in the dict others once the page has been read
+
+    Args:
+        compact (bool): yields azure_client.message.Message objects instead of dicts,
+            only the fields of Message.SELECT are selected if select is not given
+    """
+    if compact and next_link is None:
+        kwargs.setdefault('select', Message.SELECT)
+    url = next_link if next_link is not None else _messages_url(user_id, folder_id, kwargs)
+    with _request(auth, "GET", url, headers=_messages_headers(kwargs), stream=True) as resp:
+        for message in iter_json_array(resp, 'value', others):
+            yield Message.from_dict(message) if compact else message
+        # the trailing whitespaces are read so that the connection can be reused
+        resp.read()
+    logging.getLogger(__name__).info("Messages recieved")
+
+
+def iter_all_emails(auth, user_id, folder_id='AllItems', pages_size=50, compact=False, **kwargs):
+    """
+    generator which yields all the messages of the folder one by one,
+    following the @odata.nextLink of the pages, each page being parsed
+    while it is read so that the memory used does not depend on its size
+
+    Args:
+        pages_size (int): the number of messages per page, at most MAX_PAGE_SIZE
+        compact (bool): yields azure_client.message.Message objects instead of dicts
+        kwargs: the query arguments of get_emails, only the fields of DEFAULT_SELECT
+            are selected if select is not given, select=None selects all of them
+    """
+    kwargs.setdefault('select', DEFAULT_SELECT)
+    if pages_size > MAX_PAGE_SIZE:
+        raise ValueError('The pages size should be at most {}'.format(MAX_PAGE_SIZE))
+    others = {}
+    yield from iter_emails_page(auth, user_id, folder_id, compact=compact, others=others,
+                                **dict(kwargs, top=pages_size))
+    while '@odata.nextLink' in others:
+        next_link = others.pop('@odata.nextLink')
+        yield from iter_emails_page(auth, user_id, folder_id, next_link, compact, others,
+                                    body_type=kwargs.get('body_type'))
@@ -0,0 +1,361 @@
+"""
+Module which handles the change notifications of the mail folders, the
+subscriptions ask the graph API to post the changes to a url instead of
+polling the folders, and NotificationReceiver is a small http server
+which answers the validation of the subscriptions, checks the client
+state of the notifications and puts them in a bounded queue
+see https://docs.microsoft.com/en-us/graph/webhooks
+"""
+
+import datetime
+import logging
+import queue
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from azure_client import codec, mail
+from azure_client.mail import _request
+
+
+# the subscriptions to messages last at most 10080 minutes
+MAX_LIFETIME = datetime.timedelta(minutes=10080)
+DEFAULT_LIFETIME = datetime.timedelta(days=2)
+DEFAULT_QUEUE_SIZE = 10000
+# the seconds given to a client to complete its TLS handshake
+HANDSHAKE_TIMEOUT = 10
+
+
+def _expiration(lifetime):
+    lifetime = min(lifetime, MAX_LIFETIME - datetime.timedelta(minutes=1))
+    expiration = datetime.datetime.now(datetime.timezone.utc) + lifetime
+    return expiration.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _resource(user_id, folder_id):
+    if folder_id is None:
+        return "{user_id}/messages".format(user_id=user_id)
+    return "{user_id}/mailFolders('{folder_id}')/messages".format(
+        user_id=user_id, folder_id=folder_id)
+
+
+def create_subscription(auth, user_id, notification_url, folder_id='Inbox', change_type='created',  # pylint: disable=too-many-arguments
+                        client_state=None, lifetime=DEFAULT_LIFETIME,
+                        lifecycle_notification_url=None):
+    """
+    subscribes to the changes of the messages of a folder, the server
+    validates notification_url before answering so the receiver should
+    already be listening, returns the subscription created as a dict
+    with its 'id', 'expirationDateTime' and 'clientState'
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        notification_url (str): the public https url of the NotificationReceiver
+        folder_id (str): the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems',
+            None for all the messages of the mailbox
+        change_type (str): the changes notified separated by commas among 'created',
+            'updated' and 'deleted'
+        client_state (str): the secret sent back with each notification, a random one if None
+        lifetime (datetime.timedelta): the time after which the subscription expires
+            if it is not renewed, at most MAX_LIFETIME
+        lifecycle_notification_url (str): the url notified when the subscription
+            should be reauthorized or was removed, it can be the same one
+    """
+    data = {
+        'changeType': change_type,
+        'notificationUrl': notification_url,
+        'resource': _resource(user_id, folder_id),
+        'expirationDateTime': _expiration(lifetime),
+        'clientState': client_state if client_state is not None else secrets.token_urlsafe(32)
+        }
+    if lifecycle_notification_url is not None:
+        data['lifecycleNotificationUrl'] = lifecycle_notification_url
+    params = codec.dumps(data)
+
+    url = "{api_url}/subscriptions".format(api_url=mail.API_URL)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "POST", url, params, headers)
+    resp_data = codec.loads(resp.read())
+    # the server does not send the client state back
+    resp_data.setdefault('clientState', data['clientState'])
+
+    logging.getLogger(__name__).info("Subscription %s created", resp_data['id'])
+
+    return resp_data
+
+
+def renew_subscription(auth, subscription_id, lifetime=DEFAULT_LIFETIME):
+    """
+    postpones the expiration of a subscription, returns the subscription updated
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        subscription_id (str): the id of the subscription
+        lifetime (datetime.timedelta): the new lifetime from now, at most MAX_LIFETIME
+    """
+    params = codec.dumps({'expirationDateTime': _expiration(lifetime)})
+
+    url = "{api_url}/subscriptions/{subscription_id}".format(
+        api_url=mail.API_URL, subscription_id=subscription_id)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "PATCH", url, params, headers)
+    resp_data = codec.loads(resp.read())
+
+    logging.getLogger(__name__).info("Subscription %s renewed", subscription_id)
+
+    return resp_data
+
+
+def delete_subscription(auth, subscription_id):
+    """
+    stops the notifications of a subscription
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        subscription_id (str): the id of the subscription
+    """
+    url = "{api_url}/subscriptions/{subscription_id}".format(
+        api_url=mail.API_URL, subscription_id=subscription_id)
+
+    _request(auth, "DELETE", url)
+    logging.getLogger(__name__).info("Subscription %s deleted", subscription_id)
+
+
+def get_subscriptions(auth):
+    """
+    returns the active subscriptions of the application
+    """
+    url = "{api_url}/subscriptions".format(api_url=mail.API_URL)
+
+    headers = {'Content-Type': 'application/json'}
+    resp = _request(auth, "GET", url, headers=headers)
+
+    return codec.loads(resp.read())['value']
+
+
+class Notification:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    """
+    one change notified by the graph API, message_id is the id of the
+    message changed, to give to azure_client.mail.get_email, lifecycle_event
+    is set instead for the lifecycle notifications, ex: 'reauthorizationRequired'
+    or 'subscriptionRemoved', data holds the notification as received
+    """
+
+    def __init__(self, data):
+        resource_data = data.get('resourceData') or {}
+        self.subscription_id = data.get('subscriptionId')
+        self.change_type = data.get('changeType')
+        self.resource = data.get('resource')
+        self.message_id = resource_data.get('id')
+        self.lifecycle_event = data.get('lifecycleEvent')
+        self.expiration = data.get('subscriptionExpirationDateTime')
+        self.tenant_id = data.get('tenantId')
+        self.data = data
+
+    def __repr__(self):
+        return ('Notification(subscription_id={!r}, change_type={!r}, message_id={!r}, '
+                'lifecycle_event={!r})').format(
+                    self.subscription_id, self.change_type, self.message_id, self.lifecycle_event)
+
+
+class _ReceiverServer(ThreadingHTTPServer):
+
+    """
+    the http server of a NotificationReceiver, the connections are
+    wrapped with ssl_context in their own thread, so that a slow TLS
+    handshake does not block the other clients
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, ssl_context=None):
+        super().__init__(server_address, handler_class)
+        self.ssl_context = ssl_context
+
+    def finish_request(self, request, client_address):
+        """
+        serves one connection, after its TLS handshake if there is a context
+        """
+        if self.ssl_context is None:
+            super().finish_request(request, client_address)
+            return
+        request.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            tls_request = self.ssl_context.wrap_socket(request, server_side=True)
+        except OSError as err:
+            logging.getLogger(__name__).debug(
+                'TLS handshake with %s failed: %r', client_address, err)
+            return
+        with tls_request:
+            tls_request.settimeout(None)
+            super().finish_request(tls_request, client_address)
+
+
+class NotificationReceiver:
+
+    """
+    Class which runs an http server receiving the notifications in a
+    background thread, it answers the validation requests, drops the
+    notifications whose client state is unknown and puts the other ones
+    in a bounded queue, if the queue is full the server answers 503 so
+    that the graph API sends the notifications again later, some of them
+    can then be received twice
+    the graph API only posts to public https urls, the receiver is
+    usually exposed through a reverse proxy or given an ssl_context
+
+    Args:
+        host (str): the interface listened on
+        port (int): the port listened on, 0 for any free port
+        client_states (iterable): the client states accepted, see add_client_state
+        maxsize (int): the maximum number of notifications waiting in the queue
+        ssl_context (ssl.SSLContext): the context to serve https, plain http if None
+    """
+
+    def __init__(self, host='0.0.0.0', port=0, client_states=(), maxsize=DEFAULT_QUEUE_SIZE,  # pylint: disable=too-many-arguments
+                 ssl_context=None):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._client_states = set(client_states)
+        self._lock = threading.Lock()
+        self._server = _ReceiverServer((host, port), _receiver_handler(self), ssl_context)
+        self._thread = None
+
+    @property
+    def port(self):
+        """
+        the port listened on
+        """
+        return self._server.server_address[1]
+
+    def add_client_state(self, client_state):
+        """
+        accepts the notifications with that client state, the 'clientState'
+        of the subscriptions returned by create_subscription
+        """
+        with self._lock:
+            self._client_states.add(client_state)
+
+    def remove_client_state(self, client_state):
+        """
+        drops the notifications with that client state from now on
+        """
+        with self._lock:
+            self._client_states.discard(client_state)
+
+    def start(self):
+        """
+        starts serving in a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stops serving and closes the socket
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get(self, timeout=None):
+        """
+        returns the next Notification, waits for it at most timeout
+        seconds, raises queue.Empty if none came
+        """
+        return self.queue.get(timeout=timeout)
+
+    def notifications(self, timeout=None):
+        """
+        generator which yields the notifications as they come, it stops
+        once no notification came for timeout seconds, never if it is None
+        """
+        while True:
+            try:
+                yield self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def _receive(self, data):
+        """
+        queues the notifications of a request, returns False if the queue is full
+        """
+        for item in data.get('value', []):
+            with self._lock:
+                accepted = item.get('clientState') in self._client_states
+                if not accepted:
+                    self.dropped += 1
+            if not accepted:
+                logging.getLogger(__name__).warning(
+                    'Notification of the subscription %s dropped, unknown client state',
+                    item.get('subscriptionId'))
+                continue
+            try:
+                self.queue.put_nowait(Notification(item))
+            except queue.Full:
+                logging.getLogger(__name__).warning(
+                    'Notifications queue full, asking the server to retry')
+                return False
+        return True
+
+
+def _is_notifications(data):
+    """
+    returns True if the decoded body has the shape of a notifications request
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('value', []), list):
+        return False
+    return all(isinstance(item, dict) for item in data.get('value', []))
+
+
+def _receiver_handler(receiver):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        """
+        answers the validation requests and the notifications
+        """
+
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logging.getLogger(__name__).debug(format, *args)
+
+        def _reply(self, status, body=b'', content_type='text/plain'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """
+            answers a validation request with its token, queues the notifications else
+            """
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            validation_token = parse_qs(urlsplit(self.path).query).get('validationToken')
+            if validation_token:
+                # the server checks the url by expecting the token back within 10 seconds
+                self._reply(200, validation_token[0].encode('utf8'))
+                return
+            try:
+                data = codec.loads(body)
+            except ValueError:
+                self._reply(400)
+                return
+            if not _is_notifications(data):
+                self._reply(400)
+                return
+            self._reply(202 if receiver._receive(data) else 503)  # pylint: disable=protected-access
+
+    return Handler
@@ -0,0 +1,103 @@
+"""
+Module which handles the incremental synchronisation of the mail folders
+with the delta queries of the graph API, the changes can be handled
+page by page as they are received with iter_sync_emails
+see https://docs.microsoft.com/en-us/graph/delta-query-messages
+"""
+
+import logging
+from azure_client import codec, mail
+from azure_client.mail import _request, _query_string, _messages_headers
+
+
+class SyncResult:  # pylint: disable=too-few-public-methods
+
+    """
+    the changes of a folder since the previous synchronisation,
+    changed holds the messages added or modified, the graph API does not
+    tell one from the other, removed holds the ids of the messages deleted
+    or moved out of the folder and delta_link is the url to give to the
+    next synchronisation
+    """
+
+    def __init__(self, changed, removed, delta_link):
+        self.changed = changed
+        self.removed = removed
+        self.delta_link = delta_link
+
+    def __repr__(self):
+        return 'SyncResult(changed={}, removed={})'.format(len(self.changed), len(self.removed))
+
+
+def _delta_url(user_id, folder_id, kwargs):
+    return "{api_url}/{user_id}/MailFolders/{folder_id}/messages/delta?{params}".format(
+        api_url=mail.API_URL,
+        user_id=user_id,
+        folder_id=folder_id,
+        params=_query_string(kwargs))
+
+
+def iter_sync_emails(auth, user_id, folder_id='Inbox', delta_link=None, pages_size=None, **kwargs):  # pylint: disable=too-many-arguments
+    """
+    generator version of sync_emails which yields one SyncResult per page
+    of changes as it is received, so that the changes are not all held in
+    memory, the delta_link is None but for the last page
+    see sync_emails for the arguments
+    """
+    url = delta_link if delta_link is not None else _delta_url(user_id, folder_id, kwargs)
+    headers = _messages_headers(kwargs)
+    if pages_size is not None:
+        prefer = 'odata.maxpagesize={}'.format(pages_size)
+        headers['Prefer'] = ', '.join(filter(None, (headers.get('Prefer'), prefer)))
+
+    while True:
+        resp = _request(auth, "GET", url, headers=headers)
+        resp_data = codec.loads(resp.read())
+        changed = []
+        removed = []
+        for message in resp_data['value']:
+            if '@removed' in message:
+                removed.append(message['id'])
+            else:
+                changed.append(message)
+        yield SyncResult(changed, removed, resp_data.get('@odata.deltaLink'))
+        if '@odata.nextLink' not in resp_data:
+            break
+        url = resp_data['@odata.nextLink']
+
+
+def _merge(pages):
+    """
+    returns one SyncResult with the changes of all the pages
+    """
+    changed = []
+    removed = []
+    delta_link = None
+    for page in pages:
+        changed.extend(page.changed)
+        removed.extend(page.removed)
+        delta_link = page.delta_link
+    logging.getLogger(__name__).info(
+        "Folder synchronised, %d changed %d removed", len(changed), len(removed))
+    return SyncResult(changed, removed, delta_link)
+
+
+def sync_emails(auth, user_id, folder_id='Inbox', delta_link=None, pages_size=None, **kwargs):  # pylint: disable=too-many-arguments
+    """
+    returns a SyncResult with the changes of the folder since the
+    synchronisation which returned delta_link, or all its messages
+    if delta_link is None, see iter_sync_emails to handle large
+    changes page by page
+
+    Args:
+        auth (azure_client.authentication.AzureAuth): authentication object with credentials
+        user_id (str): the id of the user, either 'me' or 'users/email@domain.com'
+        folder_id (str): either the id of the folder or 'Inbox' 'Drafts' 'SentItems' 'DeletedItems',
+            the delta queries are not supported on 'AllItems'
+        delta_link (str): the delta link of the previous SyncResult
+        pages_size (int): the maximum number of messages per page asked to the server
+        select (str): the elements you want to select separated by a comma ex: 'Subject,id'
+        filter (str): only receivedDateTime filters are supported by delta queries
+        body_type (str): 'text' or 'html', the format of the bodies returned
+    """
+    return _merge(iter_sync_emails(auth, user_id, folder_id, delta_link, pages_size, **kwargs))
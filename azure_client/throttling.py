@@ -0,0 +1,243 @@
+"""
+Module which handles the throttling of the graph API, the requests
+are retried with the delay given by the Retry-After header or with a
+jittered exponential backoff, and a token bucket per mailbox adapts
+the request rate to the throttling observed
+see https://docs.microsoft.com/en-us/graph/throttling
+"""
+
+import asyncio
+import random
+import re
+import socket
+import threading
+import time
+import email.utils
+import http.client
+import urllib.parse
+
+
+RETRY_AFTER_STATUSES = (429, 503)
+TRANSIENT_STATUSES = (500, 502, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+# the network errors of a request which may have reached the server
+TRANSPORT_ERRORS = (OSError, http.client.HTTPException, EOFError, asyncio.TimeoutError)
+# the network errors raised before the request was sent
+CONNECT_ERRORS = (ConnectionRefusedError, socket.gaierror)
+
+# the outlook mailboxes accept 10000 requests per 10 minutes per application
+DEFAULT_RATE = 16.0
+DEFAULT_BURST = 16
+DEFAULT_MIN_RATE = 0.5
+# the adaptive rate can grow above the initial one while nothing is throttled
+DEFAULT_MAX_RATE = 2 * DEFAULT_RATE
+
+# the url of the first request of a $batch body, which gives the mailbox of the batch
+_BATCH_URL_RE = re.compile(rb'"url"\s*:\s*"([^"]*)"')
+
+
+def parse_retry_after(value):
+    """
+    returns the number of seconds to wait given by a Retry-After header,
+    which is either a number of seconds or an http date, None if there is none
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+class RetryPolicy:
+
+    """
+    Class which decides if and when a failed request is retried,
+    429 and 503 are always retried since the server did not process
+    the request, the other transient errors only for idempotent methods,
+    as are the network errors unless the connection could not be opened
+
+    Args:
+        max_retries (int): the maximum number of retries of one request, 0 to disable them
+        backoff_factor (float): the base delay of the exponential backoff in seconds
+        max_backoff (float): the maximum delay between two attempts in seconds
+    """
+
+    def __init__(self, max_retries=5, backoff_factor=0.5, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    def should_retry(self, method, status, attempt):
+        """
+        returns True if the attempt-th attempt, starting at 0, of a request
+        which failed with that status should be retried
+        """
+        if attempt >= self.max_retries:
+            return False
+        if status in RETRY_AFTER_STATUSES:
+            return True
+        return status in TRANSIENT_STATUSES and method in IDEMPOTENT_METHODS
+
+    def should_retry_error(self, method, error, attempt):
+        """
+        returns True if the attempt-th attempt, starting at 0, of a request
+        which failed with that network error should be retried
+        """
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, CONNECT_ERRORS):
+            return True
+        return isinstance(error, TRANSPORT_ERRORS) and method in IDEMPOTENT_METHODS
+
+    def delay(self, attempt, retry_after=None):
+        """
+        returns the number of seconds to wait before the next attempt,
+        the Retry-After delay if the server gave one, a full jitter
+        exponential backoff else
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+
+class TokenBucket:
+
+    """
+    Class which limits a request rate, the tokens are refilled at rate
+    per second up to burst, each request takes one token
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        takes one token and returns the number of seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def set_rate(self, update):
+        """
+        replaces the rate by update(rate), the tokens accumulated so far
+        being counted at the previous rate
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = update(self.rate)
+
+    def pause(self, seconds):
+        """
+        prevents any request to be sent for that number of seconds
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+
+    """
+    Class which keeps one token bucket per mailbox and adapts its rate,
+    the rate is halved each time the mailbox is throttled and slowly
+    grows back to max_rate while the requests succeed
+
+    Args:
+        rate (float): the initial number of requests per second per mailbox
+        burst (int): the number of requests which can be sent at once
+        min_rate (float): the rate is never decreased below that
+        max_rate (float): the rate is never increased above that, DEFAULT_MAX_RATE
+            or rate if it is higher when None
+        increase (float): the rate gained after each request which succeeds
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=DEFAULT_MIN_RATE,  # pylint: disable=too-many-arguments
+                 max_rate=None, increase=0.05):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else max(rate, DEFAULT_MAX_RATE)
+        self.increase = increase
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, data=None):
+        """
+        returns the mailbox targeted by a url, ex: 'me' or 'users/email@domain.com',
+        the one of the first request of the body data for a $batch request,
+        the host for the urls which do not target a mailbox
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        if data and parsed_url.path.endswith('/$batch'):
+            match = _BATCH_URL_RE.search(data)
+            if match is not None:
+                key = RateLimiter.key(match.group(1).decode('utf8'))
+                if key:
+                    return key
+        segments = parsed_url.path.split('/')
+        for i, segment in enumerate(segments):
+            if segment.lower() == 'me':
+                return 'me'
+            if segment.lower() == 'users' and i + 1 < len(segments):
+                return 'users/' + urllib.parse.unquote(segments[i + 1]).lower()
+        return parsed_url.netloc
+
+    def bucket(self, key):
+        """
+        returns the token bucket of the mailbox
+        """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def reserve(self, key):
+        """
+        returns the number of seconds to wait before sending a request to the mailbox
+        """
+        return self.bucket(key).reserve()
+
+    def acquire(self, key):
+        """
+        blocks until a request can be sent to the mailbox
+        """
+        wait = self.reserve(key)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self, key, retry_after=None):
+        """
+        to call when the server throttled a request to the mailbox
+        """
+        bucket = self.bucket(key)
+        bucket.set_rate(lambda rate: max(self.min_rate, rate / 2))
+        if retry_after:
+            bucket.pause(retry_after)
+
+    def succeeded(self, key):
+        """
+        to call when a request to the mailbox succeeded
+        """
+        bucket = self.bucket(key)
+        if bucket.rate < self.max_rate:
+            bucket.set_rate(lambda rate: min(self.max_rate, rate + self.increase))
@@ -3,33 +3,140 @@ some utils functions
 """
 
 import os
+import json
 from pathlib import Path
-from selenium import webdriver
 from azure_client.authentication import AzureAuth
+from azure_client.credentials import CredentialStore, file_lock, write_json_atomic
+from azure_client.exceptions import AzureError
+from azure_client.mail import _query_string
+from azure_client.sync import iter_sync_emails, _merge
 
 
 AZURE_AUTH_DIRECTORY = os.path.join(Path.home(), '.azure_auth')
+DELTA_LINKS_FILENAME = "delta_links.json"
 
 
 def create_azure_directory():
+    """
+    creates the directory $HOME/.azure_auth if it does not exist
+    """
     if not os.path.isdir(AZURE_AUTH_DIRECTORY):
         os.makedirs(AZURE_AUTH_DIRECTORY)
 
-def get_or_create_credentials(client_id, private_key, scope, tenant, redirect_uri, filename="credentials.json"):
+def get_or_create_credentials(client_id, private_key, scope, tenant, redirect_uri,
+                              filename="credentials.json"):
     """
     function which gets credentials in $HOME/.azure_auth/$filename if it
-    exists and regenerates a token, reauthentifies else
+    exists and regenerates a token if it expires soon, reauthentifies else,
+    the file is shared safely by several processes, only one of them
+    refreshes the token and the other ones reuse it, see
+    azure_client.credentials.CredentialStore
     """
     create_azure_directory()
-    auth = AzureAuth()
-    auth_path = os.path.join(AZURE_AUTH_DIRECTORY, filename)
-
-    if not os.path.exists(auth_path):
-        DriverGenerator = webdriver.Chrome
-        auth.authenticate(DriverGenerator, client_id, private_key, scope, tenant, redirect_uri)
-    else:
-        auth.get_auth_from_file(auth_path)
+    store = CredentialStore(os.path.join(AZURE_AUTH_DIRECTORY, filename))
+    auth = AzureAuth(store=store)
+
+    if not store.load(auth):
+        with store.lock():
+            # another process may have authenticated while this one waited for the lock
+            if not store.load(auth):
+                # selenium is only needed by the interactive flow, it is slow and heavy to import
+                from selenium import webdriver  # pylint: disable=import-outside-toplevel
+                DriverGenerator = webdriver.Chrome
+                auth.authenticate(DriverGenerator, client_id, private_key, scope, tenant,
+                                  redirect_uri)
+                store.save(auth)
+                return auth
+    if auth.expires_at is None or auth.token_expires_soon():
         auth.refresh_access_token()
-    auth.save_auth(auth_path)
 
     return auth
+
+def get_or_create_app_credentials(client_id, tenant, client_secret='', certificate='',  # pylint: disable=too-many-arguments
+                                  thumbprint='', filename="app_credentials.json"):
+    """
+    function which gets the application credentials in $HOME/.azure_auth/$filename
+    if they exist and requests a new token if it expires soon, authenticates the
+    application with its client secret or certificate else, no browser is needed,
+    the file is shared safely by several processes as in get_or_create_credentials
+    see AzureAuth.authenticate_application for the arguments
+    """
+    create_azure_directory()
+    store = CredentialStore(os.path.join(AZURE_AUTH_DIRECTORY, filename))
+    auth = AzureAuth(store=store)
+
+    if not store.load(auth):
+        with store.lock():
+            if not store.load(auth):
+                # the token is requested without the store, whose refresh would take
+                # the lock held here again and wait forever
+                auth.store = None
+                try:
+                    auth.authenticate_application(client_id, tenant, client_secret, certificate,
+                                                  thumbprint)
+                finally:
+                    auth.store = store
+                store.save(auth)
+                return auth
+    if auth.expires_at is None or auth.token_expires_soon():
+        auth.refresh_access_token()
+
+    return auth
+
+def _read_delta_links(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as data_file:
+        return json.load(data_file)
+
+def get_delta_link(key, filename=DELTA_LINKS_FILENAME):
+    """
+    returns the delta link saved in $HOME/.azure_auth/$filename
+    for the key, None if there is none
+    """
+    return _read_delta_links(os.path.join(AZURE_AUTH_DIRECTORY, filename)).get(key)
+
+def save_delta_link(key, delta_link, filename=DELTA_LINKS_FILENAME):
+    """
+    saves the delta link for the key in $HOME/.azure_auth/$filename,
+    the file is replaced atomically so that it is never left half written
+    and it is updated under a lock so that the concurrent synchronisations
+    do not lose each other's links
+    """
+    create_azure_directory()
+    path = os.path.join(AZURE_AUTH_DIRECTORY, filename)
+    with file_lock(path + '.lock'):
+        delta_links = _read_delta_links(path)
+        delta_links[key] = delta_link
+        write_json_atomic(path, delta_links)
+
+def iter_sync_folder(auth, user_id, folder_id='Inbox', filename=DELTA_LINKS_FILENAME, **kwargs):
+    """
+    generator version of sync_folder which yields one SyncResult per page
+    of changes, see azure_client.sync.iter_sync_emails, the delta link is
+    only saved once the last page has been consumed
+    """
+    key = '{}/{}?{}'.format(user_id, folder_id, _query_string(kwargs))
+    delta_link = get_delta_link(key, filename)
+    pages = iter_sync_emails(auth, user_id, folder_id, delta_link, **kwargs)
+    try:
+        page = next(pages)
+    except AzureError as err:
+        if delta_link is None or err.code != 410:
+            raise
+        # the synchronisation state expired on the server, starting over
+        pages = iter_sync_emails(auth, user_id, folder_id, **kwargs)
+        page = next(pages)
+    yield page
+    for page in pages:
+        yield page
+    save_delta_link(key, page.delta_link, filename)
+
+def sync_folder(auth, user_id, folder_id='Inbox', filename=DELTA_LINKS_FILENAME, **kwargs):
+    """
+    returns the azure_client.sync.SyncResult of the changes of the folder
+    since the previous call with the same arguments, all its messages
+    the first time, the delta link is saved in $HOME/.azure_auth/$filename
+    see azure_client.sync.sync_emails for the arguments
+    """
+    return _merge(iter_sync_folder(auth, user_id, folder_id, filename, **kwargs))
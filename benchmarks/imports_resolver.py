@@ -0,0 +1,4 @@
+import os
+import sys
+
+sys.path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path
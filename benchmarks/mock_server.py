@@ -0,0 +1,545 @@
+"""
+Local mock of the graph and login APIs used by the benchmarks, it serves
+the messages listings with pagination, the drafts creation, the sending,
+the deletion, the $batch requests, the tokens and the change notification
+subscriptions, with a configurable latency, throttling and size of the
+messages, the subscribers are notified of the messages created
+
+it can be run on its own, ex: python benchmarks/mock_server.py --port 8000
+the configuration is changed at runtime with POST /_reset and the
+counters are read with GET /_stats
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+DEFAULT_CONFIG = {
+    # the number of messages in the mailbox after a reset
+    'messages': 1000,
+    # the number of characters of the body of each message
+    'body_size': 1024,
+    # the number of seconds waited before each response
+    'latency': 0.0,
+    # every throttle_every-th request is answered with a 429, 0 to disable it
+    'throttle_every': 0,
+    # the Retry-After of the 429 responses in seconds
+    'retry_after': 0.1,
+    # the lifetime of the access tokens in seconds
+    'expires_in': 3600,
+    # the size of the file attached to each message, 0 for no attachment
+    'attachment_size': 0,
+    }
+
+_MAILBOX = r'/(?:me|users/[^/]+)'
+_LIST_RE = re.compile(_MAILBOX + r'/MailFolders/([^/]+)/messages$', re.IGNORECASE)
+_CREATE_RE = re.compile(_MAILBOX + r'/messages$')
+_SEND_MAIL_RE = re.compile(_MAILBOX + r'/sendMail$')
+_SEND_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/send$')
+_MESSAGE_RE = re.compile(_MAILBOX + r'/messages/([^/]+)$')
+_ATTACHMENTS_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/attachments$')
+_ATTACHMENT_VALUE_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/attachments/([^/]+)/\$value$')
+_RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+_MOVE_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/move$')
+_PERMANENT_DELETE_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/permanentDelete$')
+_MIME_RE = re.compile(_MAILBOX + r'/messages/([^/]+)/\$value$')
+_TOKEN_RE = re.compile(r'/[^/]+/oauth2/v2.0/token$')
+_FOLDERS_RE = re.compile(_MAILBOX + r'/mailFolders$', re.IGNORECASE)
+_FOLDER_RE = re.compile(_MAILBOX + r'/mailFolders/([^/]+)$', re.IGNORECASE)
+_CHILD_FOLDERS_RE = re.compile(_MAILBOX + r'/mailFolders/([^/]+)/childFolders$', re.IGNORECASE)
+# the folders of the mailbox, all the messages are in the first one
+FOLDERS = ('Inbox', 'Drafts', 'SentItems', 'DeletedItems')
+_SUBSCRIPTIONS_RE = re.compile(r'/subscriptions$')
+_SUBSCRIPTION_RE = re.compile(r'/subscriptions/([^/]+)$')
+
+
+def make_mime(message):
+    """
+    builds the MIME content of a message as returned by /$value
+    """
+    sender = (message.get('sender') or {}).get('emailAddress', {}).get(
+        'address', 'sender@example.com')
+    body = (message.get('body') or {}).get('content', '')
+    return ('From: {}\r\nSubject: {}\r\nMessage-ID: <{}@example.com>\r\n'
+            'Content-Type: text/html; charset=utf-8\r\n'
+            '\r\n{}\r\nFrom the mock server\r\n').format(
+                sender, message.get('subject', ''), message['id'], body).encode('utf8')
+
+
+def make_message(index, body_size):
+    """
+    builds one message as returned by the graph API
+    """
+    return {
+        'id': 'AAMk{:012d}'.format(index),
+        'changeKey': 'CQAAAB{:08d}'.format(index),
+        'subject': 'Message {}'.format(index),
+        'sender': {'emailAddress': {'name': 'Sender {}'.format(index % 50),
+                                    'address': 'sender{}@example.com'.format(index % 50)}},
+        'receivedDateTime': '2020-01-01T{:02d}:{:02d}:00Z'.format(index // 60 % 24, index % 60),
+        'isRead': index % 3 == 0,
+        'parentFolderId': 'Inbox',
+        'bodyPreview': 'Preview of the message {}'.format(index),
+        'body': {'contentType': 'html', 'content': '<p>{}</p>'.format('x' * body_size)},
+        }
+
+
+class MockGraphServer:
+
+    """
+    Class which runs the mock server in a background thread
+
+    Args:
+        host (str): the interface listened on
+        port (int): the port listened on, 0 for any free port
+        config: overrides the values of DEFAULT_CONFIG
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **config):
+        self.config = dict(DEFAULT_CONFIG)
+        self.messages = {}
+        self.subscriptions = {}
+        self.stats = {}
+        self._content = b''
+        self._lock = threading.Lock()
+        self.reset(**config)
+        self._server = ThreadingHTTPServer((host, port), _handler_class(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        the base url of the server, to use as API_URL and LOGIN_URL
+        """
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """
+        starts serving in a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        serves in the current thread until stop is called from another one
+        """
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        stops serving and closes the socket
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset(self, **config):
+        """
+        changes the configuration, refills the mailbox and resets the counters
+        """
+        with self._lock:
+            unknown = set(config) - set(DEFAULT_CONFIG)
+            if unknown:
+                raise ValueError('Unexpected options {}'.format(', '.join(sorted(unknown))))
+            self.config.update(config)
+            messages = (make_message(i, self.config['body_size'])
+                        for i in range(self.config['messages']))
+            self.messages = {message['id']: message for message in messages}
+            self.subscriptions = {}
+            self.stats = {'requests': 0, 'throttled': 0, 'tokens': 0, 'bytes_sent': 0,
+                          'notifications': 0, 'sent': 0}
+
+    def handle(self, method, url, body, headers=None):
+        """
+        answers one request, returns its status, its decoded body and its headers
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            throttle_every = self.config['throttle_every']
+            if throttle_every and self.stats['requests'] % throttle_every == 0:
+                self.stats['throttled'] += 1
+                error = _error('TooManyRequests', 'Too many requests')
+                return 429, error, {'Retry-After': str(self.config['retry_after'])}
+
+        parsed_url = urlsplit(url)
+        path = parsed_url.path
+        if path == '/$batch' and method == 'POST':
+            return self._batch(json.loads(body))
+        if _TOKEN_RE.search(path) and method == 'POST':
+            with self._lock:
+                self.stats['tokens'] += 1
+            token = {'access_token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex,
+                     'expires_in': self.config['expires_in'], 'token_type': 'Bearer'}
+            return 200, token, {}
+        match = _LIST_RE.search(path)
+        if match and method == 'GET':
+            return self._list(path, match.group(1), parse_qs(parsed_url.query))
+        if _CREATE_RE.search(path) and method == 'POST':
+            message = dict(json.loads(body), id=uuid.uuid4().hex, changeKey=uuid.uuid4().hex,
+                           parentFolderId='Drafts')
+            with self._lock:
+                self.messages[message['id']] = message
+            self._notify('created', message['id'])
+            return 201, message, {}
+        if _SUBSCRIPTIONS_RE.search(path):
+            if method == 'POST':
+                return self._subscribe(json.loads(body))
+            if method == 'GET':
+                with self._lock:
+                    return 200, {'value': list(self.subscriptions.values())}, {}
+        if _FOLDERS_RE.search(path) and method == 'GET':
+            return 200, {'value': [self._folder(name) for name in FOLDERS]}, {}
+        match = _FOLDER_RE.search(path)
+        if match and method == 'GET':
+            folder = self._folder(match.group(1))
+            return (200, folder, {}) if folder is not None else _not_found(path)
+        match = _CHILD_FOLDERS_RE.search(path)
+        if match and method == 'GET':
+            if self._folder(match.group(1)) is None:
+                return _not_found(path)
+            return 200, {'value': []}, {}
+        match = _SUBSCRIPTION_RE.search(path)
+        if match and method in ('PATCH', 'DELETE'):
+            with self._lock:
+                subscription = self.subscriptions.get(match.group(1))
+                if subscription is not None and method == 'PATCH':
+                    subscription.update(json.loads(body))
+                elif subscription is not None:
+                    del self.subscriptions[match.group(1)]
+            if subscription is None:
+                return _not_found(path)
+            return (200, subscription, {}) if method == 'PATCH' else (204, None, {})
+        if _SEND_MAIL_RE.search(path) and method == 'POST':
+            message = json.loads(body)['Message']
+            if not message.get('ToRecipients'):
+                return 400, _error('ErrorInvalidRecipients', 'No recipient'), {}
+            with self._lock:
+                self.stats['sent'] += 1
+            return 202, None, {}
+        match = _MOVE_RE.search(path)
+        if match and method == 'POST':
+            destination = self._folder(json.loads(body)['destinationId'])
+            if destination is None:
+                return _not_found(path)
+            with self._lock:
+                message = self.messages.pop(match.group(1), None)
+                if message is not None:
+                    # the graph API gives a new id to the messages moved
+                    message = dict(message, id=uuid.uuid4().hex, parentFolderId=destination['id'])
+                    self.messages[message['id']] = message
+            return (201, message, {}) if message is not None else _not_found(path)
+        match = _PERMANENT_DELETE_RE.search(path)
+        if match and method == 'POST':
+            with self._lock:
+                found = self.messages.pop(match.group(1), None) is not None
+            return (204, None, {}) if found else _not_found(path)
+        match = _SEND_RE.search(path)
+        if match and method == 'POST':
+            with self._lock:
+                found = self.messages.pop(match.group(1), None) is not None
+                self.stats['sent'] += found
+            return (202, None, {}) if found else _not_found(path)
+        match = _ATTACHMENTS_RE.search(path)
+        if match and method == 'GET':
+            return self._attachments(match.group(1), path, parse_qs(parsed_url.query))
+        match = _ATTACHMENT_VALUE_RE.search(path)
+        if match and method == 'GET':
+            return self._attachment_value(match.group(1), match.group(2), path,
+                                          (headers or {}).get('Range'))
+        match = _MIME_RE.search(path)
+        if match and method == 'GET':
+            with self._lock:
+                message = self.messages.get(match.group(1))
+            if message is None:
+                return _not_found(path)
+            return 200, make_mime(message), {'Content-Type': 'message/rfc822'}
+        match = _MESSAGE_RE.search(path)
+        if match and method == 'GET':
+            with self._lock:
+                message = self.messages.get(match.group(1))
+            return (200, message, {}) if message is not None else _not_found(path)
+        if match and method == 'DELETE':
+            with self._lock:
+                found = self.messages.pop(match.group(1), None) is not None
+            return (204, None, {}) if found else _not_found(path)
+        return _not_found(path)
+
+    def _folder_messages(self, folder_id):
+        """
+        returns the messages of a folder, all of them for 'AllItems'
+        """
+        if folder_id.lower() == 'allitems':
+            return list(self.messages.values())
+        return [message for message in self.messages.values()
+                if message.get('parentFolderId', '').lower() == folder_id.lower()]
+
+    def _list(self, path, folder_id, query):
+        top = int(query.get('$top', ['10'])[0])
+        skip = int(query.get('$skip', ['0'])[0])
+        with self._lock:
+            messages = self._folder_messages(folder_id)
+            page = messages[skip:skip + top]
+            total = len(messages)
+        if '$select' in query:
+            fields = query['$select'][0].split(',')
+            page = _select(page, fields)
+        resp_data = {'value': page}
+        if '$count' in query:
+            resp_data['@odata.count'] = total
+        if skip + top < total:
+            next_query = {key: items[0] for (key, items) in query.items()}
+            next_query['$skip'] = skip + top
+            resp_data['@odata.nextLink'] = '{}{}?{}'.format(self.url, path, urlencode(next_query))
+        return 200, resp_data, {}
+
+    def _folder(self, folder_id):
+        """
+        returns the resource of a folder with its counts, None if it does not exist
+        """
+        names = {name.lower(): name for name in FOLDERS}
+        name = names.get(folder_id.lower())
+        if name is None:
+            return None
+        with self._lock:
+            messages = self._folder_messages(name)
+        return {
+            'id': name, 'displayName': name, 'parentFolderId': 'root', 'childFolderCount': 0,
+            'totalItemCount': len(messages),
+            'unreadItemCount': sum(not message.get('isRead') for message in messages),
+            }
+
+    def _attachment_content(self):
+        size = self.config['attachment_size']
+        if len(self._content) != size:
+            self._content = (bytes(range(256)) * (size // 256 + 1))[:size]
+        return self._content
+
+    def _attachments(self, message_id, path, query):
+        with self._lock:
+            if message_id not in self.messages:
+                return _not_found(path)
+            size = self.config['attachment_size']
+        attachments = []
+        if size:
+            attachments.append({
+                '@odata.type': '#microsoft.graph.fileAttachment', 'id': 'ATT0', 'name': 'file.bin',
+                'contentType': 'application/octet-stream', 'size': size + 200, 'isInline': False,
+                })
+        if '$select' in query:
+            fields = query['$select'][0].split(',') + ['@odata.type']
+            attachments = _select(attachments, fields)
+        return 200, {'value': attachments}, {}
+
+    def _attachment_value(self, message_id, attachment_id, path, range_header):
+        with self._lock:
+            found = message_id in self.messages and attachment_id == 'ATT0'
+            if not found or not self.config['attachment_size']:
+                return _not_found(path)
+            content = self._attachment_content()
+        match = _RANGE_RE.match(range_header or '')
+        if match is None:
+            return 200, content, {'Content-Type': 'application/octet-stream'}
+        start = int(match.group(1))
+        if start >= len(content):
+            return 416, None, {'Content-Range': 'bytes */{}'.format(len(content))}
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))}
+        return 206, content[start:end + 1], headers
+
+    def _subscribe(self, data):
+        """
+        validates the notification url as the graph API does, by expecting
+        a validation token back, then stores the subscription
+        """
+        token = uuid.uuid4().hex
+        url = '{}?{}'.format(data['notificationUrl'], urlencode({'validationToken': token}))
+        try:
+            request = urllib.request.Request(url, b'', method='POST')
+            with urllib.request.urlopen(request, timeout=10) as resp:
+                valid = resp.status == 200 and resp.read().decode('utf8') == token
+        except OSError:
+            valid = False
+        if not valid:
+            return 400, _error('ValidationError', 'Subscription validation request failed'), {}
+        subscription = dict(data, id=uuid.uuid4().hex)
+        with self._lock:
+            self.subscriptions[subscription['id']] = subscription
+        resp_data = {key: value for (key, value) in subscription.items() if key != 'clientState'}
+        return 201, resp_data, {}
+
+    def _notify(self, change_type, message_id):
+        """
+        posts the notifications of a change to the subscribers in the background
+        """
+        with self._lock:
+            subscriptions = [subscription for subscription in self.subscriptions.values()
+                             if change_type in subscription['changeType'].split(',')]
+        for subscription in subscriptions:
+            notification = {
+                'subscriptionId': subscription['id'],
+                'subscriptionExpirationDateTime': subscription['expirationDateTime'],
+                'changeType': change_type,
+                'resource': 'Users/me/Messages/{}'.format(message_id),
+                'clientState': subscription.get('clientState'),
+                'resourceData': {'@odata.type': '#Microsoft.Graph.Message', 'id': message_id},
+                }
+            body = json.dumps({'value': [notification]}).encode('utf8')
+            request = urllib.request.Request(
+                subscription['notificationUrl'], body, {'Content-Type': 'application/json'})
+            threading.Thread(target=self._post_notification, args=(request,), daemon=True).start()
+
+    def _post_notification(self, request):
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+        except OSError:
+            return
+        with self._lock:
+            self.stats['notifications'] += 1
+
+    def _batch(self, data):
+        responses = []
+        for request in data['requests']:
+            body = json.dumps(request['body']).encode('utf8') if 'body' in request else b''
+            status, resp_data, headers = self.handle(request['method'], request['url'], body)
+            response = {'id': request['id'], 'status': status, 'headers': headers}
+            if resp_data is not None:
+                response['body'] = resp_data
+            responses.append(response)
+        return 200, {'responses': responses}, {}
+
+
+def _select(items, fields):
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+def _error(code, message):
+    return {'error': {'code': code, 'message': message}}
+
+
+def _not_found(path):
+    return 404, _error('ErrorItemNotFound', 'Not found: {}'.format(path)), {}
+
+
+def _handler_class(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        """
+        dispatches the requests to the MockGraphServer
+        """
+
+        protocol_version = 'HTTP/1.1'
+        # the headers and the body are written separately, without that
+        # the delayed acknowledgements would add 40ms to the small responses
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+        def _reply(self, status, resp_data=None, headers=None):
+            headers = dict(headers or {})
+            if isinstance(resp_data, bytes):
+                body = resp_data
+            else:
+                body = json.dumps(resp_data).encode('utf8') if resp_data is not None else b''
+                if body:
+                    headers['Content-Type'] = 'application/json'
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            with server._lock:  # pylint: disable=protected-access
+                server.stats['bytes_sent'] += len(body)
+
+        def _go(self, method):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/_stats':
+                self._reply(200, dict(server.stats, messages=len(server.messages)))
+                return
+            if self.path == '/_reset':
+                server.reset(**json.loads(body or b'{}'))
+                self._reply(200, server.config)
+                return
+            if server.config['latency']:
+                time.sleep(server.config['latency'])
+            self._reply(*server.handle(method, self.path, body, self.headers))
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            answers a GET request
+            """
+            self._go('GET')
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """
+            answers a POST request
+            """
+            self._go('POST')
+
+        def do_PUT(self):  # pylint: disable=invalid-name
+            """
+            answers a PUT request
+            """
+            self._go('PUT')
+
+        def do_PATCH(self):  # pylint: disable=invalid-name
+            """
+            answers a PATCH request
+            """
+            self._go('PATCH')
+
+        def do_DELETE(self):  # pylint: disable=invalid-name
+            """
+            answers a DELETE request
+            """
+            self._go('DELETE')
+
+    return Handler
+
+
+def main():
+    """
+    runs the mock server until it is interrupted
+    """
+    parser = argparse.ArgumentParser(description='Mock of the graph and login APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    for name, value in DEFAULT_CONFIG.items():
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=type(value),
+                            default=value)
+    args = vars(parser.parse_args())
+    host, port = args.pop('host'), args.pop('port')
+    server = MockGraphServer(host, port, **args)
+    # the first line tells the parent process where the server listens
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server._server.server_close()  # pylint: disable=protected-access
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
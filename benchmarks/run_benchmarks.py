@@ -0,0 +1,352 @@
+"""
+Benchmarks of azure_client against the local mock server of
+benchmarks/mock_server.py, which runs in a child process so that it
+does not compete with the client for the interpreter
+
+each scenario is run against a freshly reset mailbox, timed, then run
+once more under tracemalloc for its peak memory, the results are
+written as json, ex:
+    python benchmarks/run_benchmarks.py --messages 5000 --latency 0.01 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json
+the second run exits with the status 1 if a scenario got slower than
+the baseline by more than the tolerance
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import imports_resolver  # pylint: disable=unused-import
+import azure_client
+from azure_client import authentication, mail
+from azure_client import (AzureAuth, HttpSession, RateLimiter, get_all_emails_it, iter_all_emails,
+                          create_drafts, send_emails, send_mails, delete_emails)
+
+
+USER_ID = 'me'
+FOLDER_ID = 'Inbox'
+
+
+class TimedSession(HttpSession):
+
+    """
+    HttpSession which records the duration of each request, retries included
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.durations = []
+        self._durations_lock = threading.Lock()
+
+    def request(self, method, url, data=None, headers=None, stream=False):  # pylint: disable=too-many-arguments
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, data, headers, stream)
+        finally:
+            duration = time.perf_counter() - start
+            with self._durations_lock:
+                self.durations.append(duration)
+
+
+class MockProcess:
+
+    """
+    runs benchmarks/mock_server.py in a child process
+    """
+
+    def __init__(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')
+        self.process = subprocess.Popen([sys.executable, script], stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        self.url = self.process.stdout.readline().strip()
+
+    def call(self, path, data=None):
+        """
+        calls one of the control endpoints of the mock
+        """
+        body = json.dumps(data).encode('utf8') if data is not None else None
+        with urllib.request.urlopen(self.url + path, body) as resp:
+            return json.loads(resp.read())
+
+    def reset(self, **config):
+        """
+        empties the mailbox of the mock and replaces its configuration
+        """
+        return self.call('/_reset', config)
+
+    def stats(self):
+        """
+        returns the counters of the requests received by the mock
+        """
+        return self.call('/_stats')
+
+    def close(self):
+        """
+        stops the mock server
+        """
+        self.process.terminate()
+        self.process.wait()
+
+
+def point_to(url):
+    """
+    makes every module of azure_client send its requests to url, they
+    all read the urls of azure_client.mail and authentication when called
+    """
+    mail.API_URL = url
+    authentication.LOGIN_URL = url
+
+
+def new_auth(session):
+    """
+    returns an AzureAuth with a valid token of the mock using that session
+    """
+    auth = AzureAuth(session=session)
+    auth.client_id = 'benchmark'
+    auth.tenant = 'common'
+    auth.access_token = 'access'
+    auth.refresh_token = 'refresh'
+    auth.expires_at = time.time() + 3600
+    return auth
+
+
+def _list_full(args, auth, _):
+    pages = get_all_emails_it(auth, USER_ID, FOLDER_ID, pages_size=args.page_size, select=None)
+    return sum(len(page) for page in pages)
+
+
+def _list_projected(args, auth, _):
+    pages = get_all_emails_it(auth, USER_ID, FOLDER_ID, pages_size=args.page_size)
+    return sum(len(page) for page in pages)
+
+
+def _list_streamed(args, auth, _):
+    messages = iter_all_emails(auth, USER_ID, FOLDER_ID, pages_size=args.page_size, compact=True)
+    return sum(1 for _ in messages)
+
+
+def _message_ids(args, auth):
+    pages = get_all_emails_it(auth, USER_ID, FOLDER_ID, pages_size=1000, select='id')
+    return [message['id'] for page in pages for message in page][:args.operations]
+
+
+def _drafts(args):
+    return [{'subject': 'Draft {}'.format(i), 'body': '<p>{}</p>'.format('x' * args.body_size),
+             'addresses': ['recipient{}@example.com'.format(i)]} for i in range(args.operations)]
+
+
+def _create(args, auth, _):
+    return sum(result.ok for result in create_drafts(auth, USER_ID, _drafts(args), args.workers))
+
+
+def _create_and_send(args, auth, _):
+    results = create_drafts(auth, USER_ID, _drafts(args), args.workers)
+    message_ids = [result.value for result in results if result.ok]
+    return sum(result.ok for result in send_emails(auth, USER_ID, message_ids, args.workers))
+
+
+def _send_direct(args, auth, _):
+    results = send_mails(auth, USER_ID, _drafts(args), max_workers=args.workers)
+    return sum(result.ok for result in results)
+
+
+def _send(args, auth, message_ids):
+    return sum(result.ok for result in send_emails(auth, USER_ID, message_ids, args.workers))
+
+
+def _delete(args, auth, message_ids):
+    return sum(result.ok for result in delete_emails(auth, USER_ID, message_ids, args.workers))
+
+
+def _refresh(args, auth, _):
+    for _ in range(args.refreshes):
+        auth.refresh_access_token()
+    return args.refreshes
+
+
+# name: (function run, function preparing its input or None, configuration of the mock)
+SCENARIOS = {
+    'list_full': (_list_full, None, {}),
+    'list_projected': (_list_projected, None, {}),
+    'list_streamed': (_list_streamed, None, {}),
+    'list_throttled': (_list_full, None, {'throttle_every': 5}),
+    'create': (_create, None, {}),
+    'send': (_send, _message_ids, {}),
+    'create_and_send': (_create_and_send, None, {}),
+    'send_direct': (_send_direct, None, {}),
+    'delete': (_delete, _message_ids, {}),
+    'delete_throttled': (_delete, _message_ids, {'throttle_every': 7}),
+    'refresh': (_refresh, None, {}),
+    }
+
+
+def percentile(values, percent):
+    """
+    returns the nearest-rank percentile of values, None if there is none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+def run_scenario(name, args, mock):
+    """
+    runs one scenario, returns its measures
+    """
+    function, prepare, config = SCENARIOS[name]
+    mock_config = {
+        'messages': args.messages,
+        'body_size': args.body_size,
+        'latency': args.latency,
+        'throttle_every': 0,
+        'retry_after': args.retry_after,
+        }
+    mock_config.update(config)
+
+    def run(trace):
+        mock.reset(**mock_config)
+        session = TimedSession(pool_size=args.workers,
+                               rate_limiter=RateLimiter(rate=args.rate, burst=args.rate))
+        auth = new_auth(session)
+        prepared = prepare(args, auth) if prepare is not None else None
+        session.durations.clear()
+        stats_before = mock.stats()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        operations = function(args, auth, prepared)
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stats = {key: value - stats_before[key]
+                 for (key, value) in mock.stats().items() if key != 'messages'}
+        session.close()
+        return operations, seconds, session.durations, peak, stats
+
+    operations, seconds, durations, _, stats = run(trace=False)
+    peak = run(trace=True)[3]
+
+    return {
+        'scenario': name,
+        'operations': operations,
+        'seconds': round(seconds, 6),
+        'throughput': round(operations / seconds, 3) if seconds else None,
+        'requests': len(durations),
+        'p50_ms': _milliseconds(percentile(durations, 50)),
+        'p99_ms': _milliseconds(percentile(durations, 99)),
+        'peak_memory_kib': round(peak / 1024, 1),
+        'server': stats,
+        }
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def compare(results, baseline, tolerance):
+    """
+    returns the scenarios whose throughput dropped by more than tolerance
+    compared to the baseline results
+    """
+    previous = {result['scenario']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None or not before.get('throughput') or result['throughput'] is None:
+            continue
+        ratio = result['throughput'] / before['throughput']
+        result['baseline_ratio'] = round(ratio, 3)
+        if ratio < 1 - tolerance:
+            regressions.append(result['scenario'])
+    return regressions
+
+
+def main():
+    """
+    runs the scenarios and prints their report, returns 1 if one regressed
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of azure_client against a local mock server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='the scenarios to run separated by commas, among {}'.format(
+                            ', '.join(SCENARIOS)))
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='the number of messages in the mailbox')
+    parser.add_argument('--body-size', type=int, default=2048,
+                        help='the size of the body of the messages')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='the number of messages per page')
+    parser.add_argument('--operations', type=int, default=500,
+                        help='the number of drafts created, sent or deleted')
+    parser.add_argument('--refreshes', type=int, default=200, help='the number of token refreshes')
+    parser.add_argument('--workers', type=int, default=4, help='the number of concurrent batches')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='the latency of the mock in seconds')
+    parser.add_argument('--retry-after', type=float, default=0.05,
+                        help='the Retry-After of the throttled requests')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='the requests per second allowed by the rate limiter, '
+                             'high so that it does not dominate')
+    parser.add_argument('--output',
+                        help='the file where the json results are written, stdout if not given')
+    parser.add_argument('--baseline', help='the json results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='the relative drop of throughput reported as a regression')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios {}'.format(', '.join(unknown)))
+
+    mock = MockProcess()
+    try:
+        point_to(mock.url)
+        results = []
+        for name in names:
+            results.append(run_scenario(name, args, mock))
+            print('{scenario}: {throughput} ops/s, p50 {p50_ms} ms, p99 {p99_ms} ms, '
+                  'peak {peak_memory_kib} KiB'.format(**results[-1]), file=sys.stderr)
+    finally:
+        mock.close()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'azure_client_path': os.path.dirname(azure_client.__file__),
+        'config': {key: value for (key, value) in vars(args).items()
+                   if key not in ('output', 'baseline')},
+        'results': results,
+        }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        report['regressions'] = regressions
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
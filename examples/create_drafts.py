@@ -3,14 +3,13 @@ basic example which creates email drafts
 """
 
 import json
-import base64
 import logging.config
 import os
 from pathlib import Path
 from selenium import webdriver
 
 import imports_resolver
-from azure_client import create_draft, get_or_create_credentials
+from azure_client import create_draft, create_draft_with_files, get_or_create_credentials, MailTemplate, mail_merge
 
 from settings import LOGGING, get_cred_data
 
@@ -23,12 +22,11 @@ if __name__ == "__main__":
     with open('examples/test_email.json', 'r') as f:
         email_data = json.load(f)
 
-    for _ in range(100):
-        create_draft(auth, **email_data)
+    # the template is serialized once for the 100 drafts, created with batch requests
+    template = MailTemplate(email_data['subject'], email_data['body'])
+    recipients = [(email_data['addresses'], {})] * 100
+    mail_merge(auth, email_data['user_id'], template, recipients, send=False)
 
     EMAIL_ID = create_draft(auth, **email_data)
 
-    NAME = "attachment.tsv"
-    with open('examples/data/attachment.tsv', 'rb') as f:
-        CONTENT_BYTES = base64.b64encode(f.read()).decode('utf8')
-        create_draft(auth, **email_data, attachments_list=[{"Name": NAME, "ContentBytes": CONTENT_BYTES, "@odata.type": "#Microsoft.OutlookServices.FileAttachment"}])
+    create_draft_with_files(auth, **email_data, files=['examples/data/attachment.tsv'])
@@ -2,7 +2,7 @@ import logging.config
 import json
 
 import imports_resolver
-from azure_client import get_or_create_credentials, get_all_emails_it, delete_email
+from azure_client import get_or_create_credentials, empty_folder
 
 from settings import LOGGING, get_cred_data
 
@@ -15,6 +15,5 @@ if __name__ == "__main__":
         exit()
     cred_data = get_cred_data()
     auth = get_or_create_credentials(**cred_data)
-    for emails_data in get_all_emails_it(auth, "me", folder, select="id"):
-        for d in emails_data:
-            delete_email(auth, "me", d['id'])
+    deleted = empty_folder(auth, "me", folder)
+    print('{} messages deleted'.format(deleted))
@@ -2,7 +2,7 @@ import logging.config
 import json
 
 import imports_resolver
-from azure_client import get_or_create_credentials, get_emails
+from azure_client import get_or_create_credentials, get_emails, get_folder
 
 from settings import LOGGING, get_cred_data
 
@@ -11,6 +11,7 @@ logging.config.dictConfig(LOGGING)
 if __name__ == "__main__":
     cred_data = get_cred_data()
     auth = get_or_create_credentials(**cred_data)
+    drafts = get_folder(auth, "me", "Drafts")
+    print('Number of emails: {}, unread: {}'.format(drafts['totalItemCount'], drafts['unreadItemCount']))
     emails = get_emails(auth, "me", "Drafts", select="id")
-    print('Number of emails: {}'.format(len(emails)))
     print(emails)
@@ -2,7 +2,7 @@ from distutils.core import setup
 
 setup(
     name = "azure_client",
-    packages = ["azure_client"],
+    packages = ["azure_client", "azure_client.aio"],
     version = "1.0.12",
     description = "Library which handles the microsoft Azure REST API",
     author = "Arnaud Paran",
@@ -0,0 +1,63 @@
+"""
+Tests of azure_client.batch
+"""
+
+import base64
+import unittest
+from azure_client import codec
+from azure_client.batch import BATCH_SIZE, MAX_BATCH_BYTES, _chunks, _encode_batch, _sub_request
+from azure_client.mail import _draft_data
+
+
+def _draft_with_attachment(size):
+    attachment = {
+        '@odata.type': '#microsoft.graph.fileAttachment',
+        'name': 'file.bin',
+        'contentBytes': base64.b64encode(b'x' * size).decode('ascii'),
+        }
+    return _draft_data('subject', 'body', ['to@example.com'], (), [attachment])
+
+
+class ChunksTest(unittest.TestCase):
+
+    """
+    the split of the requests in batches
+    """
+
+    def test_dict_bodies_count_in_the_size(self):
+        """
+        the drafts with large attachments are sent one per batch
+        """
+        # 3 MB attachments become 4 MB of base64, one request per batch at most
+        requests = [_sub_request('POST', '/me/messages', _draft_with_attachment(3 * 1000 * 1000))
+                    for _ in range(3)]
+        chunks = list(_chunks(requests, MAX_BATCH_BYTES))
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 1, 1])
+
+    def test_raw_dict_bodies_are_counted_and_serialized(self):
+        """
+        the dict bodies given to execute_batch are counted and serialized once
+        """
+        body = _draft_with_attachment(1200 * 1000)
+        requests = [{'method': 'POST', 'url': '/me/messages', 'body': body} for _ in range(5)]
+        chunks = list(_chunks(requests, MAX_BATCH_BYTES))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        for chunk in chunks:
+            self.assertLessEqual(len(_encode_batch(chunk)), 4 * 1024 * 1024)
+            for request in chunk:
+                self.assertEqual(codec.loads(request['body']), body)
+        # the requests given are not modified
+        self.assertIs(requests[0]['body'], body)
+
+    def test_small_bodies_are_split_by_count(self):
+        """
+        the small requests are sent by BATCH_SIZE
+        """
+        requests = [_sub_request('POST', '/me/messages', {'subject': str(i)})
+                    for i in range(2 * BATCH_SIZE + 1)]
+        chunks = list(_chunks(requests, MAX_BATCH_BYTES))
+        self.assertEqual([len(chunk) for chunk in chunks], [BATCH_SIZE, BATCH_SIZE, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
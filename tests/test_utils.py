@@ -0,0 +1,74 @@
+"""
+Tests of azure_client.utils
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from azure_client import utils
+from azure_client.authentication import AzureAuth, CLIENT_CREDENTIALS
+
+
+class GetOrCreateAppCredentialsTest(unittest.TestCase):
+
+    """
+    get_or_create_app_credentials with a fake token endpoint
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch.object(utils, 'AZURE_AUTH_DIRECTORY', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.requests = []
+
+        def get_token(data, tenant, session=None):  # pylint: disable=unused-argument
+            self.requests.append(data)
+            return 'token{}'.format(len(self.requests)), 3600
+
+        patcher = mock.patch.object(AzureAuth, '_get_client_credentials_token',
+                                    staticmethod(get_token))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self):
+        # the call runs in a thread so that a deadlock fails the test instead of hanging it
+        result = {}
+
+        def run():
+            result['auth'] = utils.get_or_create_app_credentials(
+                'client', 'tenant', client_secret='secret', filename='app.json')
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'get_or_create_app_credentials did not return')
+        return result['auth']
+
+    def test_first_run_authenticates_and_saves(self):
+        """
+        the first run requests a token and saves it without deadlocking
+        """
+        auth = self._run()
+        self.assertEqual(auth.access_token, 'token1')
+        self.assertEqual(auth.grant_type, CLIENT_CREDENTIALS)
+        self.assertIsNotNone(auth.store)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'app.json')))
+        self.assertEqual(len(self.requests), 1)
+
+    def test_next_run_reuses_the_saved_token(self):
+        """
+        the next runs load the token saved instead of requesting a new one
+        """
+        self._run()
+        auth = self._run()
+        self.assertEqual(auth.access_token, 'token1')
+        self.assertEqual(len(self.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()